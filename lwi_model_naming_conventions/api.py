@@ -0,0 +1,58 @@
+# Copyright (C) 2021-present State of Louisiana, Division of Administration, Office of Community Development.
+# All rights reserved. Licensed under the GPLv3 License. See LICENSE.txt in the project root for license information.
+
+"""
+Python API for labeling the streams of a watershed in-process.
+
+Unlike the lwi-label-nhd-streams command, these functions have no filesystem side effects: labeled reaches are
+returned rather than written to output files, and nothing is printed. For example:
+
+    from lwi_model_naming_conventions.api import label_huc8
+    for reach in label_huc8('08080101', 'AA', network_cache_path='data/NHDPlusV2.lwinet'):
+        print(reach.stream_label, reach.comid)
+"""
+
+import io
+from typing import List
+
+from lwi_model_naming_conventions.network import FlowlineNetwork
+from lwi_model_naming_conventions.sinks import LabeledReach
+from lwi_model_naming_conventions.sources import NetworkSource, get_network_source
+from lwi_model_naming_conventions.cmd.lwi_label_nhd_streams import label_streams_for_huc8, iter_labeled_rows
+
+
+def label_network(network: FlowlineNetwork, huc8: str, ws_code: str, base32: bool = True,
+                  log: io.TextIOBase = None) -> List[LabeledReach]:
+    """
+    Label the streams of a watershed whose subnetwork has already been loaded. The network's flowlines are labeled
+    in place, so a network should only be labeled once.
+
+    :param log: Text stream to write labeling statistics and warnings to. Discarded if None.
+    :return: Labeled reaches, in the same order as in labeling output
+    """
+    if log is None:
+        log = io.StringIO()
+    flowlines_by_stream_id = label_streams_for_huc8(network, huc8, ws_code, log, base32)
+    return [LabeledReach(*row) for row in iter_labeled_rows(flowlines_by_stream_id, ws_code, huc8, log)]
+
+
+def label_huc8(huc8: str, ws_code: str, flowline_path: str = None, plusflow_path: str = None, nhd_hr: bool = False,
+               network_cache_path: str = None, base32: bool = True, source: NetworkSource = None,
+               log: io.TextIOBase = None) -> List[LabeledReach]:
+    """
+    Label the streams of a watershed.
+
+    The watershed's subnetwork is loaded from source if specified, otherwise from the NHDPlus SQLite files or network
+    cache specified (as with the -f, -p, --nhdhr and -c options of lwi-label-nhd-streams). The databases (or cache)
+    are kept open by this process, so subsequent calls don't have to open them again.
+
+    :return: Labeled reaches, in the same order as in labeling output. Empty if there are no flowlines in huc8.
+    """
+    if source is None:
+        if not flowline_path and not network_cache_path:
+            raise ValueError('One of flowline_path or network_cache_path must be specified.')
+        source = get_network_source(flowline_path, plusflow_path, nhd_hr, network_cache_path)
+    network = source.load_huc8_network(huc8)
+    if len(network) == 0:
+        return []
+    return label_network(network, huc8, ws_code, base32, log)
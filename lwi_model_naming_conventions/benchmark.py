@@ -0,0 +1,173 @@
+# Copyright (C) 2021-present State of Louisiana, Division of Administration, Office of Community Development.
+# All rights reserved. Licensed under the GPLv3 License. See LICENSE.txt in the project root for license information.
+
+"""
+Benchmark of stream labeling, stage by stage, with a check that labels are unchanged.
+
+Each watershed is labeled in the following stages:
+    load: Load the watershed's subnetwork from the NHDPlus databases or network cache
+    find_roots: Find and sort root flowlines
+    assign: Assign orders and labels to flowlines
+    compact: Convert labels to compact form
+    output: Write labeled flowlines as CSV (to a temporary directory)
+
+For each stage, the fastest of several runs is reported, along with the number of SQL queries issued, and, from an
+additional run with tracemalloc enabled, the peak memory allocated during the stage.
+
+Golden label files hold the label of every flowline (as huc8, comid, stream_label CSV rows). Comparing labels with a
+golden file written before making a change shows whether the change alters any labels.
+"""
+
+import io
+import os
+import csv
+import time
+import tempfile
+import tracemalloc
+from typing import Dict, List, Tuple
+
+from lwi_model_naming_conventions.sources import NetworkSource
+from lwi_model_naming_conventions.sinks import CSVOutputSink
+from lwi_model_naming_conventions.cmd.lwi_label_nhd_streams import find_root_flowlines, sort_root_flowlines, \
+    assign_stream_labels, compact_stream_labels, iter_labeled_rows
+
+STAGES = ('load', 'find_roots', 'assign', 'compact', 'output')
+GOLDEN_FIELDS = ['huc8', 'comid', 'stream_label']
+# Number of label differences to report
+MAX_DIFFERENCES_REPORTED = 10
+
+
+def run_stages(source: NetworkSource, ws_code: str, huc8: str, base32: bool, output_dir: str,
+               trace_memory: bool = False) -> Tuple[Dict[str, dict], List[Tuple[str, str, str]]]:
+    """
+    Label a watershed, measuring each stage.
+
+    :return: Tuple of (measurements of each stage, keyed by stage name, list of (huc8, comid, stream_label) of each
+        labeled flowline). Measurements are a dict of 'seconds', 'queries', and, if trace_memory, 'peak_memory'.
+    """
+    stages = {}
+
+    def run(name, func, *args):
+        num_queries = source.num_queries
+        if trace_memory:
+            tracemalloc.start()
+        start = time.perf_counter()
+        result = func(*args)
+        stage = {'seconds': time.perf_counter() - start, 'queries': source.num_queries - num_queries}
+        if trace_memory:
+            stage['peak_memory'] = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        stages[name] = stage
+        return result
+
+    network = run('load', source.load_huc8_network, huc8)
+    root_flowlines = run('find_roots', lambda: sort_root_flowlines(find_root_flowlines(network, huc8)))
+    stream_orders, _, _ = run('assign', assign_stream_labels, network, huc8, root_flowlines, base32)
+    flowlines_by_stream_id = run('compact', compact_stream_labels, stream_orders, base32)
+    run('output', CSVOutputSink(output_dir).write_huc8, ws_code, huc8,
+        iter_labeled_rows(flowlines_by_stream_id, ws_code, huc8, io.StringIO()))
+    labels = [(huc8, str(f.comid), f"{ws_code}{k}")
+              for k, flowlines in flowlines_by_stream_id.items() for f in flowlines]
+    return stages, labels
+
+
+def benchmark(source: NetworkSource, watersheds: List[Tuple[str, str, str]], base32: bool = True,
+              repeat: int = 3) -> Tuple[List[dict], List[Tuple[str, str, str]]]:
+    """
+    :return: Tuple of (results for each watershed, labels of all flowlines as returned by run_stages()). Results are
+        a dict of 'ws_code', 'huc8', 'reaches' (number of labeled flowlines), and 'stages' (measurements of each
+        stage, keyed by stage name, with 'reaches_per_second' added).
+    """
+    results = []
+    all_labels = []
+    with tempfile.TemporaryDirectory() as output_dir:
+        for ws in watersheds:
+            ws_code, huc8 = ws[0], ws[1]
+            best = None
+            labels = None
+            for _ in range(max(1, repeat)):
+                stages, labels = run_stages(source, ws_code, huc8, base32, output_dir)
+                if best is None:
+                    best = stages
+                else:
+                    for name, stage in stages.items():
+                        best[name]['seconds'] = min(best[name]['seconds'], stage['seconds'])
+            memory, _ = run_stages(source, ws_code, huc8, base32, output_dir, trace_memory=True)
+            for name, stage in best.items():
+                stage['peak_memory'] = memory[name]['peak_memory']
+                stage['reaches_per_second'] = len(labels) / stage['seconds'] if stage['seconds'] > 0 else None
+            results.append({'ws_code': ws_code, 'huc8': huc8, 'reaches': len(labels), 'stages': best})
+            all_labels.extend(labels)
+    return results, all_labels
+
+
+def format_results(results: List[dict]) -> str:
+    buff = io.StringIO()
+    buff.write(f"{'HUC8':<10}{'stage':<12}{'reaches':>10}{'seconds':>12}{'reaches/s':>14}{'queries':>10}"
+               f"{'peak MB':>10}\n")
+    totals = {name: [0, 0.0, 0, 0] for name in STAGES}
+    for result in results:
+        for name in STAGES:
+            stage = result['stages'][name]
+            rate = stage['reaches_per_second']
+            buff.write(f"{result['huc8']:<10}{name:<12}{result['reaches']:>10}{stage['seconds']:>12.4f}"
+                       f"{rate if rate is not None else float('nan'):>14.0f}{stage['queries']:>10}"
+                       f"{stage['peak_memory'] / (1024 * 1024):>10.1f}\n")
+            total = totals[name]
+            total[0] += result['reaches']
+            total[1] += stage['seconds']
+            total[2] += stage['queries']
+            total[3] = max(total[3], stage['peak_memory'])
+    for name in STAGES:
+        reaches, seconds, queries, peak_memory = totals[name]
+        rate = reaches / seconds if seconds > 0 else float('nan')
+        buff.write(f"{'total':<10}{name:<12}{reaches:>10}{seconds:>12.4f}{rate:>14.0f}{queries:>10}"
+                   f"{peak_memory / (1024 * 1024):>10.1f}\n")
+    return buff.getvalue()
+
+
+def write_golden_labels(path: str, labels: List[Tuple[str, str, str]]):
+    with open(path, 'w') as f:
+        w = csv.writer(f, delimiter=',', quotechar='"')
+        w.writerow(GOLDEN_FIELDS)
+        w.writerows(sorted(labels))
+
+
+def read_golden_labels(path: str) -> Dict[Tuple[str, str], str]:
+    """
+    :return: Stream labels keyed by (huc8, comid)
+    """
+    with open(path, 'r') as f:
+        reader = csv.reader(f)
+        next(reader)
+        return {(huc8, comid): label for huc8, comid, label in reader}
+
+
+def compare_golden_labels(golden: Dict[Tuple[str, str], str],
+                          labels: List[Tuple[str, str, str]]) -> List[str]:
+    """
+    Compare labels with golden labels, for the HUC8s in labels only.
+
+    :return: Descriptions of differences, empty if labels are identical to the golden labels
+    """
+    huc8s = {huc8 for huc8, _, _ in labels}
+    expected = {k: v for k, v in golden.items() if k[0] in huc8s}
+    actual = {(huc8, comid): label for huc8, comid, label in labels}
+    differences = []
+    for key in sorted(expected.keys() | actual.keys()):
+        if expected.get(key) != actual.get(key):
+            differences.append(f"HUC8 {key[0]}, COMID {key[1]}: expected label {expected.get(key)}, "
+                               f"got {actual.get(key)}")
+    return differences
+
+
+def check_golden_labels(path: str, labels: List[Tuple[str, str, str]]) -> List[str]:
+    """
+    Compare labels with the golden labels in path, writing them to path if it doesn't exist.
+
+    :return: Descriptions of differences, empty if labels are identical to the golden labels
+    """
+    if not os.path.exists(path):
+        write_golden_labels(path, labels)
+        return []
+    return compare_golden_labels(read_golden_labels(path), labels)
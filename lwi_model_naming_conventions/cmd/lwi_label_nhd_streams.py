@@ -1,22 +1,47 @@
 # Copyright (C) 2021-present State of Louisiana, Division of Administration, Office of Community Development.
 # All rights reserved. Licensed under the GPLv3 License. See LICENSE.txt in the project root for license information.
 
+import os
 import sys
-from typing import Tuple, List, Dict, Set, Callable
+import json
+import cProfile
+import contextlib
+from typing import Tuple, List, Dict, Set, Iterable, Iterator, Optional
 from collections import Counter, OrderedDict
 import sqlite3
 import csv
 import io
 import multiprocessing
 import argparse
+import itertools
+import shutil
+import tempfile
 
 import base32_crockford as b32
 
-FLOWLINE_COMID = 0
-FLOWLINE_REACHCODE = 1
-FLOWLINE_LEVEL = 2
-FLOWLINE_ORDER = 3
-FLOWLINE_DIVERGENCE = 4
+from lwi_model_naming_conventions.network import Flowline, FlowlineNetwork, RegionNetwork
+from lwi_model_naming_conventions.network_cache import NetworkCache, compile_network_cache
+from lwi_model_naming_conventions.shared_network import SharedNetworkCache
+from lwi_model_naming_conventions.hydroseq import HydroseqNetwork, find_root_flowlines_hydroseq, \
+    missing_hydroseq_columns
+from lwi_model_naming_conventions.sources import NetworkSource, get_network_source, init_worker_network_source
+from lwi_model_naming_conventions.scheduler import estimate_sizes, imap_scheduled, deal_batches
+from lwi_model_naming_conventions.manifest import network_digest, is_up_to_date, make_manifest_entry, \
+    load_manifest, save_manifest, manifest_key, file_digest
+from lwi_model_naming_conventions.sinks import OUTPUT_FIELDS, OUTPUT_RAW_LABEL, OUTPUT_SINKS, OutputSink, \
+    get_output_sinks, typed_rows
+from lwi_model_naming_conventions.label_index import DEFAULT_LABEL_INDEX, LabelIndex
+from lwi_model_naming_conventions.synthetic import generate_network, write_synthetic_data
+from lwi_model_naming_conventions.flowline_cache import DEFAULT_FLOWLINE_CACHE_SIZE
+from lwi_model_naming_conventions.database import connect_nhdplus, prepare_nhdplus
+from lwi_model_naming_conventions.extract import extract_nhdplus
+from lwi_model_naming_conventions.export import DEFAULT_LAYER, export_labeled_flowlines
+from lwi_model_naming_conventions.metrics import DEFAULT_METRICS_FILE, HUC8Metrics, stage, \
+    record_labeling_metrics, write_metrics
+from lwi_model_naming_conventions.pipeline import run_pipeline
+from lwi_model_naming_conventions.task_queue import DEFAULT_LEASE_SECONDS, DEFAULT_MAX_ATTEMPTS, DONE, FAILED, \
+    TASK_STATES, TaskQueue, default_worker_id, merge_results, run_worker, staging_format
+from lwi_model_naming_conventions.diff import CHANGE_FIELDS, diff_outputs, format_differences, has_differences
 
 MAIN_STEM_LABEL_BASE_STR = '0'
 MAIN_STEM_LABEL_BASE_INT = 0
@@ -35,283 +60,325 @@ MAX_LABEL_LEVEL = 6
 OUTPUT_PREFIX = 'output'
 
 
-class Flowline:
-    def __init__(self, comid, reachcode, stream_level, strahler_order, divergence, hack_order=None, label=''):
-        self.comid = comid
-        self.reachcode = reachcode
-        self.stream_level = stream_level
-        self.strahler_order = strahler_order
-        self.divergence = divergence
-        self.hack_order = hack_order
-        self.label = label
-
-    def __str__(self):
-        return f"Flowline(comid={self.comid}, reachcode={self.reachcode}, stream_level={self.stream_level}, " \
-               f"strahler_order={self.strahler_order}, divergence={self.divergence}, " \
-               f"hack_order={self.hack_order}, label={self.label})"
-
-    def __repr__(self):
-        return self.__str__()
-
-    def __eq__(self, o: object) -> bool:
-        if not isinstance(o, Flowline):
-            raise NotImplemented()
-        if self.comid != o.comid:
-            return False
-        if self.reachcode != o.reachcode:
-            return False
-        if self.stream_level != o.stream_level:
-            return False
-        if self.strahler_order != o.strahler_order:
-            return False
-        if self.divergence != o.divergence:
-            return False
-        if self.hack_order != o.hack_order:
-            return False
-        if self.label != o.label:
-            return False
-        return True
-
-    def __hash__(self) -> int:
-        return hash(self.comid) + hash(self.reachcode) + hash(self.stream_level) + hash(self.strahler_order) + \
-            hash(self.divergence) + hash(self.hack_order) + hash(self.label)
-
-
-def get_flowline(cur, comid: int):
-    cur.execute('select comid, reachcode, streamleve, streamorde, divergence from nhdflowline_network where comid=?',
-                (comid,))
-    f = cur.fetchone()
-    if f is None:
-        return f
-    return Flowline(comid=f[FLOWLINE_COMID], reachcode=f[FLOWLINE_REACHCODE], stream_level=f[FLOWLINE_LEVEL],
-                    strahler_order=f[FLOWLINE_ORDER], divergence=f[FLOWLINE_DIVERGENCE])
-
-
-def get_flowline_hr(cur, nhdplusid: float):
-    cur.execute(('select fl.nhdplusid, fl.reachcode, vaa.streamleve, vaa.streamorde, vaa.divergence '
-                 'from nhdflowline as fl, nhdplusflowlinevaa as vaa '
-                 'where fl.nhdplusid=? and fl.nhdplusid=vaa.nhdplusid'),
-                (nhdplusid,))
-    f = cur.fetchone()
-    if f is None:
-        return f
-    return Flowline(comid=f[FLOWLINE_COMID], reachcode=f[FLOWLINE_REACHCODE], stream_level=f[FLOWLINE_LEVEL],
-                    strahler_order=f[FLOWLINE_ORDER], divergence=f[FLOWLINE_DIVERGENCE])
-
-
-def get_headwater_reaches(flowline: sqlite3.Cursor, huc8: str) -> Callable[[None], List]:
-    def curried():
-        query = "select comid from nhdflowline_network where reachcode like '{huc8}%' and startflag=1 order by comid desc".format(
-            huc8=huc8)
-        flowline.execute(query)
-        return flowline.fetchall()
-    return curried
-
-
-def get_headwater_reaches_hr(flowline: sqlite3.Cursor, huc8: str) -> Callable[[None], List]:
-    def curried():
-        query = "select nhdplusid from nhdplusflowlinevaa where reachcode like '{huc8}%' and startflag=1".format(
-            huc8=huc8)
-        flowline.execute(query)
-        return flowline.fetchall()
-    return curried
-
-
-def get_downstream_flowlines(flowline, plusflow, comid: int):
-    downstream_flowlines = []
-    plusflow.execute('select tocomid from plusflow where fromcomid=? order by tocomid asc', (comid,))
-    for row in plusflow:
-        f = get_flowline(flowline, row[0])
-        if f:
-            downstream_flowlines.append(f)
-    return downstream_flowlines
-
-
-def get_downstream_flowlines_hr(nhdplushr, nhdplusid: float):
-    downstream_flowlines = []
-    nhdplushr.execute('select tonhdpid from nhdplusflow where fromnhdpid=?', (nhdplusid,))
-    for row in nhdplushr:
-        f = get_flowline_hr(nhdplushr, row[0])
-        if f:
-            downstream_flowlines.append(f)
-    return downstream_flowlines
-
-
-def get_upstream_flowlines(flowline, plusflow, comid: int):
-    upstream_flowlines = []
-    plusflow.execute('select fromcomid from plusflow where tocomid=? order by fromcomid desc', (comid,))
-    for row in plusflow:
-        f = get_flowline(flowline, row[0])
-        if f:
-            upstream_flowlines.append(f)
-    return upstream_flowlines
-
-
-def get_upstream_flowlines_hr(nhdplushr, nhdplusid: float):
-    upstream_flowlines = []
-    nhdplushr.execute('select fromnhdpid from nhdplusflow where tonhdpid=?', (nhdplusid,))
-    for row in nhdplushr:
-        f = get_flowline_hr(nhdplushr, row[0])
-        if f:
-            upstream_flowlines.append(f)
-    return upstream_flowlines
-
-
-def find_root_flowlines(flowline, plusflow, huc8: str, curr_flowline: Flowline,
-                        root_flowlines: set = set(), visited: set = set(), nhd_hr: bool = False) -> Flowline:
-    visited.add(curr_flowline)
-    # print("\tfind_root_flowline: {0}".format(curr_flowline))
-
-    if curr_flowline.stream_level == 1.0:
-        # Current flowline terminates on the coastline, add as a root flowline, don't search "downstream"
-        root_flowlines.add(curr_flowline)
-    else:
-        if nhd_hr:
-            downstream = get_downstream_flowlines_hr(flowline, curr_flowline.comid)
-        else:
-            downstream = get_downstream_flowlines(flowline, plusflow, curr_flowline.comid)
-        for d in downstream:
-            # print("\t\tdownstream: {0}".format(d))
-            if d.reachcode.startswith(huc8):
-                # Downstream flowline is in the same watershed, keep searching downstream...
-                if d not in visited:
-                    find_root_flowlines(flowline, plusflow, huc8, d, root_flowlines, visited, nhd_hr)
-            else:
-                # Downstream flowline is not in the same watershed, curr_flowline is a root flowline
-                # in the watershed.
-                root_flowlines.add(curr_flowline)
+def find_root_flowlines(network: FlowlineNetwork, huc8: str) -> Set[Flowline]:
+    """
+    Find root flowlines (i.e. watershed outlets) in a single set-based pass over the watershed's network.
+
+    Root flowlines are flowlines in the watershed that are reachable downstream from a headwater flowline and that
+    either terminate on the coastline (stream level 1), or flow into a flowline outside of the watershed. Rather than
+    searching downstream from each headwater flowline in turn, all headwater flowlines are searched from at once,
+    one frontier of flowlines at a time, so that shared downstream paths are only visited once.
+    """
+    store = network.store
+    stream_level = store.stream_level
+    in_huc8 = network.in_huc(huc8)
+    down_offsets, down_nodes = network.downstream_offsets, network.downstream_nodes
+
+    root_nodes = set()
+    visited = set(network.headwaters)
+    frontier = list(visited)
+    while frontier:
+        next_frontier = []
+        for n in frontier:
+            if stream_level[n] == 1:
+                # Flowline terminates on the coastline, it is a root flowline, don't search "downstream"
+                root_nodes.add(n)
+                continue
+            for d in down_nodes[down_offsets[n]:down_offsets[n + 1]]:
+                if not in_huc8[d]:
+                    # Downstream flowline is not in the same watershed, so this flowline is a root flowline
+                    root_nodes.add(n)
+                elif d not in visited:
+                    # Downstream flowline is in the same watershed, keep searching downstream...
+                    visited.add(d)
+                    next_frontier.append(d)
+        frontier = next_frontier
+
+    return {Flowline(store, n) for n in root_nodes}
+
+
+def find_region_root_flowlines(region: RegionNetwork):
+    """
+    Find the root flowlines of every HUC8 in region in a single pass over the region's network, setting
+    region.root_comids. The root flowlines of each HUC8 are those found by find_root_flowlines(): searches from
+    the headwater flowlines of each HUC8 stop at the HUC8's boundary.
+    """
+    store = region.network.store
+    stream_level = store.stream_level
+    huc8_of_node = {}
+    for huc8, nodes in region.huc8_nodes.items():
+        for n in nodes:
+            huc8_of_node[n] = huc8
+    down_offsets, down_nodes = region.network.downstream_offsets, region.network.downstream_nodes
+
+    root_nodes = {huc8: set() for huc8 in region.huc8_nodes}
+    visited = {n for n in region.network.headwaters if n in huc8_of_node}
+    frontier = list(visited)
+    while frontier:
+        next_frontier = []
+        for n in frontier:
+            huc8 = huc8_of_node[n]
+            if stream_level[n] == 1:
+                # Flowline terminates on the coastline, it is a root flowline
+                root_nodes[huc8].add(n)
+                continue
+            for d in down_nodes[down_offsets[n]:down_offsets[n + 1]]:
+                if huc8_of_node.get(d) != huc8:
+                    # Downstream flowline is not in the same watershed, so this flowline is a root flowline
+                    root_nodes[huc8].add(n)
+                elif d not in visited:
+                    visited.add(d)
+                    next_frontier.append(d)
+        frontier = next_frontier
+
+    region.root_comids = {huc8: [store.comid[n] for n in nodes] for huc8, nodes in root_nodes.items()}
+
+
+def sort_root_flowlines(root_flowlines: Iterable[Flowline]) -> List[Flowline]:
+    # Sort root flowlines by descending reachcode, descending strahler order, ascending stream level to ensure
+    # consistent traversal across invocations starting with the most downstream flowlines (i.e. highest reachcode).
+    # Also sort by divergence to make sure the first flowline isn't a minor flowpath of a divergence.
+    # Doesn't seem to make sense to sort NHDPlusHR flow lines by NHDPlusID as it doesn't seem to vary predictably
+    # downstream, but flowlines are first sorted by comid to break ties between flowlines sharing a reachcode
+    # independently of set iteration order.
+    root_flowlines = sorted(root_flowlines, key=lambda f: f.comid)
+    root_flowlines = sorted(root_flowlines, key=lambda f: f.reachcode, reverse=True)
+    root_flowlines = sorted(root_flowlines, key=lambda f: f.strahler_order, reverse=True)
+    root_flowlines = sorted(root_flowlines, key=lambda f: f.stream_level)
+    root_flowlines = sorted(root_flowlines, key=lambda f: f.divergence)
+    return root_flowlines
 
 
-def _add_flowline_to_order_list(flowline_orders: Dict[int, Set[Flowline]], order, flowline):
+def _add_flowline_to_order_list(flowline_orders: Dict[int, List[Flowline]], order, flowline):
+    # Each flowline is only processed once, so flowlines are kept in a list (in the order in which they are visited)
+    # rather than a set, the iteration order of which would depend on how flowlines are numbered in the network.
     flowlines_for_order = None
     try:
         flowlines_for_order = flowline_orders[order]
     except KeyError:
-        flowlines_for_order = set()
+        flowlines_for_order = []
         flowline_orders[order] = flowlines_for_order
-    flowlines_for_order.add(flowline)
+    flowlines_for_order.append(flowline)
 
 
 def _int_to_hex_str(num: int) -> str:
     return "{0:#0x}".format(num)[2:].rjust(2, '0')
 
 
-def _pad_stream_label(label_in, hierarchy_levels, hierarchy_separator='-', empty_level_indicator='0',
-                      base32: bool = False):
-    segments = label_in.split(hierarchy_separator)
-    padded_buff = io.StringIO()
-    # Create compact label
-    for i, s in enumerate(segments):
-        if i == 0:
-            if base32:
-                # Convert hexadecimal to base32 (this is a hack, we should go back to just storing decimal not hex)
-                label = b32.encode(int(s, base=16)).rjust(2, '0')
-            else:
-                # Emit name as hexadecimal
-                label = s
-            padded_buff.write(label)
+# Stream labels are kept as tuples of integers, one for each LEVEL_SEP-delimited level of the label hierarchy, and
+# are only converted to strings once all streams in a watershed have been labeled. The first level of a label, its
+# stem, is the zero-padded hexadecimal main stem number, followed by the zero-padded hexadecimal first order number
+# (for streams of order 1 or greater). So that a stem is equal to another exactly when their hexadecimal strings
+# are equal, it is stored as the integer value of its hexadecimal digits preceded by a 1 digit, e.g. stem '0a05'
+# is stored as 0x10a05. Subsequent levels are plain integers.
+#
+# order_label_count counts the labels issued under each parent: the main stem count is keyed by (), first order
+# counts by (main stem,), and counts at subsequent levels by the parent label followed by 0.
+MAIN_STEM_LABEL_BASE = (int('1' + MAIN_STEM_LABEL_BASE_STR, 16),)
+MAIN_STEM_COUNT_KEY = ()
+
+# Lookup tables for encoding levels of a label after the stem
+_HEX_LEVEL_LABELS = [_int_to_hex_str(i) for i in range(MAX_LEVEL_LABEL_B32 + 1)]
+_B32_LEVEL_LABELS = [b32.encode(i) for i in range(MAX_LEVEL_LABEL_B32 + 1)]
+
+
+def _stem_num_digits(stem: int) -> int:
+    return (stem.bit_length() - 1) >> 2
+
+
+def _append_hex_to_stem(stem: int, num: int) -> int:
+    # Zero-padded to at least two digits, as in _int_to_hex_str()
+    num_digits = max(2, (num.bit_length() + 3) >> 2)
+    return (stem << (num_digits << 2)) | num
+
+
+def _stem_hex_str(stem: int) -> str:
+    return "{0:x}".format(stem)[1:]
+
+
+def _stem_value(stem: int) -> int:
+    return stem ^ (1 << (_stem_num_digits(stem) << 2))
+
+
+def _stem_main_stem(stem: int) -> int:
+    """
+    :return: Stem holding the first two hexadecimal digits of stem, which are the main stem number unless there are
+        more than 255 main stems.
+    """
+    return stem >> (max(0, _stem_num_digits(stem) - 2) << 2)
+
+
+def _format_raw_stream_label(label: Tuple[int, ...]) -> str:
+    """
+    :return: The delimited form of label, e.g. '0a05-3-12'
+    """
+    return LEVEL_SEP.join([_stem_hex_str(label[0]), *[str(n) for n in label[1:]]])
+
+
+def _parse_raw_stream_label(raw_label: str) -> Tuple[int, ...]:
+    """
+    :return: The label whose delimited form (see _format_raw_stream_label()) is raw_label
+    """
+    stem, *levels = raw_label.split(LEVEL_SEP)
+    return (int('1' + stem, 16), *[int(n) for n in levels])
+
+
+def _check_label_limits(label: Tuple[int, ...], base32: bool = False):
+    """
+    Check that label could have been assigned with the encoding, which limits the number of streams at each level
+    (e.g. labels assigned for base32 may number more streams than hexadecimal allows).
+
+    :raises ValueError: If it could not
+    """
+    max_level_label = MAX_LEVEL_LABEL_B32 if base32 else MAX_LEVEL_LABEL
+    # Main stem and first order numbers of at most 255 are two hexadecimal digits each
+    if not base32 and _stem_num_digits(label[0]) not in (2, 4):
+        raise ValueError(f"Stem {_stem_hex_str(label[0])} exceeds max main stem label {MAX_MAIN_STEM_NUM} or max "
+                         f"first order label {MAX_FIRST_ORDER_NUM}.")
+    for n in label[1:]:
+        if n > max_level_label:
+            raise ValueError(f"Max nth order label {max_level_label} exceeded.")
+
+
+def _pad_stream_label(label_in: Tuple[int, ...], hierarchy_levels, empty_level_indicator='0',
+                      base32: bool = False, stem_labels: Dict[int, str] = None) -> str:
+    """
+    Create compact label, without delimiters, from label_in.
+
+    :param stem_labels: Cache of encoded stems, which are shared by many labels
+    """
+    stem = label_in[0]
+    label = None
+    if stem_labels is not None:
+        label = stem_labels.get(stem)
+    if label is None:
+        if base32:
+            # Convert hexadecimal to base32 (this is a hack, we should go back to just storing decimal not hex)
+            label = b32.encode(_stem_value(stem)).rjust(2, '0')
         else:
-            if base32:
-                label = b32.encode(s)
-            else:
-                # Convert 2nd and higher orders to hexadecimal here
-                label = _int_to_hex_str(int(s))
-            padded_buff.write(label)
-    padded_label = padded_buff.getvalue()
+            # Emit name as hexadecimal
+            label = _stem_hex_str(stem)
+        if stem_labels is not None:
+            stem_labels[stem] = label
+    if base32:
+        level_labels, encode_level = _B32_LEVEL_LABELS, b32.encode
+    else:
+        # Convert 2nd and higher orders to hexadecimal here
+        level_labels, encode_level = _HEX_LEVEL_LABELS, _int_to_hex_str
+    segments = [label]
+    for n in label_in[1:]:
+        segments.append(level_labels[n] if n < len(level_labels) else encode_level(n))
+    padded_label = ''.join(segments)
     # Fill missing hierarchy levels with 0
-    padded_label = padded_label.ljust(MAX_LABEL_LEN, '0')
+    padded_label = padded_label.ljust(MAX_LABEL_LEN, empty_level_indicator)
     return padded_label
 
 
-def _process_stream_segment(flowline_orders: Dict[int, Set[Flowline]], order:int, curr_flowline: Flowline, label:str):
+def _pad_stream_labels(labels: Iterable[Tuple[int, ...]], base32: bool = False) -> List[Tuple[Tuple[int, ...], str]]:
+    """
+    Convert labels to compact form in one pass.
+
+    :return: List of (label, compact label), sorted by the delimited form of label
+    """
+    stem_labels = {}
+    return [(label, _pad_stream_label(label, MAX_LABEL_LEVEL, base32=base32, stem_labels=stem_labels))
+            for label in sorted(labels, key=_format_raw_stream_label)]
+
+
+def _process_stream_segment(flowline_orders: Dict[int, List[Flowline]], order: int, curr_flowline: Flowline,
+                            label: Tuple[int, ...]):
     curr_flowline.label = label
     curr_flowline.hack_order = order
     _add_flowline_to_order_list(flowline_orders, order, curr_flowline)
 
 
-def _get_next_mainstem_label(order_label_count, base32: bool = False) -> str:
+def _get_next_mainstem_label(order_label_count, base32: bool = False) -> Tuple[int, ...]:
     if base32:
         max_main_stem = MAX_MAIN_STEM_NUM_B32
     else:
         max_main_stem = MAX_MAIN_STEM_NUM
-    assert order_label_count[MAIN_STEM_LABEL_BASE_STR] < max_main_stem,\
+    assert order_label_count[MAIN_STEM_COUNT_KEY] < max_main_stem,\
         f"Max main stem label {max_main_stem} exceeded."
-    order_label_count[MAIN_STEM_LABEL_BASE_STR] += 1
-    # Return as zero-padded hexadecimal
-    return "{0:#0x}".format(order_label_count[MAIN_STEM_LABEL_BASE_STR])[2:].rjust(2, '0')
+    order_label_count[MAIN_STEM_COUNT_KEY] += 1
+    # Stem of zero-padded hexadecimal
+    return _append_hex_to_stem(1, order_label_count[MAIN_STEM_COUNT_KEY]),
 
 
-def _get_next_first_order_label(order_label_count, zeroth_order: str, base32: bool = False) -> str:
+def _get_next_first_order_label(order_label_count, zeroth_order: int, base32: bool = False) -> Tuple[int, ...]:
     if base32:
         max_first_order = MAX_FIRST_ORDER_NUM_B32
     else:
         max_first_order = MAX_FIRST_ORDER_NUM
-    assert order_label_count[zeroth_order] < max_first_order,\
+    key = (zeroth_order,)
+    assert order_label_count[key] < max_first_order,\
         f"Max first order label {max_first_order} exceeded."
-    order_label_count[zeroth_order] += 1
-    # Convert to zero-padded hexadecimal
-    first_order = "{0:#0x}".format(order_label_count[zeroth_order])[2:].rjust(2, '0')
-    return "{0}{1}".format(zeroth_order, first_order)
+    order_label_count[key] += 1
+    # Append zero-padded hexadecimal to stem
+    return _append_hex_to_stem(zeroth_order, order_label_count[key]),
 
 
-def _get_next_nth_order_label(order_label_count, n_plus_oneth_order: str, base32: bool = False) -> str:
+def _get_next_nth_order_label(order_label_count, n_plus_oneth_order: Tuple[int, ...],
+                              base32: bool = False) -> Tuple[int, ...]:
     if base32:
         max_nth_order = MAX_LEVEL_LABEL_B32
     else:
         max_nth_order = MAX_LEVEL_LABEL
 
-    components = n_plus_oneth_order.split(LEVEL_SEP)
-    nth_level_stub = LEVEL_SEP.join(components[:-1]) + LEVEL_SEP
-    level_stream_count_label = nth_level_stub + '0'
+    nth_level_stub = n_plus_oneth_order[:-1]
+    level_stream_count_label = nth_level_stub + (0,)
 
     assert order_label_count[level_stream_count_label] < max_nth_order, \
         f"Max first order label {max_nth_order} exceeded."
 
     order_label_count[level_stream_count_label] += 1
-    return nth_level_stub + str(order_label_count[level_stream_count_label])
+    return nth_level_stub + (order_label_count[level_stream_count_label],)
 
 
-def _get_next_label_for_next_level(new_order: int, curr_level_label: str, order_label_count: Counter = Counter(),
-                                   base32: bool = False) -> str:
+def _get_next_label_for_next_level(new_order: int, curr_level_label: Tuple[int, ...],
+                                   order_label_count: Counter = None, base32: bool = False) -> Tuple[int, ...]:
+    if order_label_count is None:
+        order_label_count = Counter()
     next_level_label = None
     if new_order == 1:
-        next_level_label = _get_next_first_order_label(order_label_count, curr_level_label, base32)
+        next_level_label = _get_next_first_order_label(order_label_count, curr_level_label[0], base32)
     elif new_order > 1:
         # Only add a level to the label hierarchy if new_order is 2nd order tributary or greater
-        level_stream_count_label = curr_level_label + LEVEL_SEP + '0'
+        level_stream_count_label = curr_level_label + (0,)
         order_label_count[level_stream_count_label] += 1
-        next_level_label = curr_level_label + LEVEL_SEP + str(order_label_count[level_stream_count_label])
+        next_level_label = curr_level_label + (order_label_count[level_stream_count_label],)
     return next_level_label
 
 
-def _get_next_label_for_prev_level(new_order: int, curr_level_label: str, order_label_count: Counter = Counter(),
-                                   base32: bool = False) -> str:
+def _get_next_label_for_prev_level(new_order: int, curr_level_label: Tuple[int, ...],
+                                   order_label_count: Counter = None, base32: bool = False) -> Tuple[int, ...]:
     assert new_order >= 0, f"_get_next_label_for_prev_level() new_ordder should be > 0, but was {new_order}."
-    # print("_determine_label_for_prev_level: curr_level_label: {0}, new_order: {1}".format(curr_level_label, new_order))
+    if order_label_count is None:
+        order_label_count = Counter()
     prev_level_label = None
     if new_order == 0:
         prev_level_label = _get_next_mainstem_label(order_label_count, base32)
-        # print(f"\tprev_level_label: {prev_level_label}")
     elif new_order == 1:
-        prev_level_label = _get_next_first_order_label(order_label_count, curr_level_label[0:2], base32)
+        prev_level_label = _get_next_first_order_label(order_label_count, _stem_main_stem(curr_level_label[0]),
+                                                       base32)
     else:
         # new_order > 1
         prev_level_label = _get_next_nth_order_label(order_label_count, curr_level_label, base32)
 
-    # print("\tprev_level_label: {0}".format(prev_level_label))
     return prev_level_label
 
 
-def _get_next_label_for_curr_level(order: int, curr_level_label: str, order_label_count: Counter = Counter(),
-                                   base32: bool = False) -> str:
+def _get_next_label_for_curr_level(order: int, curr_level_label: Tuple[int, ...],
+                                   order_label_count: Counter = None, base32: bool = False) -> Tuple[int, ...]:
 
     assert order >= 0, f"_get_next_label_for_prev_level() new_ordder should be > 0, but was {order}."
+    if order_label_count is None:
+        order_label_count = Counter()
 
     new_label = None
     if order == 0:
         new_label = _get_next_mainstem_label(order_label_count, base32)
     elif order == 1:
-        new_label = _get_next_first_order_label(order_label_count, curr_level_label[0:2], base32)
+        new_label = _get_next_first_order_label(order_label_count, _stem_main_stem(curr_level_label[0]), base32)
     else:
         # order > 1
         new_label = _get_next_nth_order_label(order_label_count, curr_level_label, base32)
@@ -319,140 +386,437 @@ def _get_next_label_for_curr_level(order: int, curr_level_label: str, order_labe
     return new_label
 
 
-def assign_stream_segment_order(flowline, plusflow, huc8: str,
-                                curr_flowline: Flowline, flowline_orders: Dict[int, Set[Flowline]],
-                                order=0, label=MAIN_STEM_LABEL_BASE_STR,
-                                order_label_count: Counter = Counter(), visit_count: Counter = Counter(), itr_meta={},
-                                nhd_hr: bool = False, base32: bool = False):
-    # print("assign_stream_segment_order: curr_flowline: {0}".format(curr_flowline))
-    if visit_count[curr_flowline.comid] > 0:
-        # Don't process a flowline more than once
-        return
-    else:
-        visit_count[curr_flowline.comid] += 1
+def _get_upstream_order_and_label(huc8: str, curr_flowline: Flowline, u: Flowline, order: int,
+                                  label: Tuple[int, ...], order_label_count: Counter,
+                                  base32: bool = False) -> Tuple[int, Tuple[int, ...]]:
+    """
+    Determine the order and label to carry from curr_flowline to the "upstream" flowline u.
 
-    itr_meta['max_order'] = max(itr_meta.get('max_order', 0), order)
-
-    # Record the current flowline
-    _process_stream_segment(flowline_orders, order, curr_flowline, label)
-    # Search upstream for additional reaches of this branch, or additional tributaries
-    if nhd_hr:
-        upstream = get_upstream_flowlines_hr(flowline, curr_flowline.comid)
+    :return: Tuple of (order, label) for u, or None if the search should not continue upstream to u.
+    """
+    if not u.reachcode.startswith(huc8):
+        # The upstream segment is not in this watershed, skip this segment.
+        return None
     else:
-        upstream = get_upstream_flowlines(flowline, plusflow, curr_flowline.comid)
-    for u in upstream:
-        # print("\tupstream: {0}".format(u))
-        if not u.reachcode.startswith(huc8):
-            # The upstream segment is not in this watershed, skip this segment.
-            continue
+        # Upstream flowline is in this watershed
+        if u.strahler_order == curr_flowline.strahler_order:
+            # Upstream flowline is of the same order as current flowline, add to list of flowlines for this
+            # order
+            if curr_flowline.divergence > 1:
+                if u.divergence != curr_flowline.divergence:
+                    # The current flowline is a minor flowpath of a divergence, but the "upstream" flowline is either
+                    # not on a divergence (divergence=0), or is the major flowpath of a divergence (divergence=1).
+                    # In these cases, we don't want to recurse upstream from the minor flowpath as this will result
+                    # in a spurious level in the hierarchy being created.
+                    # print("assign_stream_segment_order(): curr_flowline.divergence == 2 and u.divergence != curr_flowline.divergence")
+                    return None
+                if u.stream_level < curr_flowline.stream_level:
+                    # The current flowline is a minor flowpath of a divergence and has a stream level higher
+                    # than the "upstream" flowline (this can happen in cases of compound divergent flow).
+                    # this means that the upstream flowline is closer to being on the mainstem than the current
+                    # flowline, so we don't want to propagate upstream from here as despite having the same Stahler
+                    # orders, the current divergence flowline is further derived from the main stem than the
+                    # upstream flowline (we want the upstream flowline to be named named from another reach
+                    # downstream of it that is closer to being on the main stem).
+                    return None
+            else:
+                if u.divergence > 1:
+                    # Upstream flowline is a minor flowpath of a divergence, create a new label at the current
+                    # level in the hierarchy instead of carrying the current label upstream. This will avoid
+                    # there being two parallel segments with the same name, which can be problematic for models
+                    # such as HEC-RAS.
+                    new_label = _get_next_label_for_curr_level(order, label, order_label_count, base32)
+                else:
+                    # Proceed upstream, using the same label as we are still at the same level of the hierarchy
+                    # new_order = order
+                    new_label = label
+                return order, new_label
         else:
-            # Upstream flowline is in this watershed
-            if u.strahler_order == curr_flowline.strahler_order:
-                # Upstream flowline is of the same order as current flowline, add to list of flowlines for this
-                # order
-                if curr_flowline.divergence > 1:
-                    if u.divergence != curr_flowline.divergence:
-                        # The current flowline is a minor flowpath of a divergence, but the "upstream" flowline is either
-                        # not on a divergence (divergence=0), or is the major flowpath of a divergence (divergence=1).
-                        # In these cases, we don't want to recurse upstream from the minor flowpath as this will result
-                        # in a spurious level in the hierarchy being created.
-                        # print("assign_stream_segment_order(): curr_flowline.divergence == 2 and u.divergence != curr_flowline.divergence")
-                        continue
-                    if u.stream_level < curr_flowline.stream_level:
-                        # The current flowline is a minor flowpath of a divergence and has a stream level higher
-                        # than the "upstream" flowline (this can happen in cases of compound divergent flow).
-                        # this means that the upstream flowline is closer to being on the mainstem than the current
-                        # flowline, so we don't want to propagate upstream from here as despite having the same Stahler
-                        # orders, the current divergence flowline is further derived from the main stem than the
-                        # upstream flowline (we want the upstream flowline to be named named from another reach
-                        # downstream of it that is closer to being on the main stem).
-                        continue
+            # Upstream flowline is not of the same order as the current flowline
+            new_order = None
+            new_label = None
+            if u.strahler_order > curr_flowline.strahler_order:
+                # "Upstream" flowline has a higher Strahler order than the current flowline.
+                # This can happen in areas with divergent flow. Go down an order and level in the label
+                # hierarchy
+                if order == 0:
+                    new_order = order
+                    new_label = label
                 else:
-                    if u.divergence > 1:
-                        # Upstream flowline is a minor flowpath of a divergence, create a new label at the current
-                        # level in the hierarchy instead of carrying the current label upstream. This will avoid
-                        # there being two parallel segments with the same name, which can be problematic for models
-                        # such as HEC-RAS.
-                        new_label = _get_next_label_for_curr_level(order, label, order_label_count, base32)
-                    else:
-                        # Proceed upstream, using the same label as we are still at the same level of the hierarchy
-                        # new_order = order
-                        new_label = label
-                    assign_stream_segment_order(flowline, plusflow, huc8, u, flowline_orders,
-                                                order=order, label=new_label,
-                                                order_label_count=order_label_count, visit_count=visit_count,
-                                                itr_meta=itr_meta,
-                                                nhd_hr=nhd_hr, base32=base32)
+                    new_order = order - 1
+                    new_label = _get_next_label_for_prev_level(new_order, label, order_label_count, base32)
             else:
-                # Upstream flowline is not of the same order as the current flowline
-                new_order = None
-                new_label = None
-                if u.strahler_order > curr_flowline.strahler_order:
-                    # "Upstream" flowline has a higher Strahler order than the current flowline.
-                    # This can happen in areas with divergent flow. Go down an order and level in the label
-                    # hierarchy
-                    if order == 0:
-                        new_order = order
-                        new_label = label
-                    else:
-                        new_order = order - 1
-                        new_label = _get_next_label_for_prev_level(new_order, label, order_label_count, base32)
-                else:
-                    # Upstream flowline has a lower Strahler order. Go up order and level in the label hierarchy
-                    new_order = order + 1
-                    try:
-                        new_label = _get_next_label_for_next_level(new_order, label, order_label_count, base32)
-                    except Exception as e:
-                        mesg = f"\n\n_determine_label_for_next_level threw Exception: {e} for HUC8 {huc8}, " \
-                               f"curr_flowline: {curr_flowline}, order: {order}\n\n"
-                        sys.exit(mesg)
-                # Continue search on the "upstream" (which may be a divergence) flowline
-                assign_stream_segment_order(flowline, plusflow, huc8, u, flowline_orders,
-                                            order=new_order, label=new_label,
-                                            order_label_count=order_label_count, visit_count=visit_count,
-                                            itr_meta=itr_meta,
-                                            nhd_hr=nhd_hr, base32=base32)
-
-
-def label_streams_for_huc8(flowline, plusflow, headwater_reaches, huc8, ws_code, log,
-                           nhd_hr: bool = False, base32: bool = False) -> OrderedDict:
-    flowlines_by_stream_id = OrderedDict()
+                # Upstream flowline has a lower Strahler order. Go up order and level in the label hierarchy
+                new_order = order + 1
+                try:
+                    new_label = _get_next_label_for_next_level(new_order, label, order_label_count, base32)
+                except Exception as e:
+                    mesg = f"\n\n_determine_label_for_next_level threw Exception: {e} for HUC8 {huc8}, " \
+                           f"curr_flowline: {curr_flowline}, order: {order}\n\n"
+                    sys.exit(mesg)
+            # Continue search on the "upstream" (which may be a divergence) flowline
+            return new_order, new_label
+    # The current flowline is a minor flowpath of a divergence, as is the "upstream" flowline of the same order,
+    # don't continue upstream
+    return None
+
+
+def assign_stream_segment_order(network: FlowlineNetwork, huc8: str,
+                                root_flowline: Flowline, flowline_orders: Dict[int, List[Flowline]],
+                                order=0, label=MAIN_STEM_LABEL_BASE,
+                                order_label_count: Counter = None, visit_count: Counter = None, itr_meta: dict = None,
+                                base32: bool = False):
+    """
+    Assign orders and labels to root_flowline and the flowlines upstream of it in the watershed.
+
+    Flowlines are visited depth-first using an explicit stack of upstream iterators rather than recursion. Each
+    upstream flowline's label is determined only once the subtrees of its preceding siblings have been labeled,
+    as it was when this search was recursive, so labels (which depend on order_label_count) and visit order are
+    unchanged.
+
+    :param order_label_count: Counter of labels issued at each level of the label hierarchy, shared by all root
+        flowlines in the watershed. A new Counter is created if None.
+    :param visit_count: Counter of visits to each flowline node, shared by all root flowlines in the watershed.
+        A new Counter is created if None.
+    :param itr_meta: Dictionary of iteration metadata ('max_order', and 'max_depth', the maximum depth of the
+        stack). A new dict is created if None.
+    """
+    if order_label_count is None:
+        order_label_count = Counter()
+    if visit_count is None:
+        visit_count = Counter()
+    if itr_meta is None:
+        itr_meta = {}
+
+    stack = []
+    pending = (root_flowline, order, label)
+    while True:
+        if pending is not None:
+            curr_flowline, order, label = pending
+            pending = None
+            # print("assign_stream_segment_order: curr_flowline: {0}".format(curr_flowline))
+            # Don't process a flowline more than once
+            if visit_count[curr_flowline.node] == 0:
+                visit_count[curr_flowline.node] += 1
+                itr_meta['max_order'] = max(itr_meta.get('max_order', 0), order)
+                # Record the current flowline
+                _process_stream_segment(flowline_orders, order, curr_flowline, label)
+                # Search upstream for additional reaches of this branch, or additional tributaries
+                stack.append((curr_flowline, order, label,
+                              iter(network.get_upstream_flowlines(curr_flowline.node))))
+                itr_meta['max_depth'] = max(itr_meta.get('max_depth', 0), len(stack))
+        if not stack:
+            break
+        curr_flowline, order, label, upstream = stack[-1]
+        u = next(upstream, None)
+        if u is None:
+            stack.pop()
+            continue
+        # print("\tupstream: {0}".format(u))
+        order_and_label = _get_upstream_order_and_label(huc8, curr_flowline, u, order, label,
+                                                        order_label_count, base32)
+        if order_and_label is not None:
+            pending = (u, *order_and_label)
 
-    # Find watershed outlets (i.e. root flowlines)
-    root_flowlines = set()
-    for i, feat in enumerate(headwater_reaches(), 1):
-        start_comid = feat[0]
-        if nhd_hr:
-            start_flowline = get_flowline_hr(flowline, start_comid)
-        else:
-            start_flowline = get_flowline(flowline, start_comid)
-        # print("Starting flowline {0} has comid: {1}".format(i, start_flowline.comid))
-        find_root_flowlines(flowline, plusflow, huc8, start_flowline, root_flowlines, nhd_hr=nhd_hr)
-    # print("Root flowlines for HUC8 '{0}' are: {1}".format(huc8, root_flowlines))
-    # Label streams in watershed
+
+def assign_stream_labels(network: FlowlineNetwork, huc8: str, root_flowlines: List[Flowline],
+                         base32: bool = False) -> Tuple[Dict[int, List[Flowline]], Counter, dict]:
+    """
+    Assign orders and labels to the flowlines upstream of each of root_flowlines, in turn.
+
+    :return: Tuple of (flowlines of each order, counts of labels issued, iteration metadata)
+    """
     stream_orders = {}
     order_label_count = Counter()
+    visit_count = Counter()
     iteration_metadata = {}
-    # Sort root flowlines by descending reachcode, descending strahler order, ascending stream level to ensure
-    # consistent traversal across invocations starting with the most downstream flowlines (i.e. highest reachcode).
-    # Also sort by divergence to make sure the first flowline isn't a minor flowpath of a divergence.
-    # Doesn't seem to make sense to sort NHDPlusHR flow lines by NHDPlusID as it doesn't seem to vary predictably
-    # downstream
-    root_flowlines = sorted(root_flowlines, key=lambda f: f.reachcode, reverse=True)
-    root_flowlines = sorted(root_flowlines, key=lambda f: f.strahler_order, reverse=True)
-    root_flowlines = sorted(root_flowlines, key=lambda f: f.stream_level)
-    root_flowlines = sorted(root_flowlines, key=lambda f: f.divergence)
-    log.write(f"DEBUG: len(root_flowlines): {len(root_flowlines)}\n")
     for root_flowline in root_flowlines:
-        assign_stream_segment_order(flowline, plusflow, huc8, root_flowline, stream_orders,
+        assign_stream_segment_order(network, huc8, root_flowline, stream_orders,
                                     label=_get_next_mainstem_label(order_label_count, base32),
-                                    order_label_count=order_label_count, itr_meta=iteration_metadata,
-                                    nhd_hr=nhd_hr, base32=base32)
-
-    log.write(f"Statistics for Watershed {ws_code}, HUC8 '{huc8}'...\n")
+                                    order_label_count=order_label_count, visit_count=visit_count,
+                                    itr_meta=iteration_metadata, base32=base32)
+    return stream_orders, order_label_count, iteration_metadata
+
+
+# Watersheds with fewer flowlines are labeled serially, as starting a pool would take longer than labeling them
+MIN_PARALLEL_LABELING_FLOWLINES = 20000
+# Merging the labels of subtrees labeled in parallel takes about two thirds of the time of labeling serially on the
+# synthetic benchmark, so watersheds are labeled serially on fewer processes (or cores), or if the largest group of
+# their root flowlines (see group_root_flowlines()) holds more than this share of their flowlines.
+MIN_PARALLEL_LABELING_WORKERS = 8
+MAX_PARALLEL_LABELING_GROUP_SHARE = 0.1
+
+# Network being labeled by a subtree labeling worker, see _init_subtree_worker()
+_subtree_labeling: Tuple[FlowlineNetwork, str, bool] = None
+
+
+class _TouchedCounter(Counter):
+    """
+    Counter recording the keys set since touched was last cleared, in the order they were first set, along with their
+    counts before they were first set.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.touched = {}
+
+    def __setitem__(self, key, value):
+        if key not in self.touched:
+            self.touched[key] = self[key]
+        super().__setitem__(key, value)
+
+
+def group_root_flowlines(network: FlowlineNetwork, huc8: str,
+                         root_flowlines: List[Flowline]) -> Tuple[List[List[int]], List[int]]:
+    """
+    Group root flowlines whose subtrees may share flowlines, i.e. that have a flowline of the watershed upstream of
+    more than one of them: root flowlines nested on the same main stem (e.g. the many stream level 1 root flowlines
+    of a coast), or joined by a divergence. Subtrees of root flowlines in different groups never share flowlines.
+
+    :return: Tuple of (indices of the root flowlines of each group, in ascending order; number of flowlines upstream
+        of the root flowlines of each group)
+    """
+    in_huc8 = network.in_huc(huc8)
+    offsets, upstream_nodes = network.upstream_offsets, network.upstream_nodes
+    # Root flowline that first reached each flowline, and the parent of each root flowline in a union-find forest
+    reached_by = [-1] * len(network)
+    parent = list(range(len(root_flowlines)))
+    sizes = [0] * len(root_flowlines)
+
+    def find(i: int) -> int:
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for i, root_flowline in enumerate(root_flowlines):
+        stack = [root_flowline.node]
+        while stack:
+            node = stack.pop()
+            if reached_by[node] >= 0:
+                a, b = find(reached_by[node]), find(i)
+                if a != b:
+                    parent[max(a, b)] = min(a, b)
+                continue
+            reached_by[node] = i
+            sizes[i] += 1
+            stack.extend(u for u in upstream_nodes[offsets[node]:offsets[node + 1]] if in_huc8[u])
+
+    groups = {}
+    for i in range(len(root_flowlines)):
+        groups.setdefault(find(i), []).append(i)
+    return list(groups.values()), [sum(sizes[i] for i in group) for group in groups.values()]
+
+
+def _init_subtree_worker(network: FlowlineNetwork, huc8: str, base32: bool):
+    global _subtree_labeling
+    _subtree_labeling = (network, huc8, base32)
+
+
+def _label_root_group(task: Tuple[int, List[Tuple[int, int, int]]]):
+    """
+    Label the subtrees of a group of root flowlines in turn, as if no other root flowlines of the watershed issued
+    labels but main stem labels (see assign_stream_labels_parallel()).
+
+    :param task: Tuple of (group, list of (i, node, main stem count before the i'th root flowline) of its root
+        flowlines, in order)
+    :return: Tuple of (group, None if a label limit was exceeded, else a list of (i, number of main stem labels issued
+        besides that of the root flowline, (node, label) of the flowlines of each order in the order they were
+        visited, (key, count before, count after) of the label counts set in the order they were first set,
+        iteration metadata) of each root flowline, the error if a label limit was exceeded)
+    """
+    group, roots = task
+    network, huc8, base32 = _subtree_labeling
+    order_label_count = _TouchedCounter()
+    visit_count = Counter()
+    results = []
+    try:
+        for i, root_node, main_stem_count in roots:
+            order_label_count[MAIN_STEM_COUNT_KEY] = main_stem_count
+            order_label_count.touched.clear()
+            stream_orders = {}
+            itr_meta = {}
+            assign_stream_segment_order(network, huc8, Flowline(network.store, root_node), stream_orders,
+                                        label=_get_next_mainstem_label(order_label_count, base32),
+                                        order_label_count=order_label_count, visit_count=visit_count,
+                                        itr_meta=itr_meta, base32=base32)
+            visits = {order: [(f.node, f.label) for f in flowlines] for order, flowlines in stream_orders.items()}
+            label_counts = [(k, before, order_label_count[k]) for k, before in order_label_count.touched.items()
+                            if k != MAIN_STEM_COUNT_KEY]
+            results.append((i, order_label_count[MAIN_STEM_COUNT_KEY] - main_stem_count - 1, visits, label_counts,
+                            itr_meta))
+    except AssertionError as e:
+        # A label limit exceeded with the main stem numbers and label counts of the group alone is exceeded with those
+        # of the watershed too. The watershed is labeled serially instead, to fail as it does serially.
+        return group, None, str(e)
+    return group, results, None
+
+
+def _main_stem_digits(num: int) -> int:
+    # Digits of main stem number num in a stem, see _append_hex_to_stem()
+    return max(2, (num.bit_length() + 3) >> 2)
+
+
+def _renumber_main_stems(result, offset: int, main_stem_count: int):
+    """
+    Renumber the main stems of a root flowline's subtree labeled with main stem numbers offset less than its own, by
+    adding offset to the main stem number of each label and label count.
+
+    :param result: Result of labeling the subtree (see _label_root_group())
+    :param main_stem_count: Main stem count before the root flowline it was labeled with
+    :return: result with renumbered labels, or None if its labels can't be renumbered: if its main stem numbers
+        don't all have as many digits as the renumbered, or it has first order labels numbered by the first two
+        digits of its main stems (see _stem_main_stem()), which are not its main stems
+    """
+    i, extra_main_stems, visits, label_counts, itr_meta = result
+    first, last = main_stem_count + 1, main_stem_count + 1 + extra_main_stems
+    digits = _main_stem_digits(first)
+    if any(_main_stem_digits(n) != digits for n in (last, first + offset, last + offset)):
+        return None
+    main_stem_bit = 1 << (digits << 2)
+    stems = {}
+
+    def renumber(stem: int) -> Optional[int]:
+        try:
+            return stems[stem]
+        except KeyError:
+            pass
+        renumbered = None
+        shift = (_stem_num_digits(stem) - digits) << 2
+        if shift >= 0 and first <= (stem >> shift) ^ main_stem_bit <= last:
+            main_stem = (stem >> shift) ^ main_stem_bit
+            renumbered = ((main_stem_bit | (main_stem + offset)) << shift) | (stem & ((1 << shift) - 1))
+        stems[stem] = renumbered
+        return renumbered
+
+    renumbered_counts = []
+    for k, before, after in label_counts:
+        stem = renumber(k[0])
+        if stem is None or (len(k) == 1 and _stem_num_digits(k[0]) != digits):
+            return None
+        renumbered_counts.append(((stem,) + k[1:], before, after))
+    renumbered_visits = {}
+    for order, flowlines in visits.items():
+        renumbered_flowlines = []
+        for node, label in flowlines:
+            stem = renumber(label[0])
+            if stem is None:
+                return None
+            renumbered_flowlines.append((node, (stem,) + label[1:]))
+        renumbered_visits[order] = renumbered_flowlines
+    return i, extra_main_stems, renumbered_visits, renumbered_counts, itr_meta
+
+
+def _label_serially_after_error(network: FlowlineNetwork, huc8: str, root_flowlines: List[Flowline], base32: bool,
+                                error: str,
+                                log: io.TextIOBase = None) -> Tuple[Dict[int, List[Flowline]], Counter, dict]:
+    if log is not None:
+        log.write(f"DEBUG: Labeling root flowlines in parallel failed ({error}), labeling serially\n")
+    return assign_stream_labels(network, huc8, root_flowlines, base32)
+
+
+def assign_stream_labels_parallel(network: FlowlineNetwork, huc8: str, root_flowlines: List[Flowline],
+                                  base32: bool = False, num_workers: int = 2,
+                                  log: io.TextIOBase = None) -> Tuple[Dict[int, List[Flowline]], Counter, dict]:
+    """
+    Assign orders and labels to the flowlines upstream of each of root_flowlines, labeling independent groups of
+    root flowlines (see group_root_flowlines()) on a pool of num_workers processes. Labels (and the order of
+    flowlines of each order) are identical to those of assign_stream_labels(). The watershed is labeled serially if
+    it has fewer than two groups, or its largest group holds more than MAX_PARALLEL_LABELING_GROUP_SHARE of its
+    flowlines.
+
+    The root flowlines of each group are labeled in turn, largest groups first, with the main stem numbers they would
+    have if no root flowline issued main stem labels but its own. A few do (at divergences), which shifts the main
+    stem numbers of the root flowlines after them; once all groups are labeled, the labels of those root flowlines
+    are renumbered, or if they can't be (see _renumber_main_stems()), their groups are labeled again with the right
+    main stem numbers. Subtrees are then merged in order of their root flowlines. A subtree whose label counts
+    started from other counts than those merged before it (as groups share the counts of first order labels numbered
+    by the first two digits of main stems when there are more than 255, see _stem_main_stem()) is labeled serially
+    instead.
+
+    :param log: If not None, log to write to when labeling falls back to serial labeling
+    """
+    groups, group_sizes = group_root_flowlines(network, huc8, root_flowlines)
+    if len(groups) < 2 or max(group_sizes) > MAX_PARALLEL_LABELING_GROUP_SHARE * len(network):
+        if log is not None:
+            log.write(f"DEBUG: {len(groups)} independent groups of root flowlines, largest {max(group_sizes)} "
+                      'flowlines, labeling serially\n')
+        return assign_stream_labels(network, huc8, root_flowlines, base32)
+    # Largest groups first, so that the pool isn't left waiting on one
+    groups = [groups[g] for g in sorted(range(len(groups)), key=lambda g: -group_sizes[g])]
+
+    def tasks(main_stem_counts: List[int], group_ids: Iterable[int]):
+        return [(g, [(i, root_flowlines[i].node, main_stem_counts[i]) for i in groups[g]]) for g in group_ids]
+
+    predicted_counts = list(range(len(root_flowlines)))
+    pool = multiprocessing.Pool(min(num_workers, len(groups)), initializer=_init_subtree_worker,
+                                initargs=(network, huc8, base32))
+    try:
+        results = [None] * len(root_flowlines)
+        for _, group_result, error in pool.imap_unordered(_label_root_group,
+                                                          tasks(predicted_counts, range(len(groups)))):
+            if error is not None:
+                return _label_serially_after_error(network, huc8, root_flowlines, base32, error, log)
+            for result in group_result:
+                results[result[0]] = result
+        main_stem_counts = list(itertools.accumulate((1 + result[1] for result in results[:-1]), initial=0))
+        relabel = set()
+        for g, group in enumerate(groups):
+            for i in group:
+                offset = main_stem_counts[i] - predicted_counts[i]
+                if offset:
+                    results[i] = _renumber_main_stems(results[i], offset, predicted_counts[i])
+                    if results[i] is None:
+                        relabel.add(g)
+                        break
+        for _, group_result, error in pool.imap_unordered(_label_root_group, tasks(main_stem_counts, relabel)):
+            if error is not None:
+                return _label_serially_after_error(network, huc8, root_flowlines, base32, error, log)
+            for result in group_result:
+                results[result[0]] = result
+    finally:
+        pool.close()
+        pool.join()
 
+    stream_orders = {}
+    order_label_count = Counter()
+    visit_count = Counter()
+    iteration_metadata = {}
+    store = network.store
+    max_main_stem = MAX_MAIN_STEM_NUM_B32 if base32 else MAX_MAIN_STEM_NUM
+    num_serial = 0
+    for i, (_, extra_main_stems, visits, label_counts, itr_meta) in enumerate(results):
+        if any(order_label_count[k] != before for k, before, _ in label_counts) or \
+                main_stem_counts[i] + 1 + extra_main_stems > max_main_stem:
+            num_serial += 1
+            assign_stream_segment_order(network, huc8, root_flowlines[i], stream_orders,
+                                        label=_get_next_mainstem_label(order_label_count, base32),
+                                        order_label_count=order_label_count, visit_count=visit_count,
+                                        itr_meta=iteration_metadata, base32=base32)
+            continue
+        # Merge in the same order as the subtree was labeled in, so that flowlines, and label counts, are in the same
+        # order as if it was labeled serially.
+        order_label_count[MAIN_STEM_COUNT_KEY] = main_stem_counts[i] + 1 + extra_main_stems
+        for order, flowlines in visits.items():
+            for node, label in flowlines:
+                visit_count[node] += 1
+                _process_stream_segment(stream_orders, order, Flowline(store, node), label)
+        for k, _, count in label_counts:
+            order_label_count[k] = count
+        for k, value in itr_meta.items():
+            iteration_metadata[k] = max(iteration_metadata.get(k, 0), value)
+    if num_serial and log is not None:
+        log.write(f"DEBUG: {num_serial} of {len(root_flowlines)} root flowlines labeled serially, as the label counts "
+                  'their subtrees started from were set by other groups\n')
+    return stream_orders, order_label_count, iteration_metadata
+
+
+def compact_stream_labels(stream_orders: Dict[int, List[Flowline]], base32: bool = False) -> OrderedDict:
+    """
+    :return: Flowlines with each label, keyed by compact label, sorted by label
+    """
+    flowlines_by_stream_id = OrderedDict()
     # Store stream labels in a dictionary with key=label and value=list of flowlines with that label
-    # (super inefficient)
     raw_flowlines_by_stream_id = {}
     for o in stream_orders.keys():
         for f in stream_orders[o]:
@@ -465,24 +829,58 @@ def label_streams_for_huc8(flowline, plusflow, headwater_reaches, huc8, ws_code,
             flowlines_with_id.append(f)
     # Now sort by ID, reformat IDs to contain the full hierarchy, and convert to compact form
     # without delimiters
+    for k, compact_label in _pad_stream_labels(raw_flowlines_by_stream_id.keys(), base32):
+        flowlines_by_stream_id[compact_label] = raw_flowlines_by_stream_id[k]
+    return flowlines_by_stream_id
+
+
+def label_streams_for_huc8(network: FlowlineNetwork, huc8, ws_code, log,
+                           base32: bool = False, metrics: HUC8Metrics = None,
+                           root_flowlines: Iterable[Flowline] = None, subtree_workers: int = 1) -> OrderedDict:
+    """
+    :param metrics: If not None, metrics to record the time of each stage of labeling, and statistics, in
+    :param root_flowlines: Root flowlines of the watershed if already found (see find_region_root_flowlines())
+    :param subtree_workers: Number of processes to label the subtrees of root flowlines on (at most the number of
+        cores), if at least MIN_PARALLEL_LABELING_WORKERS, and the watershed has at least
+        MIN_PARALLEL_LABELING_FLOWLINES flowlines (see assign_stream_labels_parallel())
+    """
+    # Find watershed outlets (i.e. root flowlines)
+    with stage(metrics, 'find_roots'):
+        if root_flowlines is None and isinstance(network, HydroseqNetwork):
+            root_flowlines = find_root_flowlines_hydroseq(network)
+        elif root_flowlines is None:
+            root_flowlines = find_root_flowlines(network, huc8)
+        # print("Root flowlines for HUC8 '{0}' are: {1}".format(huc8, root_flowlines))
+        root_flowlines = sort_root_flowlines(root_flowlines)
+    log.write(f"DEBUG: len(root_flowlines): {len(root_flowlines)}\n")
+    # Label streams in watershed
+    with stage(metrics, 'assign'):
+        subtree_workers = min(subtree_workers, multiprocessing.cpu_count())
+        if subtree_workers >= MIN_PARALLEL_LABELING_WORKERS and len(root_flowlines) > 1 and \
+                len(network) >= MIN_PARALLEL_LABELING_FLOWLINES:
+            stream_orders, order_label_count, iteration_metadata = \
+                assign_stream_labels_parallel(network, huc8, root_flowlines, base32, subtree_workers, log)
+        else:
+            stream_orders, order_label_count, iteration_metadata = assign_stream_labels(network, huc8,
+                                                                                        root_flowlines, base32)
+    if metrics is not None:
+        metrics['roots'] = len(root_flowlines)
+        record_labeling_metrics(metrics, stream_orders, iteration_metadata)
+
+    log.write(f"Statistics for Watershed {ws_code}, HUC8 '{huc8}'...\n")
+
     label_depth = iteration_metadata['max_order']
     log.write(f"\tMax depth was: {label_depth}\n")
-    max_compact_length = 0
-    for k in sorted(raw_flowlines_by_stream_id.keys()):
-        compact_label = _pad_stream_label(k, MAX_LABEL_LEVEL, base32=base32)
-        # print(f"compact_label: {compact_label}")
-        max_compact_length = max(max_compact_length, len(compact_label))
-        flowlines_by_stream_id[compact_label] = raw_flowlines_by_stream_id[k]
+    with stage(metrics, 'compact'):
+        flowlines_by_stream_id = compact_stream_labels(stream_orders, base32)
+    max_compact_length = max((len(k) for k in flowlines_by_stream_id), default=0)
     log.write(f"\tMax compact label length was {max_compact_length}\n")
 
     # Calculate statistics on the number of streams in each order
     num_reaches_per_order = [0] * (label_depth + 2)
     for k in order_label_count:
-        if k == MAIN_STEM_LABEL_BASE_STR:
-            num_reaches_per_order[0] = order_label_count[k]
-        else:
-            c = k.split(LEVEL_SEP)
-            num_reaches_per_order[len(c)] = order_label_count[k]
+        # The number of levels in the key of a count is the order of the labels it counts
+        num_reaches_per_order[len(k)] = order_label_count[k]
     for i, count in enumerate(num_reaches_per_order):
         log.write(f"\tNum streams of order {i}: {count}\n")
 
@@ -498,62 +896,367 @@ def load_watersheds_data(ws_filepath: str) -> List[Tuple[str, str, str]]:
     return watersheds
 
 
+def _long_label_warning(label: str) -> str:
+    return (f"!!! WARNING: Stream label {label} has length {len(label)}, which is longer than the max length of "
+            f"{MAX_FQ_LABEL_LEN}\n")
+
+
+def iter_labeled_rows(flowlines_by_stream_id: OrderedDict, ws_code: str, huc8: str, log: io.TextIOWrapper):
+    """
+    Generate output rows (see sinks.OUTPUT_FIELDS) of labeled flowlines, warning in log of labels that are too long.
+    """
+    for k, flowlines in flowlines_by_stream_id.items():
+        label = f"{ws_code}{k}"
+        label_len = len(label)
+        # Flowlines are grouped by label, so all have the same raw label
+        raw_label = _format_raw_stream_label(flowlines[0].label)
+        for f in flowlines:
+            if label_len > MAX_FQ_LABEL_LEN:
+                log.write(_long_label_warning(label))
+            yield label, ws_code, huc8, f.comid, f.reachcode, f.divergence, raw_label
+
+
+def _reencoded_log_lines(log_lines: Iterable[str], max_compact_length: int) -> Iterator[str]:
+    """
+    :return: Lines of a watershed's log, without warnings of labels that are too long, and with the max compact label
+        length replaced
+    """
+    for line in log_lines:
+        if line.startswith('\tMax compact label length was '):
+            yield f"\tMax compact label length was {max_compact_length}\n"
+        elif not line.startswith('!!! WARNING: Stream label '):
+            yield line
+
+
+def reencode_huc8(source: OutputSink, sinks: List[OutputSink], ws_code: str, huc8: str, base32: bool,
+                  source_log_file: str, log_file: str):
+    """
+    Encode the labels of a HUC8's labeled reaches read from source again, from their raw labels, with the encoding
+    (and padding) of a labeling run, and write them to sinks, with its log. Output is the same as that of labeling the
+    HUC8 with the encoding. Reaches are streamed, and read again for each sink, so memory use does not grow with the
+    size of the HUC8.
+
+    :raises ValueError: If the HUC8 was labeled before raw labels were output, or one of its labels could not have
+        been assigned with the encoding
+    """
+    stem_labels = {}
+    max_compact_length = 0
+    with tempfile.TemporaryFile('w+', encoding='utf-8') as warnings:
+        def reencode(rows: Iterable[Tuple], warn: bool):
+            nonlocal max_compact_length
+            raw_label = label = None
+            for row in typed_rows(rows):
+                # Reaches are grouped by label, so each label is encoded once
+                if row[OUTPUT_RAW_LABEL] != raw_label or label is None:
+                    raw_label = row[OUTPUT_RAW_LABEL]
+                    if raw_label is None:
+                        raise ValueError(f"Watershed {ws_code}, HUC8 {huc8} has no raw labels, it was labeled before "
+                                         'raw labels were output.')
+                    parsed = _parse_raw_stream_label(raw_label)
+                    _check_label_limits(parsed, base32)
+                    compact_label = _pad_stream_label(parsed, MAX_LABEL_LEVEL, base32=base32, stem_labels=stem_labels)
+                    max_compact_length = max(max_compact_length, len(compact_label))
+                    label = f"{ws_code}{compact_label}"
+                if warn and len(label) > MAX_FQ_LABEL_LEN:
+                    warnings.write(_long_label_warning(label))
+                yield (label,) + row[1:]
+
+        for i, sink in enumerate(sinks):
+            sink.write_huc8(ws_code, huc8, reencode(source.read_huc8(ws_code, huc8), i == 0))
+        warnings.seek(0)
+        with open(log_file, 'w', encoding='utf-8') as log:
+            if os.path.exists(source_log_file):
+                with open(source_log_file, 'r', encoding='utf-8') as source_log:
+                    log.writelines(_reencoded_log_lines(source_log, max_compact_length))
+            shutil.copyfileobj(warnings, log)
+
+
+# Number of watersheds in each batch pipelined by a worker in parallel runs with --pipeline (see
+# do_label_streams_for_huc8s()), and the number of them in memory at once (loading, loaded, and being labeled)
+PIPELINE_BATCH_SIZE = 8
+PIPELINE_MAX_IN_FLIGHT = 3
+
+# Region network shared by the watersheds labeled by this process, see init_worker_region()
+_region: RegionNetwork = None
+
+
+def init_worker_region(region: RegionNetwork):
+    """
+    multiprocessing.Pool initializer that sets the region network of a worker. With the fork start method, workers
+    inherit the region network from the parent without it being copied.
+    """
+    global _region
+    _region = region
+
+
+# Network shared in memory by the watersheds labeled by all processes, see init_worker_shared_network()
+_shared_network: NetworkCache = None
+
+
+def init_worker_shared_network(name: str):
+    """
+    multiprocessing.Pool initializer that attaches a worker to the network shared in memory by its parent (see
+    shared_network.py) under name.
+    """
+    global _shared_network
+    _shared_network = SharedNetworkCache.attach(name)
+
+
+def _output_checksums(sinks: List[OutputSink], ws_code: str, huc8: str, log_file: str) -> Dict[str, str]:
+    checksums = {}
+    for sink in sinks:
+        checksums.update(sink.checksums(ws_code, huc8))
+    checksums[os.path.basename(log_file)] = file_digest(log_file)
+    return checksums
+
+
+def _load_huc8(huc8: str, flowline_path: str, plusflow_path: str, nhd_hr: bool, network_cache_path: str,
+               flowline_cache_size: int, region: bool, metrics: HUC8Metrics = None,
+               hydroseq: bool = False, shared: bool = False) -> Tuple[FlowlineNetwork, Optional[List[Flowline]]]:
+    """
+    Load the HUC8's subnetwork into memory so that traversals don't have to query the database. The database
+    connections (or network cache) are kept open by this process for subsequent watersheds. In region mode, the
+    subnetwork is instead copied out of the region network, which has already been loaded, and in shared mode, out
+    of the network shared in memory.
+
+    :return: Tuple of (subnetwork, root flowlines, or None if not yet found)
+    """
+    root_flowlines = None
+    if region:
+        with stage(metrics, 'load'):
+            network = _region.subnetwork(huc8)
+            root_flowlines = [network.get_flowline(comid) for comid in _region.root_comids[huc8]]
+        if metrics is not None:
+            metrics['flowlines'] = len(network)
+    elif shared:
+        with stage(metrics, 'load'):
+            network = _shared_network.load_huc8_network(huc8)
+        if metrics is not None:
+            metrics['flowlines'] = len(network)
+    else:
+        source = get_network_source(flowline_path, plusflow_path, nhd_hr, network_cache_path, flowline_cache_size,
+                                    hydroseq)
+        num_queries, query_seconds = source.num_queries, source.query_seconds
+        cache = source.flowline_cache
+        cache_hits, cache_misses = (cache.hits, cache.misses) if cache is not None else (0, 0)
+        with stage(metrics, 'load'):
+            network = source.load_huc8_network(huc8)
+        if metrics is not None:
+            metrics['flowlines'] = len(network)
+            metrics['sql_queries'] = source.num_queries - num_queries
+            metrics['sql_seconds'] = source.query_seconds - query_seconds
+            if cache is not None:
+                metrics['flowline_cache_hits'] = cache.hits - cache_hits
+                metrics['flowline_cache_misses'] = cache.misses - cache_misses
+    return network, root_flowlines
+
+
+@contextlib.contextmanager
+def _profiled(profile_dir: Optional[str], ws_code: str, huc8: str):
+    """
+    Profile the block, and write a cProfile dump ({ws_code}_{huc8}.prof) of it to profile_dir, unless profile_dir is
+    None.
+    """
+    if not profile_dir:
+        yield
+        return
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        yield
+    finally:
+        profile.disable()
+        profile.dump_stats(os.path.join(profile_dir, f"{ws_code}_{huc8}.prof"))
+
+
+def _huc8_log_file(output_dir: str, ws_code: str, huc8: str) -> str:
+    return f"{output_dir}/{ws_code}_{huc8}.txt"
+
+
+def _is_huc8_up_to_date(ws: Tuple[str, str, str], previous_entry: Optional[dict], base32: bool, output_format: str,
+                        digest: str, sinks: List[OutputSink], output_dir: str, metrics: HUC8Metrics = None) -> bool:
+    """
+    :return: Whether the watershed's subnetwork, code, label encoding, and output format are unchanged since the
+        previous run it has manifest entry previous_entry from, and its output in sinks is intact (see
+        manifest.is_up_to_date()), in which case it is recorded as skipped in metrics
+    """
+    ws_code, huc8 = ws[0], ws[1]
+    log_file = _huc8_log_file(output_dir, ws_code, huc8)
+    if not is_up_to_date(previous_entry, ws_code, huc8, base32, output_format, digest,
+                         lambda: _output_checksums(sinks, ws_code, huc8, log_file)):
+        return False
+    print("Skipping: do_label_streams_for_huc8 for unchanged watershed: {0}".format(ws))
+    if metrics is not None:
+        metrics['skipped'] = True
+    return True
+
+
+def _label_huc8(network: FlowlineNetwork, ws: Tuple[str, str, str], log, base32: bool, metrics: HUC8Metrics = None,
+                root_flowlines: List[Flowline] = None, subtree_workers: int = 1) -> Iterator[Tuple]:
+    """
+    Label streams for a watershed (see label_streams_for_huc8()), writing statistics and warnings to log.
+
+    :return: Output rows of the watershed's labeled reaches (see iter_labeled_rows()), generated lazily
+    """
+    ws_code, huc8 = ws[0], ws[1]
+    flowlines_by_stream_id = label_streams_for_huc8(network, huc8, ws_code, log, base32, metrics, root_flowlines,
+                                                    subtree_workers)
+    return iter_labeled_rows(flowlines_by_stream_id, ws_code, huc8, log)
+
+
+def _write_huc8(sinks: List[OutputSink], ws: Tuple[str, str, str], rows: Iterable[Tuple], metrics: HUC8Metrics = None):
+    """
+    Write the output rows of a watershed's labeled reaches to each of sinks.
+    """
+    with stage(metrics, 'output'):
+        # Stream rows to the output sink, or if there is more than one (i.e. the label index), to each in turn
+        if len(sinks) > 1:
+            rows = list(rows)
+        for sink in sinks:
+            sink.write_huc8(ws[0], ws[1], rows)
+
+
+def _huc8_manifest_entry(ws: Tuple[str, str, str], base32: bool, output_format: str, digest: str,
+                         sinks: List[OutputSink], output_dir: str, metrics: HUC8Metrics = None) -> dict:
+    """
+    :return: Manifest entry for a watershed whose output has been written to sinks and its log
+    """
+    ws_code, huc8 = ws[0], ws[1]
+    entry = make_manifest_entry(ws_code, huc8, base32, output_format, digest,
+                                _output_checksums(sinks, ws_code, huc8, _huc8_log_file(output_dir, ws_code, huc8)))
+    if metrics is not None:
+        metrics['skipped'] = False
+    print("Finish: do_label_streams_for_huc8 for watershed: {0}".format(ws))
+    return entry
+
+
 def do_label_streams_for_huc8(ws: Tuple[str, str, str], flowline_path: str, plusflow_path: str,
-                              nhd_hr: bool = False, base32: bool = False):
+                              nhd_hr: bool = False, base32: bool = False, network_cache_path: str = None,
+                              previous_entry: dict = None, output_format: str = 'csv',
+                              label_index: bool = False, collect_metrics: bool = False,
+                              profile_dir: str = None,
+                              flowline_cache_size: int = DEFAULT_FLOWLINE_CACHE_SIZE,
+                              region: bool = False, subtree_workers: int = 1,
+                              hydroseq: bool = False, shared: bool = False,
+                              output_dir: str = OUTPUT_PREFIX) -> Tuple[dict, Optional[dict]]:
+    """
+    Label streams for a watershed, unless previous_entry (the watershed's entry in the manifest of a previous run)
+    shows that the watershed's subnetwork, code, label encoding, and output format are unchanged and its output is
+    intact.
+
+    :param collect_metrics: Whether to collect performance metrics (see metrics.py)
+    :param profile_dir: If not None, directory to write a cProfile dump ({ws_code}_{huc8}.prof) to
+    :param flowline_cache_size: Size of the flowline cache of this process's network source (see NetworkSource)
+    :param region: Whether to copy the watershed's subnetwork, and its root flowlines, out of the region network
+        of this process (see init_worker_region()) rather than loading it from the network source
+    :param subtree_workers: Number of processes to label the subtrees of the watershed's root flowlines on
+    :param hydroseq: Whether to load the watershed's subnetwork from the VAA routing columns rather than the flow
+        tables (see hydroseq.py)
+    :param shared: Whether to copy the watershed's subnetwork out of the network shared in memory by all processes
+        (see init_worker_shared_network()) rather than loading it from the network source
+    :param output_dir: Directory to write the watershed's log and output to
+    :return: Tuple of (manifest entry for the watershed, metrics, or None if not collect_metrics)
+    """
     print("Begin: do_label_streams_for_huc8 for watershed: {0}".format(ws))
 
-    flowline_conn = sqlite3.connect(flowline_path)
-    flowline = flowline_conn.cursor()
-    plusflow = None
-    if not nhd_hr:
-        plusflow_conn = sqlite3.connect(plusflow_path)
-        plusflow = plusflow_conn.cursor()
-
     ws_code = ws[0]
     huc8 = ws[1]
-
-    log_file = f"{OUTPUT_PREFIX}/{ws_code}_{huc8}.txt"
-    with open(log_file, 'w', encoding='utf-8') as log:
-        if nhd_hr:
-            flowlines_by_stream_id = label_streams_for_huc8(flowline, plusflow,
-                                                            get_headwater_reaches_hr(flowline, huc8),
-                                                            huc8, ws_code, log, nhd_hr, base32)
+    metrics = HUC8Metrics(ws_code, huc8) if collect_metrics else None
+    sinks = []
+    try:
+        sinks.extend(get_output_sinks(output_format, output_dir, label_index))
+        with _profiled(profile_dir, ws_code, huc8):
+            network, root_flowlines = _load_huc8(huc8, flowline_path, plusflow_path, nhd_hr, network_cache_path,
+                                                 flowline_cache_size, region, metrics, hydroseq, shared)
+            digest = network_digest(network)
+            if _is_huc8_up_to_date(ws, previous_entry, base32, output_format, digest, sinks, output_dir, metrics):
+                entry = previous_entry
+            else:
+                with open(_huc8_log_file(output_dir, ws_code, huc8), 'w', encoding='utf-8') as log:
+                    rows = _label_huc8(network, ws, log, base32, metrics, root_flowlines, subtree_workers)
+                    _write_huc8(sinks, ws, rows, metrics)
+                entry = _huc8_manifest_entry(ws, base32, output_format, digest, sinks, output_dir, metrics)
+    finally:
+        for sink in sinks:
+            sink.close()
+    return entry, None if metrics is None else metrics.to_dict()
+
+
+def do_label_streams_for_huc8s(watersheds: List[Tuple[Tuple[str, str, str], Optional[dict]]], flowline_path: str,
+                               plusflow_path: str, nhd_hr: bool = False, base32: bool = False,
+                               network_cache_path: str = None, output_format: str = 'csv',
+                               label_index: bool = False, collect_metrics: bool = False, profile_dir: str = None,
+                               flowline_cache_size: int = DEFAULT_FLOWLINE_CACHE_SIZE,
+                               region: bool = False, hydroseq: bool = False, shared: bool = False,
+                               output_dir: str = OUTPUT_PREFIX) -> List[Tuple[dict, Optional[dict]]]:
+    """
+    Label streams for each of watersheds, given as (watershed, manifest entry of a previous run), as
+    do_label_streams_for_huc8() does, but pipelined (see pipeline.py): the next watershed is loaded by a prefetch
+    thread while the current one is labeled, and labeled reaches and logs are written to the output sinks by a
+    writer thread. Profiles (if profile_dir is not None) cover labeling only.
+
+    :param output_dir: Directory to write the watersheds' logs and output to
+    :return: Tuple of (manifest entry, metrics, or None if not collect_metrics) for each watershed, in order
+    """
+    previous_entries = {ws: previous_entry for ws, previous_entry in watersheds}
+    # Sinks used to check whether watersheds are up to date. The writer thread writes to sinks of its own, as
+    # sinks (i.e. SQLite connections) must only be used by one thread at a time.
+    sinks = []
+    writer_sinks = []
+
+    def load(ws):
+        print("Begin: do_label_streams_for_huc8 for watershed: {0}".format(ws))
+        metrics = HUC8Metrics(ws[0], ws[1]) if collect_metrics else None
+        network, root_flowlines = _load_huc8(ws[1], flowline_path, plusflow_path, nhd_hr, network_cache_path,
+                                             flowline_cache_size, region, metrics, hydroseq, shared)
+        return metrics, network, root_flowlines, network_digest(network)
+
+    def label(ws, loaded):
+        metrics, network, root_flowlines, digest = loaded
+        if _is_huc8_up_to_date(ws, previous_entries[ws], base32, output_format, digest, sinks, output_dir, metrics):
+            return metrics, digest, None, None
+        log = io.StringIO()
+        with _profiled(profile_dir, ws[0], ws[1]):
+            rows = _label_huc8(network, ws, log, base32, metrics, root_flowlines)
+            with stage(metrics, 'output'):
+                rows = list(rows)
+        return metrics, digest, rows, log.getvalue()
+
+    def write(ws, labeled):
+        metrics, digest, rows, log_text = labeled
+        if rows is None:
+            entry = previous_entries[ws]
         else:
-            flowlines_by_stream_id = label_streams_for_huc8(flowline, plusflow,
-                                                            get_headwater_reaches(flowline, huc8),
-                                                            huc8, ws_code, log, nhd_hr, base32)
-        # Save results as CSV
-        outfile = f"{OUTPUT_PREFIX}/{ws_code}_{huc8}.csv"
-        with open(outfile, 'w') as csvfile:
-            fieldnames = ['stream_label', 'ws_code', 'huc8', 'comid', 'reachcode', 'divergence']
-            w = csv.DictWriter(csvfile, delimiter=',', quotechar='"', fieldnames=fieldnames)
-            w.writeheader()
-            for k in flowlines_by_stream_id.keys():
-                flowlines = flowlines_by_stream_id[k]
-                for f in flowlines:
-                    label = f"{ws_code}{k}"
-                    label_len = len(label)
-                    if label_len > MAX_FQ_LABEL_LEN:
-                        log.write(f"!!! WARNING: Stream label {label} has length {label_len}, which is longer than the max length of {MAX_FQ_LABEL_LEN}\n")
-                    w.writerow({
-                        'stream_label': f"{ws_code}{k}",
-                        'ws_code': ws_code,
-                        'huc8': huc8,
-                        'comid': f.comid,
-                        'reachcode': f.reachcode,
-                        'divergence': f.divergence
-                    })
+            _write_huc8(writer_sinks, ws, rows, metrics)
+            with stage(metrics, 'output'):
+                with open(_huc8_log_file(output_dir, ws[0], ws[1]), 'w', encoding='utf-8') as log:
+                    log.write(log_text)
+            entry = _huc8_manifest_entry(ws, base32, output_format, digest, writer_sinks, output_dir, metrics)
+        return entry, None if metrics is None else metrics.to_dict()
 
-    print("Finish: do_label_streams_for_huc8 for watershed: {0}".format(ws))
+    try:
+        sinks.extend(get_output_sinks(output_format, output_dir, label_index))
+        writer_sinks.extend(OUTPUT_SINKS[sink.format](output_dir) for sink in sinks)
+        return run_pipeline([ws for ws, _ in watersheds], load, label, write)
+    finally:
+        for sink in sinks + writer_sinks:
+            sink.close()
 
 
 def parallel_do_label_streams_for_huc8(args):
     # Can't pickle a curried function so we'll do this instead
-    do_label_streams_for_huc8(*args)
+    return do_label_streams_for_huc8(*args)
 
 
-def main():
-    parser = argparse.ArgumentParser(description='LWI Stream Naming Convention Example code')
+def parallel_do_label_streams_for_huc8s(args):
+    return do_label_streams_for_huc8s(*args)
+
+
+def compile_main(argv: List[str]):
+    parser = argparse.ArgumentParser(prog='lwi-label-nhd-streams compile',
+                                     description=('Compile NHDPlus flowline and flow tables into a network cache '
+                                                  'file that can be used (via the -c option) to label streams '
+                                                  'without querying the NHDPlus databases.'))
     parser.add_argument('-f', '--flowline', required=True,
                         help=('Path to SQLite file containing NHDPlus flowline geometries. '
                               'If NHDPlus HR is specified, the SQLite file must also contain '
@@ -561,12 +1264,665 @@ def main():
     parser.add_argument('-p', '--plusflow',
                         help=('Path to SQLite file containing NHDPlus PlusFlow table. '
                               'Only required if NHDPlus HR is NOT specified.'))
+    parser.add_argument('--nhdhr', action='store_true', help='Use NHDPlus HR', default=False)
+    parser.add_argument('-o', '--output', required=True, help='Path of network cache file to write.')
+    args = parser.parse_args(argv)
+    if not args.nhdhr and not args.plusflow:
+        parser.error('-p/--plusflow is required unless --nhdhr is specified.')
+
+    flowline = connect_nhdplus(args.flowline).cursor()
+    plusflow = None
+    if not args.nhdhr:
+        plusflow = connect_nhdplus(args.plusflow).cursor()
+    print(f"Compiling network cache {args.output}...")
+    compile_network_cache(args.output, flowline, plusflow, args.nhdhr)
+    with NetworkCache(args.output) as cache:
+        print(f"Compiled {cache.num_flowlines} flowlines, {cache.num_edges} flow edges, "
+              f"and {cache.num_huc8s} HUC8s into {args.output}.")
+
+
+def prepare_main(argv: List[str]):
+    parser = argparse.ArgumentParser(prog='lwi-label-nhd-streams prepare',
+                                     description=('Create the covering indexes used to load HUC8s from the NHDPlus '
+                                                  'databases, if missing, and run ANALYZE. Run once after '
+                                                  'downloading NHDPlus data; labeling then opens the databases '
+                                                  'read-only.'))
+    parser.add_argument('-f', '--flowline', required=True,
+                        help=('Path to SQLite file containing NHDPlus flowline geometries. '
+                              'If NHDPlus HR is specified, the SQLite file must also contain '
+                              'NHDPlusFlowlineVAA, and NHDPlusFlow.'))
+    parser.add_argument('-p', '--plusflow',
+                        help=('Path to SQLite file containing NHDPlus PlusFlow table. '
+                              'Only required if NHDPlus HR is NOT specified.'))
+    parser.add_argument('--nhdhr', action='store_true', help='Use NHDPlus HR', default=False)
+    parser.add_argument('--no_analyze', action='store_true', help="Don't run ANALYZE. Default: False",
+                        default=False)
+    parser.add_argument('--hydroseq', action='store_true',
+                        help=('Also create the indexes used to label from the VAA routing columns (see the --hydroseq '
+                              'option of labeling). Default: False'),
+                        default=False)
+    args = parser.parse_args(argv)
+    if not args.nhdhr and not args.plusflow:
+        parser.error('-p/--plusflow is required unless --nhdhr is specified.')
+
+    try:
+        created = prepare_nhdplus(args.flowline, args.plusflow, args.nhdhr, not args.no_analyze, args.hydroseq)
+    except (ValueError, sqlite3.Error) as e:
+        sys.exit(f"Unable to prepare NHDPlus databases: {e}")
+    for path, indexes in created.items():
+        if indexes:
+            print(f"Created indexes {', '.join(indexes)} in {path}.")
+        else:
+            print(f"All indexes already exist in {path}.")
+
+
+def extract_main(argv: List[str]):
+    parser = argparse.ArgumentParser(prog='lwi-label-nhd-streams extract',
+                                     description=('Extract the NHDPlus flowlines and flow edges needed to label the '
+                                                  'HUC8s in a watershed definition file (and the flowlines one hop '
+                                                  'across their boundaries) into a small, indexed, attribute-only '
+                                                  'SQLite database, which can be used in place of the NHDPlus '
+                                                  'databases when labeling those HUC8s.'))
+    parser.add_argument('-f', '--flowline', required=True,
+                        help=('Path to SQLite file containing NHDPlus flowline geometries. '
+                              'If NHDPlus HR is specified, the SQLite file must also contain '
+                              'NHDPlusFlowlineVAA, and NHDPlusFlow.'))
+    parser.add_argument('-p', '--plusflow',
+                        help=('Path to SQLite file containing NHDPlus PlusFlow table. '
+                              'Only required if NHDPlus HR is NOT specified.'))
+    parser.add_argument('--nhdhr', action='store_true', help='Use NHDPlus HR', default=False)
+    parser.add_argument('-w', '--watersheds', type=str, default='input/LWI_watersheds.csv',
+                        help='Path to CSV file containing watershed definitions of the HUC8s to extract.')
+    parser.add_argument('-o', '--output', required=True,
+                        help=('Path of extract to write. For NHDPlus V2, use it as both the flowline (-f) and '
+                              'PlusFlow (-p) database when labeling.'))
+    parser.add_argument('--no_analyze', action='store_true', help="Don't run ANALYZE. Default: False",
+                        default=False)
+    args = parser.parse_args(argv)
+    if not args.nhdhr and not args.plusflow:
+        parser.error('-p/--plusflow is required unless --nhdhr is specified.')
+
+    huc8s = [ws[1] for ws in load_watersheds_data(args.watersheds)]
+    print(f"Extracting {len(huc8s)} HUC8s to {args.output}...")
+    try:
+        counts = extract_nhdplus(args.flowline, args.plusflow, args.nhdhr, huc8s, args.output, not args.no_analyze)
+    except (FileExistsError, FileNotFoundError) as e:
+        parser.error(str(e))
+    except sqlite3.Error as e:
+        sys.exit(f"Unable to extract NHDPlus data: {e}")
+    print(f"Extracted {counts['flowlines']} flowlines ({counts['huc8_flowlines']} within the HUC8s) and "
+          f"{counts['edges']} flow edges into {args.output}.")
+
+
+def serve_main(argv: List[str]):
+    # Imported here as the service uses the labeling functions of this module
+    from lwi_model_naming_conventions.service import LabelService, serve, DEFAULT_HOST, DEFAULT_PORT, \
+        DEFAULT_CACHE_SIZE, DEFAULT_NETWORK_CACHE_SIZE
+
+    parser = argparse.ArgumentParser(prog='lwi-label-nhd-streams serve',
+                                     description=('Serve stream labels over HTTP, keeping the NHDPlus network and '
+                                                  'the labels of recently requested watersheds in memory.'))
+    parser.add_argument('-f', '--flowline',
+                        help=('Path to SQLite file containing NHDPlus flowline geometries. '
+                              'If NHDPlus HR is specified, the SQLite file must also contain '
+                              'NHDPlusFlowlineVAA, and NHDPlusFlow. '
+                              'Required unless a network cache is specified.'))
+    parser.add_argument('-p', '--plusflow',
+                        help=('Path to SQLite file containing NHDPlus PlusFlow table. '
+                              'Only required if NHDPlus HR is NOT specified.'))
+    parser.add_argument('-c', '--network_cache',
+                        help=('Path to network cache file created by the compile command to read the NHDPlus '
+                              'network from instead of the SQLite files.'))
+    parser.add_argument('--nhdhr', action='store_true', help='Use NHDPlus HR', default=False)
+    parser.add_argument('--hexadecimal', action='store_true',
+                        help=('Encode stream reach IDs as hexadecimal instead of Crockford base32 unless '
+                              'otherwise requested. Default: False'),
+                        default=False)
+    parser.add_argument('--host', default=DEFAULT_HOST, help=f"Host to listen on. Default: {DEFAULT_HOST}")
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help=f"Port to listen on. Default: {DEFAULT_PORT}")
+    parser.add_argument('-s', '--socket', help='Path of Unix socket to listen on instead of a TCP port.')
+    parser.add_argument('--cache_size', type=int, default=DEFAULT_CACHE_SIZE,
+                        help=('Number of watersheds whose labels are kept in memory. '
+                              f"Default: {DEFAULT_CACHE_SIZE}"))
+    parser.add_argument('--network_cache_size', type=int, default=DEFAULT_NETWORK_CACHE_SIZE,
+                        help=('Number of HUC8 subnetworks kept in memory, so that their watersheds can be labeled '
+                              'again (e.g. in the other encoding) without loading them. '
+                              f"Default: {DEFAULT_NETWORK_CACHE_SIZE}"))
+    args = parser.parse_args(argv)
+    if not args.flowline and not args.network_cache:
+        parser.error('one of -f/--flowline or -c/--network_cache is required.')
+
+    with NetworkSource(args.flowline, args.plusflow, args.nhdhr, args.network_cache) as source:
+        service = LabelService(source, base32=not args.hexadecimal, cache_size=args.cache_size,
+                               network_cache_size=args.network_cache_size)
+        try:
+            serve(service, args.host, args.port, args.socket)
+        except FileExistsError as e:
+            parser.error(str(e))
+
+
+def query_main(argv: List[str]):
+    parser = argparse.ArgumentParser(prog='lwi-label-nhd-streams query',
+                                     description=('Look up labeled flowlines in the label index written when '
+                                                  'labeling streams, printing them as CSV.'))
+    parser.add_argument('-i', '--index', default=DEFAULT_LABEL_INDEX,
+                        help=f"Path of label index. Default: {DEFAULT_LABEL_INDEX}")
+    query = parser.add_mutually_exclusive_group(required=True)
+    query.add_argument('-l', '--label', nargs='+',
+                       help='Fully qualified stream label(s) (e.g. AA0A1000000000000) of flowlines to look up.')
+    query.add_argument('--prefix', nargs='+',
+                       help=('Stream label prefix(es) (e.g. AA0A) of flowlines to look up, e.g. to find a stream '
+                             'and all of its tributaries.'))
+    query.add_argument('--comid', nargs='+',
+                       help='COMID(s) (or NHDPlusID(s)) of flowlines to look up.')
+    args = parser.parse_args(argv)
+
+    try:
+        index = LabelIndex(args.index)
+    except FileNotFoundError as e:
+        parser.error(str(e))
+    with index:
+        w = csv.writer(sys.stdout, delimiter=',', quotechar='"')
+        w.writerow(OUTPUT_FIELDS)
+        if args.label:
+            for label in args.label:
+                w.writerows(index.flowlines(label))
+        elif args.prefix:
+            for prefix in args.prefix:
+                w.writerows(index.flowlines_with_prefix(prefix))
+        else:
+            for comid in args.comid:
+                try:
+                    reach = index.flowline(int(comid))
+                except ValueError:
+                    reach = index.flowline(float(comid))
+                if reach is None:
+                    print(f"COMID {comid} not found in label index.", file=sys.stderr)
+                else:
+                    w.writerow(reach)
+
+
+def synthesize_main(argv: List[str]):
+    parser = argparse.ArgumentParser(prog='lwi-label-nhd-streams synthesize',
+                                     description=('Generate a synthetic NHDPlus network, written as NHDPlus V2 and '
+                                                  'HR SQLite databases along with a watershed definition file.'))
+    parser.add_argument('-o', '--output_dir', required=True, help='Directory to write synthetic data to.')
+    parser.add_argument('-r', '--reaches', type=int, default=10000,
+                        help='Approximate number of flowlines to generate. Default: 10000')
+    parser.add_argument('--huc8s', type=int, default=4, help='Number of HUC8s to generate. Default: 4')
+    parser.add_argument('--branching', type=float, default=0.4,
+                        help='Probability that a tributary joins a stream at each reach. Default: 0.4')
+    parser.add_argument('--max_order', type=int, default=5,
+                        help='Maximum Strahler order of a drainage basin. Default: 5')
+    parser.add_argument('--divergence', type=float, default=0.1,
+                        help='Probability that a stream splits into two flowpaths at each reach. Default: 0.1')
+    parser.add_argument('--coastal_outlets', type=int, default=2,
+                        help='Number of drainage basins in each HUC8 that drain to the coast. Default: 2')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed. Default: 0')
+    args = parser.parse_args(argv)
+
+    network = generate_network(args.reaches, args.huc8s, args.branching, args.max_order, args.divergence,
+                               args.coastal_outlets, args.seed)
+    try:
+        paths = write_synthetic_data(network, args.output_dir)
+    except FileExistsError as e:
+        parser.error(str(e))
+    print(f"Generated {len(network)} flowlines and {len(network.edges)} flow edges in {len(network.huc8s)} HUC8s:")
+    for name, path in paths.items():
+        print(f"\t{name}: {path}")
+
+
+def benchmark_main(argv: List[str]):
+    # Imported here as the benchmark uses the labeling functions of this module
+    from lwi_model_naming_conventions.benchmark import benchmark, format_results, check_golden_labels, \
+        MAX_DIFFERENCES_REPORTED
+
+    parser = argparse.ArgumentParser(prog='lwi-label-nhd-streams benchmark',
+                                     description=('Measure the time, SQL queries, and memory used by each stage of '
+                                                  'labeling, and optionally check that labels are unchanged.'))
+    parser.add_argument('-f', '--flowline',
+                        help=('Path to SQLite file containing NHDPlus flowline geometries. '
+                              'If NHDPlus HR is specified, the SQLite file must also contain '
+                              'NHDPlusFlowlineVAA, and NHDPlusFlow. '
+                              'Required unless a network cache is specified.'))
+    parser.add_argument('-p', '--plusflow',
+                        help=('Path to SQLite file containing NHDPlus PlusFlow table. '
+                              'Only required if NHDPlus HR is NOT specified.'))
+    parser.add_argument('-c', '--network_cache',
+                        help=('Path to network cache file created by the compile command to read the NHDPlus '
+                              'network from instead of the SQLite files.'))
+    parser.add_argument('-w', '--watersheds', type=str, default='input/LWI_watersheds.csv',
+                        help='Path to CSV file containing watershed definitions of the HUC8s to benchmark.')
+    parser.add_argument('--nhdhr', action='store_true', help='Use NHDPlus HR', default=False)
+    parser.add_argument('--hexadecimal', action='store_true',
+                        help='Encode stream reach IDs as hexadecimal instead of Crockford base32. Default: False',
+                        default=False)
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Number of times to label each watershed, reporting the fastest. Default: 3')
+    parser.add_argument('-g', '--golden',
+                        help=('Path of golden label file to compare labels with. If the file does not exist, it '
+                              'is written with the current labels.'))
+    parser.add_argument('--json', help='Path of JSON file to write results to.')
+    args = parser.parse_args(argv)
+    if not args.flowline and not args.network_cache:
+        parser.error('one of -f/--flowline or -c/--network_cache is required.')
+
+    ws_data = load_watersheds_data(args.watersheds)
+    with NetworkSource(args.flowline, args.plusflow, args.nhdhr, args.network_cache) as source:
+        results, labels = benchmark(source, ws_data, not args.hexadecimal, args.repeat)
+    print(format_results(results), end='')
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+    if args.golden:
+        differences = check_golden_labels(args.golden, labels)
+        if differences:
+            print(f"{len(differences)} labels differ from golden labels in {args.golden}:")
+            for d in differences[:MAX_DIFFERENCES_REPORTED]:
+                print(f"\t{d}")
+            sys.exit(1)
+        print(f"All {len(labels)} labels match golden labels in {args.golden}.")
+
+
+def diff_main(argv: List[str]):
+    parser = argparse.ArgumentParser(prog='lwi-label-nhd-streams diff',
+                                     description=('Compare the stream labels of two labeling runs, reporting added, '
+                                                  'removed, and relabeled reaches in each HUC8, and the hierarchy '
+                                                  'levels at which streams were renumbered. Exits with status 1 if '
+                                                  'labels differ.'))
+    parser.add_argument('old', help='Output directory of the old labeling run.')
+    parser.add_argument('new', help='Output directory of the new labeling run.')
+    parser.add_argument('--old_format', choices=list(OUTPUT_SINKS), default='csv',
+                        help='Output format of the old labeling run. Default: csv')
+    parser.add_argument('--new_format', choices=list(OUTPUT_SINKS), default='csv',
+                        help='Output format of the new labeling run. Default: csv')
+    parser.add_argument('--huc8', nargs='+', help='HUC8s to compare. Default: all HUC8s in either run')
+    parser.add_argument('-o', '--changes',
+                        help='Path of CSV file to write each added, removed, and relabeled reach to.')
+    parser.add_argument('--json', help='Path of JSON file to write the differences in each HUC8 to.')
+    parser.add_argument('--all', action='store_true', default=False,
+                        help='List all HUC8s, not only those whose labels differ. Default: False')
+    args = parser.parse_args(argv)
+    for output_dir in (args.old, args.new):
+        if not os.path.isdir(output_dir):
+            parser.error(f"Output directory {output_dir} not found.")
+
+    old = OUTPUT_SINKS[args.old_format](args.old)
+    new = OUTPUT_SINKS[args.new_format](args.new)
+    changes_file = None
+    try:
+        changes = None
+        if args.changes:
+            changes_file = open(args.changes, 'w', newline='')
+            changes = csv.writer(changes_file, delimiter=',', quotechar='"')
+            changes.writerow(CHANGE_FIELDS)
+        results = diff_outputs(old, new, changes, args.huc8)
+    finally:
+        if changes_file is not None:
+            changes_file.close()
+        old.close()
+        new.close()
+    print(format_differences(results, args.all), end='')
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+    if has_differences(results):
+        sys.exit(1)
+
+
+def reencode_main(argv: List[str]):
+    parser = argparse.ArgumentParser(prog='lwi-label-nhd-streams reencode',
+                                     description=('Encode the stream labels of a labeling run\'s output again, from '
+                                                  'their raw labels, as hexadecimal or Crockford base32 (with the '
+                                                  'current padding), writing them to a new output directory, without '
+                                                  'labeling streams again. Output is the same as that of labeling '
+                                                  'with the new encoding.'))
+    parser.add_argument('source', help='Output directory of the labeling run.')
+    parser.add_argument('output', help='Output directory to write re-encoded output to.')
+    parser.add_argument('--source_format', choices=list(OUTPUT_SINKS), default='csv',
+                        help='Output format of the labeling run. Default: csv')
+    parser.add_argument('--output_format', '--output-format', choices=list(OUTPUT_SINKS), default='csv',
+                        help='Format of re-encoded output. Default: csv')
+    encoding = parser.add_mutually_exclusive_group(required=True)
+    encoding.add_argument('--base32', action='store_true', help='Encode stream reach IDs as Crockford base32.')
+    encoding.add_argument('--hexadecimal', action='store_true', help='Encode stream reach IDs as hexadecimal.')
+    parser.add_argument('--label_index', action='store_true',
+                        help=('Also write labeled streams to the label index, unless the output format is sqlite. '
+                              'Default: False'),
+                        default=False)
+    parser.add_argument('--huc8', nargs='+', help='HUC8s to re-encode. Default: all HUC8s in the output')
+    args = parser.parse_args(argv)
+    if not os.path.isdir(args.source):
+        parser.error(f"Output directory {args.source} not found.")
+    if os.path.realpath(args.source) == os.path.realpath(args.output):
+        parser.error('Output must be re-encoded into a different directory.')
+
+    base32 = args.base32
+    source = OUTPUT_SINKS[args.source_format](args.source)
+    os.makedirs(args.output, exist_ok=True)
+    try:
+        sinks = get_output_sinks(args.output_format, args.output, args.label_index)
+    except ImportError as e:
+        parser.error(str(e))
+    for sink in sinks:
+        sink.prepare()
+    source_manifest = load_manifest(args.source)
+    manifest = load_manifest(args.output)
+    huc8s = [ws for ws in source.huc8s() if args.huc8 is None or ws[1] in args.huc8]
+    try:
+        for ws_code, huc8 in huc8s:
+            key = manifest_key(ws_code, huc8)
+            log_file = f"{args.output}/{key}.txt"
+            try:
+                reencode_huc8(source, sinks, ws_code, huc8, base32, f"{args.source}/{key}.txt", log_file)
+            except ValueError as e:
+                sys.exit(f"Unable to re-encode {args.source}: {e}")
+            # The re-encoded output is up to date for the network labeled by the source run
+            source_entry = source_manifest.get(key)
+            if source_entry is not None:
+                manifest[key] = make_manifest_entry(ws_code, huc8, base32, args.output_format,
+                                                    source_entry['network_digest'],
+                                                    _output_checksums(sinks, ws_code, huc8, log_file))
+            else:
+                manifest.pop(key, None)
+    finally:
+        source.close()
+        for sink in sinks:
+            sink.close()
+    save_manifest(args.output, manifest)
+    print(f"Re-encoded {len(huc8s)} HUC8s into {args.output}.")
+
+
+def export_main(argv: List[str]):
+    parser = argparse.ArgumentParser(prog='lwi-label-nhd-streams export',
+                                     description=('Export the labeled streams of a labeling run as a flowline layer, '
+                                                  'with the geometries of the NHDPlus flowlines and a spatial index, '
+                                                  'to a new SpatiaLite database or GeoPackage (the format of the '
+                                                  'flowline database), joining them in SQLite.'))
+    parser.add_argument('source', help='Output directory of the labeling run.')
+    parser.add_argument('-f', '--flowline', required=True,
+                        help=('Path to SpatiaLite database or GeoPackage containing NHDPlus flowline geometries '
+                              '(NHDFlowline_Network, or NHDFlowline for NHDPlus HR).'))
+    parser.add_argument('--nhdhr', action='store_true', help='Use NHDPlus HR', default=False)
+    parser.add_argument('-o', '--output', required=True, help='Path of SpatiaLite database or GeoPackage to write.')
+    parser.add_argument('--source_format', choices=list(OUTPUT_SINKS), default='csv',
+                        help='Output format of the labeling run. Default: csv')
+    parser.add_argument('--layer', default=DEFAULT_LAYER, help=f"Name of layer to write. Default: {DEFAULT_LAYER}")
+    parser.add_argument('--huc8', nargs='+', help='HUC8s to export. Default: all HUC8s in the output')
+    args = parser.parse_args(argv)
+    if not os.path.isdir(args.source):
+        parser.error(f"Output directory {args.source} not found.")
+
+    source = OUTPUT_SINKS[args.source_format](args.source)
+    print(f"Exporting labeled streams in {args.source} to {args.output}...")
+    try:
+        counts = export_labeled_flowlines(source, args.flowline, args.output, args.nhdhr, args.layer, args.huc8)
+    except (FileExistsError, FileNotFoundError) as e:
+        parser.error(str(e))
+    except (ValueError, sqlite3.Error) as e:
+        sys.exit(f"Unable to export labeled streams: {e}")
+    finally:
+        source.close()
+    print(f"Exported {counts['flowlines']} flowlines to layer {args.layer} ({counts['indexed']} spatially indexed).")
+    if counts['missing']:
+        print(f"!!! WARNING: {counts['missing']} labeled flowlines were not found in {args.flowline}.")
+
+
+def enqueue_main(argv: List[str]):
+    parser = argparse.ArgumentParser(prog='lwi-label-nhd-streams enqueue',
+                                     description=('Create a task queue (see the work and merge commands) with a task '
+                                                  'for each watershed in a watershed definition file, so that '
+                                                  'watersheds can be labeled by workers on any number of nodes.'))
+    parser.add_argument('-q', '--queue', required=True,
+                        help='Directory to create the task queue in, on a filesystem shared by all workers.')
+    parser.add_argument('-w', '--watersheds', type=str, default='input/LWI_watersheds.csv',
+                        help='Path to CSV file containing watershed definitions of the HUC8s to label.')
+    parser.add_argument('-f', '--flowline',
+                        help=('Path to SQLite file containing NHDPlus flowlines, used to estimate the size of each '
+                              'watershed so that the largest are labeled first. Default: watersheds are labeled in '
+                              'the order of the watershed definition file'))
+    parser.add_argument('-p', '--plusflow', help='Path to SQLite file containing NHDPlus PlusFlow table.')
+    parser.add_argument('-c', '--network_cache',
+                        help='Path to network cache file to estimate the size of each watershed from instead.')
+    parser.add_argument('--nhdhr', action='store_true', help='Use NHDPlus HR', default=False)
+    parser.add_argument('--hexadecimal', action='store_true',
+                        help='Encode stream reach IDs as hexadecimal instead of Crockford base32. Default: False',
+                        default=False)
+    parser.add_argument('--output_format', '--output-format', choices=list(OUTPUT_SINKS), default='csv',
+                        help='Format of output, as for labeling. Default: csv')
+    parser.add_argument('--lease_seconds', type=float, default=DEFAULT_LEASE_SECONDS,
+                        help=('Seconds after a worker\'s last heartbeat that its task is retried by another worker. '
+                              f"Default: {DEFAULT_LEASE_SECONDS}"))
+    parser.add_argument('--max_attempts', type=int, default=DEFAULT_MAX_ATTEMPTS,
+                        help=('Number of times a task is attempted before it is failed, if its workers stop '
+                              f"heartbeating. Default: {DEFAULT_MAX_ATTEMPTS}"))
+    args = parser.parse_args(argv)
+    if args.lease_seconds <= 0:
+        parser.error('--lease_seconds must be positive.')
+    if args.max_attempts < 1:
+        parser.error('--max_attempts must be at least 1.')
+
+    ws_data = load_watersheds_data(args.watersheds)
+    sizes = [0] * len(ws_data)
+    if args.flowline or args.network_cache:
+        with NetworkSource(args.flowline, args.plusflow, args.nhdhr, args.network_cache) as source:
+            sizes = estimate_sizes(source.count_flowlines, [ws[1] for ws in ws_data])
+    options = {'base32': not args.hexadecimal, 'output_format': args.output_format, 'nhd_hr': args.nhdhr}
+    try:
+        TaskQueue.create(args.queue, ws_data, sizes, options, args.lease_seconds, args.max_attempts)
+    except FileExistsError as e:
+        parser.error(str(e))
+    print(f"Queued {len(ws_data)} watersheds in {args.queue}.")
+
+
+def _run_queue_worker(queue_path: str, flowline_path: str, plusflow_path: str, network_cache_path: str,
+                      flowline_cache_size: int) -> Dict[str, int]:
+    queue = TaskQueue(queue_path)
+    options = queue.options
+
+    def label(ws: Tuple[str, str, str], output_dir: str) -> Tuple[dict, Optional[dict]]:
+        # Watersheds are always labeled (there is no previous manifest), and metrics are always collected, for the
+        # merge command to write if asked to
+        return do_label_streams_for_huc8(ws, flowline_path, plusflow_path, options['nhd_hr'], options['base32'],
+                                         network_cache_path, None, staging_format(options['output_format']),
+                                         False, True, None, flowline_cache_size, output_dir=output_dir)
+
+    counts = run_worker(queue, label)
+    print(f"Worker {default_worker_id()} labeled {counts[DONE]} watersheds, {counts[FAILED]} failed.")
+    return counts
+
+
+def work_main(argv: List[str]):
+    parser = argparse.ArgumentParser(prog='lwi-label-nhd-streams work',
+                                     description=('Label watersheds of a task queue (see the enqueue command) until '
+                                                  'all are done or failed. Run on as many nodes as needed; workers '
+                                                  'claim tasks largest first, and the tasks of workers that stop '
+                                                  'heartbeating are retried.'))
+    parser.add_argument('-q', '--queue', required=True, help='Directory of the task queue.')
+    parser.add_argument('-f', '--flowline',
+                        help=('Path to SQLite file containing NHDPlus flowline geometries. '
+                              'If NHDPlus HR is specified, the SQLite file must also contain '
+                              'NHDPlusFlowlineVAA, and NHDPlusFlow. '
+                              'Required unless a network cache is specified.'))
+    parser.add_argument('-p', '--plusflow',
+                        help=('Path to SQLite file containing NHDPlus PlusFlow table. '
+                              'Only required if NHDPlus HR is NOT specified.'))
+    parser.add_argument('-c', '--network_cache',
+                        help=('Path to network cache file created by the compile command to read the NHDPlus '
+                              'network from instead of the SQLite files.'))
+    parser.add_argument('-n', '--num_workers', type=int, default=multiprocessing.cpu_count(),
+                        help=('Number of worker processes to run on this node. '
+                              f"Defaults to {multiprocessing.cpu_count()} on this machine."))
+    parser.add_argument('--flowline_cache_size', type=int, default=DEFAULT_FLOWLINE_CACHE_SIZE,
+                        help=('Maximum number of flowlines each worker caches across the watersheds it labels. '
+                              f"Default: {DEFAULT_FLOWLINE_CACHE_SIZE}"))
+    args = parser.parse_args(argv)
+    if not args.flowline and not args.network_cache:
+        parser.error('one of -f/--flowline or -c/--network_cache is required.')
+    if args.num_workers < 1:
+        parser.error('--num_workers must be at least 1.')
+    try:
+        queue = TaskQueue(args.queue)
+    except (FileNotFoundError, ValueError) as e:
+        parser.error(str(e))
+    # Check that the output format's requirements (e.g. pyarrow) are met before any tasks are claimed
+    try:
+        OUTPUT_SINKS[staging_format(queue.options['output_format'])](args.queue)
+    except ImportError as e:
+        parser.error(str(e))
+
+    worker_args = (args.queue, args.flowline, args.plusflow, args.network_cache, args.flowline_cache_size)
+    if args.num_workers == 1:
+        _run_queue_worker(*worker_args)
+        return
+    workers = [multiprocessing.Process(target=_run_queue_worker, args=worker_args) for _ in range(args.num_workers)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    if any(worker.exitcode != 0 for worker in workers):
+        sys.exit('One or more workers exited abnormally, their tasks will be retried once their leases expire.')
+
+
+def _format_queue_status(queue: TaskQueue, states: Dict[str, str]) -> str:
+    counts = Counter(states.values())
+    lines = [f"{len(states)} watersheds: " + ', '.join(f"{counts[state]} {state}" for state in TASK_STATES)]
+    for key in sorted(k for k, state in states.items() if state == FAILED):
+        try:
+            error = queue.read_failure(key)['error'].strip().splitlines()[-1]
+        except FileNotFoundError:
+            error = 'Lease expired, no attempts left.'
+        lines.append(f"  {key} failed: {error}")
+    return '\n'.join(lines) + '\n'
+
+
+def status_main(argv: List[str]):
+    parser = argparse.ArgumentParser(prog='lwi-label-nhd-streams status',
+                                     description='Report the number of tasks of a task queue in each state.')
+    parser.add_argument('-q', '--queue', required=True, help='Directory of the task queue.')
+    args = parser.parse_args(argv)
+    try:
+        queue = TaskQueue(args.queue)
+    except (FileNotFoundError, ValueError) as e:
+        parser.error(str(e))
+    print(_format_queue_status(queue, queue.states()), end='')
+
+
+def merge_main(argv: List[str]):
+    parser = argparse.ArgumentParser(prog='lwi-label-nhd-streams merge',
+                                     description=('Combine the output and logs of the watersheds labeled by the '
+                                                  'workers of a task queue into an output directory, with its '
+                                                  'manifest and label index, as if labeled by a single run.'))
+    parser.add_argument('-q', '--queue', required=True, help='Directory of the task queue.')
+    parser.add_argument('-o', '--output', default=OUTPUT_PREFIX,
+                        help=f"Output directory to merge into. Default: {OUTPUT_PREFIX}")
+    parser.add_argument('--label_index', action='store_true',
+                        help='Also write labeled streams to the label index. Default: False', default=False)
+    parser.add_argument('--metrics',
+                        help='Write the performance metrics of each watershed, as recorded by workers, to this file.')
+    parser.add_argument('--partial', action='store_true',
+                        help=('Merge the watersheds that are done even if others are not, rather than exiting with '
+                              'an error. Default: False'),
+                        default=False)
+    args = parser.parse_args(argv)
+    try:
+        queue = TaskQueue(args.queue)
+    except (FileNotFoundError, ValueError) as e:
+        parser.error(str(e))
+    states = queue.states()
+    if any(state != DONE for state in states.values()):
+        print(_format_queue_status(queue, states), end='')
+        if not args.partial:
+            sys.exit('Not all watersheds are done, add --partial to merge those that are.')
+
+    output_format = queue.options['output_format']
+    base32 = queue.options['base32']
+    os.makedirs(args.output, exist_ok=True)
+    try:
+        sinks = get_output_sinks(output_format, args.output, args.label_index)
+    except ImportError as e:
+        parser.error(str(e))
+    for sink in sinks:
+        sink.prepare()
+    manifest = load_manifest(args.output)
+    metrics_file = open(args.metrics, 'w', encoding='utf-8') if args.metrics else None
+    try:
+        for task, result in merge_results(queue, sinks, args.output):
+            ws_code, huc8 = task['ws'][0], task['ws'][1]
+            log_file = f"{args.output}/{ws_code}_{huc8}.txt"
+            manifest[manifest_key(ws_code, huc8)] = make_manifest_entry(
+                ws_code, huc8, base32, output_format, result['entry']['network_digest'],
+                _output_checksums(sinks, ws_code, huc8, log_file))
+            if metrics_file is not None and result['metrics'] is not None:
+                write_metrics(metrics_file, result['metrics'])
+    finally:
+        if metrics_file is not None:
+            metrics_file.close()
+        for sink in sinks:
+            sink.close()
+    save_manifest(args.output, manifest)
+    print(f"Merged {sum(state == DONE for state in states.values())} watersheds into {args.output}.")
+
+
+def _collect_results(results: Iterable[Tuple[dict, Optional[dict]]], metrics_file=None) -> List[dict]:
+    """
+    Collect manifest entries from results of do_label_streams_for_huc8(), writing metrics, as each watershed
+    finishes, to metrics_file if not None.
+    """
+    entries = []
+    for entry, metrics in results:
+        entries.append(entry)
+        if metrics_file is not None and metrics is not None:
+            write_metrics(metrics_file, metrics)
+    return entries
+
+
+COMMANDS = {
+    'prepare': prepare_main,
+    'extract': extract_main,
+    'compile': compile_main,
+    'serve': serve_main,
+    'query': query_main,
+    'synthesize': synthesize_main,
+    'benchmark': benchmark_main,
+    'diff': diff_main,
+    'reencode': reencode_main,
+    'export': export_main,
+    'enqueue': enqueue_main,
+    'work': work_main,
+    'status': status_main,
+    'merge': merge_main
+}
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] in COMMANDS:
+        COMMANDS[sys.argv[1]](sys.argv[2:])
+        return
+
+    parser = argparse.ArgumentParser(description='LWI Stream Naming Convention Example code',
+                                     epilog=f"Other commands: {', '.join(COMMANDS)} (use "
+                                            f"'lwi-label-nhd-streams COMMAND --help' for details).")
+    parser.add_argument('-f', '--flowline',
+                        help=('Path to SQLite file containing NHDPlus flowline geometries. '
+                              'If NHDPlus HR is specified, the SQLite file must also contain '
+                              'NHDPlusFlowlineVAA, and NHDPlusFlow. '
+                              'Required unless a network cache is specified.'))
+    parser.add_argument('-p', '--plusflow',
+                        help=('Path to SQLite file containing NHDPlus PlusFlow table. '
+                              'Only required if NHDPlus HR is NOT specified.'))
+    parser.add_argument('-c', '--network_cache',
+                        help=('Path to network cache file created by the compile command to read the NHDPlus '
+                              'network from instead of the SQLite files.'))
     parser.add_argument('-w', '--watersheds', type=str, default='input/LWI_watersheds.csv',
                         help=('Path to CSV file containing watershed definitions that controls the '
                               'HUC8 watersheds whose NHD flowlines are to be labeled.'))
     parser.add_argument('-n', '--num_threads', type=int, default=multiprocessing.cpu_count(),
                         help=('Number of threads to use to process watersheds. '
                               f"Defaults to {multiprocessing.cpu_count()} on this machine."))
+    parser.add_argument('-m', '--memory_budget', type=float,
+                        help=('Limit the number of watersheds processed at once so that their estimated total '
+                              'memory use (in MB) stays within this budget. Default: no limit'))
     parser.add_argument('--nhdhr', action='store_true', help='Use NHDPlus HR', default=False)
     parser.add_argument('--base32', action='store_true',
                         help='Encode stream reach IDs as Crockford base32 instead of hexadecimal. Default: True',
@@ -574,7 +1930,108 @@ def main():
     parser.add_argument('--hexadecimal', action='store_true',
                         help='Encode stream reach IDs as hexadecimal instead of Crockford base32. Default: False',
                         default=False)
+    parser.add_argument('--output_format', '--output-format', choices=list(OUTPUT_SINKS), default='csv',
+                        help=('Format of output: csv (one CSV file per watershed), sqlite (one indexed table in '
+                              'output/stream_labels.sqlite for all watersheds), or parquet (one Parquet file per '
+                              'watershed, requires pyarrow). Default: csv'))
+    parser.add_argument('--label_index', action='store_true',
+                        help=(f"Also write labeled streams to the label index ({DEFAULT_LABEL_INDEX}) used by the "
+                              'query command, unless the output format is sqlite. Each watershed is then held in '
+                              'memory while written, and written twice. Default: False'),
+                        default=False)
+    parser.add_argument('--metrics', nargs='?', const=os.path.join(OUTPUT_PREFIX, DEFAULT_METRICS_FILE),
+                        help=('Write performance metrics of each watershed (time and CPU time of each stage, SQL '
+                              'queries, reaches visited, traversal depth, label counts, and peak memory) as JSON '
+                              f"lines to this file. Default: {os.path.join(OUTPUT_PREFIX, DEFAULT_METRICS_FILE)} "
+                              'if no file is specified'))
+    parser.add_argument('--profile_dir',
+                        help=('Directory to write a cProfile dump ({ws_code}_{huc8}.prof) of labeling each '
+                              'watershed to.'))
+    parser.add_argument('--flowline_cache_size', type=int, default=DEFAULT_FLOWLINE_CACHE_SIZE,
+                        help=('Maximum number of flowlines each worker caches across the '
+                              'watersheds it labels, so that flowlines shared by neighboring watersheds are queried '
+                              f"once. 0 disables the cache. Default: {DEFAULT_FLOWLINE_CACHE_SIZE}"))
+    parser.add_argument('--subtree_workers', type=int, default=1,
+                        help=('Number of processes to label the subtrees of the root flowlines of each large '
+                              f"watershed (of at least {MIN_PARALLEL_LABELING_FLOWLINES} flowlines) on, so that a "
+                              'single large watershed can use more than one core. Labels are identical to those '
+                              'of labeling serially. Watersheds are labeled serially unless this (capped at the '
+                              f"number of cores) is at least {MIN_PARALLEL_LABELING_WORKERS}, as merging subtrees "
+                              'takes most of the time saved on fewer. Requires -n 1. Default: 1'))
+    parser.add_argument('--pipeline', action='store_true',
+                        help=('Pipeline the watersheds processed by each worker: load the next watershed in a '
+                              'background thread while labeling the current one, and write output in another. '
+                              'Default: False'),
+                        default=False)
+    parser.add_argument('--region', nargs='*', metavar='HUC',
+                        help=('Load the network of a whole region from the NHDPlus databases once, find the root '
+                              'flowlines of all of its watersheds in one pass, and label each watershed from the '
+                              'region network in memory. The region is made up of the HUCs specified (e.g. HUC4s, '
+                              'in which case only watersheds within them are labeled), or if none are, all '
+                              'watersheds in the watershed definition file. Labels are the same as those of '
+                              'watersheds loaded one at a time.'))
+    parser.add_argument('--hydroseq', action='store_true',
+                        help=('Load each watershed\'s network from the hydrologic sequence numbers in the NHDPlus '
+                              'value added attributes (hydroseq, dnhydroseq, and dnminorhyd) of the flowline '
+                              'database rather than from the flow tables, which are not needed. NHDPlus V2 labels '
+                              'are the same as those of the flow tables. Default: False'),
+                        default=False)
+    parser.add_argument('--shared_memory', action='store_true',
+                        help=('Load the network of all watersheds to be labeled (or of the region given by --region) '
+                              'from the NHDPlus databases once, into shared memory, which worker processes label '
+                              'watersheds from without copying it or querying the databases, so that memory use '
+                              'does not grow with the number of workers. Requires Python 3.8 or later. Labels are '
+                              'the same as those of watersheds loaded one at a time. Default: False'),
+                        default=False)
+    parser.add_argument('--force', action='store_true',
+                        help=('Label all watersheds, rather than only those whose NHDPlus subnetwork, watershed '
+                              'code, label encoding, or output format have changed since the previous run. '
+                              'Default: False'),
+                        default=False)
     args = parser.parse_args()
+    if not args.flowline and not args.network_cache:
+        parser.error('one of -f/--flowline or -c/--network_cache is required.')
+    if args.flowline_cache_size < 0:
+        parser.error('--flowline_cache_size must not be negative.')
+    if args.subtree_workers < 1:
+        parser.error('--subtree_workers must be at least 1.')
+    if args.subtree_workers > 1 and args.num_threads > 1:
+        parser.error('--subtree_workers requires -n 1, as watersheds are labeled in a pool of worker processes.')
+    if args.pipeline and args.subtree_workers > 1:
+        parser.error('--pipeline can\'t be used with --subtree_workers, as subtree labeling processes would be '
+                     'started while pipeline threads run.')
+    if args.hydroseq:
+        if args.network_cache or not args.flowline:
+            parser.error('--hydroseq loads the NHDPlus flowline database (-f/--flowline), it can\'t be used with '
+                         '-c/--network_cache.')
+        if args.region is not None:
+            parser.error('--hydroseq can\'t be used with --region, which loads regions from the flow tables.')
+        missing = missing_hydroseq_columns(args.flowline, args.nhdhr)
+        if missing:
+            parser.error(f"--hydroseq requires VAA columns {', '.join(missing)}, which are missing from "
+                         f"{args.flowline}.")
+    if args.shared_memory:
+        if args.network_cache:
+            parser.error('--shared_memory loads the NHDPlus databases, it can\'t be used with -c/--network_cache, '
+                         'which is already shared by worker processes.')
+        if args.hydroseq:
+            parser.error('--shared_memory can\'t be used with --hydroseq, as networks are loaded from the flow '
+                         'tables.')
+    if args.region is not None:
+        if args.network_cache:
+            parser.error('--region loads the NHDPlus databases, it can\'t be used with -c/--network_cache.')
+        for huc in args.region:
+            if not huc.isdigit() or len(huc) > 8:
+                parser.error(f"Invalid HUC {huc} in --region.")
+    # Prepare output (e.g. create the output database) once, before any watersheds are labeled. Sinks are closed
+    # so that worker processes don't inherit their database connections.
+    try:
+        sinks = get_output_sinks(args.output_format, OUTPUT_PREFIX, args.label_index)
+    except ImportError as e:
+        parser.error(str(e))
+    for sink in sinks:
+        sink.prepare()
+        sink.close()
 
     flowline_path = args.flowline
     plusflow_path = None
@@ -587,16 +2044,116 @@ def main():
 
     # Load watershed data
     ws_data = load_watersheds_data(args.watersheds)
-
+    # Load manifest of previous run so that unchanged watersheds can be skipped
+    previous_manifest = {} if args.force else load_manifest(OUTPUT_PREFIX)
+
+    region = None
+    shared_network = None
+    if args.region is not None or args.shared_memory:
+        hucs = args.region or None
+        if hucs:
+            ws_data = [ws for ws in ws_data if any(ws[1].startswith(huc) for huc in hucs)]
+        print(f"Loading region {', '.join(hucs or [ws[1] for ws in ws_data])}...")
+        with NetworkSource(flowline_path, plusflow_path, args.nhdhr) as source:
+            region = source.load_region_network([ws[1] for ws in ws_data], hucs)
+        print(f"Loaded {len(region)} flowlines.")
+        if args.shared_memory:
+            # Pack the region network into shared memory, and free it before any worker processes are started
+            try:
+                shared_network = SharedNetworkCache.create(region.network)
+            except ImportError as e:
+                parser.error(str(e))
+            region = None
+        else:
+            find_region_root_flowlines(region)
+            # Set the region network of this process for synchronous runs, and of worker processes (via the pool
+            # initializer) for parallel runs
+            init_worker_region(region)
+    try:
+        _label_watersheds(args, ws_data, previous_manifest, flowline_path, plusflow_path, use_base32, region,
+                          shared_network)
+    finally:
+        if shared_network is not None:
+            shared_network.close()
+
+
+def _label_watersheds(args, ws_data: List[Tuple[str, str, str]], previous_manifest: dict, flowline_path: str,
+                      plusflow_path: str, use_base32: bool, region: Optional[RegionNetwork],
+                      shared_network: Optional[SharedNetworkCache]):
+    """
+    Label the streams of each of ws_data, serially or in a pool of worker processes, and save the manifest of the run.
+
+    :param region: Region network to label watersheds from, if any (see init_worker_region())
+    :param shared_network: Network in shared memory to label watersheds from, if any (see
+        init_worker_shared_network())
+    """
+    global _shared_network
+    shared = shared_network is not None
+
+    if args.pipeline:
+        # Each task is a batch of watersheds, pipelined by a worker
+        task_func = parallel_do_label_streams_for_huc8s
+        watersheds = [(ws, previous_manifest.get(manifest_key(ws[0], ws[1]))) for ws in ws_data]
+        common_args = (flowline_path, plusflow_path, args.nhdhr, use_base32, args.network_cache, args.output_format,
+                       args.label_index, args.metrics is not None, args.profile_dir,
+                       args.flowline_cache_size, region is not None, args.hydroseq, shared)
+        par_args = [(watersheds,) + common_args]
+    else:
+        task_func = parallel_do_label_streams_for_huc8
+        par_args = [(ws, flowline_path, plusflow_path, args.nhdhr, use_base32, args.network_cache,
+                     previous_manifest.get(manifest_key(ws[0], ws[1])), args.output_format, args.label_index,
+                     args.metrics is not None, args.profile_dir, args.flowline_cache_size, region is not None,
+                     args.subtree_workers, args.hydroseq, shared)
+                    for ws in ws_data]
+    if args.profile_dir:
+        os.makedirs(args.profile_dir, exist_ok=True)
+    metrics_file = None
+    if args.metrics:
+        metrics_file = open(args.metrics, 'w', encoding='utf-8')
     if args.num_threads > 1:
-        # Parallel
-        with(multiprocessing.Pool(args.num_threads)) as p:
-            par_args = [(ws, flowline_path, plusflow_path, args.nhdhr, use_base32) for ws in ws_data]
-            p.map(parallel_do_label_streams_for_huc8, par_args)
+        # Parallel: estimate the size of each watershed so that the largest are processed first. The network
+        # source used for this is closed before the pool is created so that workers don't inherit its connections.
+        if region is not None:
+            sizes = [region.num_flowlines(ws[1]) for ws in ws_data]
+            initializer, initargs = init_worker_region, (region,)
+        elif shared:
+            sizes = [len(shared_network.huc8_range(ws[1])) for ws in ws_data]
+            initializer, initargs = init_worker_shared_network, (shared_network.name,)
+        else:
+            with NetworkSource(flowline_path, plusflow_path, args.nhdhr, args.network_cache,
+                               hydroseq=args.hydroseq) as source:
+                sizes = estimate_sizes(source.count_flowlines, [ws[1] for ws in ws_data])
+            initializer, initargs = init_worker_network_source, (flowline_path, plusflow_path, args.nhdhr,
+                                                                 args.network_cache, args.flowline_cache_size,
+                                                                 args.hydroseq)
+        if args.pipeline:
+            # Deal watersheds into at least one batch per worker, each small enough for the workers to balance
+            num_batches = max(args.num_threads, -(-len(watersheds) // PIPELINE_BATCH_SIZE))
+            batches, sizes = deal_batches(watersheds, sizes, num_batches, PIPELINE_MAX_IN_FLIGHT)
+            par_args = [(batch,) + common_args for batch in batches]
+        memory_budget = None
+        if args.memory_budget:
+            memory_budget = int(args.memory_budget * 1024 * 1024)
+        with(multiprocessing.Pool(args.num_threads, initializer=initializer, initargs=initargs)) as p:
+            results = imap_scheduled(p, task_func, par_args, sizes, args.num_threads, memory_budget)
+            if args.pipeline:
+                results = itertools.chain.from_iterable(results)
+            entries = _collect_results(results, metrics_file)
     else:
-        # Synchronous
-        for ws in ws_data:
-            do_label_streams_for_huc8(ws, flowline_path, plusflow_path, args.nhdhr, args.base32)
+        # Synchronous. Worker processes attach to the shared network themselves (via the pool initializer), so
+        # this process's view of it is only set for synchronous runs.
+        _shared_network = shared_network
+        results = map(task_func, par_args)
+        if args.pipeline:
+            results = itertools.chain.from_iterable(results)
+        entries = _collect_results(results, metrics_file)
+    if metrics_file is not None:
+        metrics_file.close()
+    # Watersheds not labeled by this run (e.g. not in its watershed definition file) keep their entries, which are
+    # checked against their output when they are next labeled (see is_up_to_date())
+    manifest = load_manifest(OUTPUT_PREFIX) if args.force else dict(previous_manifest)
+    manifest.update((manifest_key(e['ws_code'], e['huc8']), e) for e in entries)
+    save_manifest(OUTPUT_PREFIX, manifest)
 
 
 if __name__ == '__main__':
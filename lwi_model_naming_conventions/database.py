@@ -0,0 +1,130 @@
+# Copyright (C) 2021-present State of Louisiana, Division of Administration, Office of Community Development.
+# All rights reserved. Licensed under the GPLv3 License. See LICENSE.txt in the project root for license information.
+
+"""
+Preparation and tuning of the NHDPlus SQLite databases.
+
+The prepare command creates covering indexes for every query used to load a HUC8 (see network.load_huc8_network()
+and network.load_huc8_network_hr()), then runs ANALYZE so that the query planner uses them. With the hydroseq
+option, it also creates covering indexes for loading HUC8s from the VAA routing columns instead of the flow tables
+(see hydroseq.py). Reachcode indexes use the NOCASE collation so that "reachcode like ?" HUC8 prefix queries are
+index range scans (SQLite's LIKE optimization requires it while case_sensitive_like is off). With these indexes,
+every HUC8 query is answered from an index without reading table rows.
+
+Prepared databases are then opened read-only and immutable (as labeling never writes to them, SQLite can skip
+locking and change detection) and memory mapped.
+"""
+
+import os
+import sqlite3
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+# Bytes of each database to memory map
+DEFAULT_MMAP_SIZE = 1024 * 1024 * 1024
+# Number of prepared statements cached per connection. Loading a HUC8 issues "in" queries with varying numbers of
+# parameters (see network.QUERY_CHUNK_SIZE), each of which is a separate statement.
+DEFAULT_CACHED_STATEMENTS = 256
+
+# Covering indexes as (name, table, columns)
+V2_FLOWLINE_INDEXES = [
+    ('nhd_flow_reachcode_cover_idx', 'nhdflowline_network',
+     'reachcode COLLATE NOCASE, comid, streamleve, streamorde, divergence, startflag'),
+    ('nhd_flow_comid_cover_idx', 'nhdflowline_network', 'comid, reachcode, streamleve, streamorde, divergence')
+]
+V2_PLUSFLOW_INDEXES = [
+    ('nhd_plusflow_fromcomid_cover_idx', 'plusflow', 'fromcomid, tocomid'),
+    ('nhd_plusflow_tocomid_cover_idx', 'plusflow', 'tocomid, fromcomid')
+]
+HR_INDEXES = [
+    ('nhdflowline_reachcode_cover_idx', 'nhdflowline', 'reachcode COLLATE NOCASE, nhdplusid'),
+    ('nhdflowline_nhdplusid_cover_idx', 'nhdflowline', 'nhdplusid, reachcode'),
+    ('nhdplusflowlinevaa_nhdplusid_cover_idx', 'nhdplusflowlinevaa',
+     'nhdplusid, streamleve, streamorde, divergence, startflag'),
+    ('nhdplusflowlinevaa_reachcode_cover_idx', 'nhdplusflowlinevaa', 'reachcode COLLATE NOCASE, startflag, nhdplusid'),
+    ('nhdplusflow_fromnhdpid_cover_idx', 'nhdplusflow', 'fromnhdpid, tonhdpid'),
+    ('nhdplusflow_tonhdpid_cover_idx', 'nhdplusflow', 'tonhdpid, fromnhdpid')
+]
+V2_HYDROSEQ_INDEXES = [
+    ('nhd_flow_reachcode_hydroseq_cover_idx', 'nhdflowline_network',
+     'reachcode COLLATE NOCASE, hydroseq, comid, streamleve, streamorde, divergence, startflag, dnhydroseq, '
+     'dnminorhyd'),
+    ('nhd_flow_hydroseq_cover_idx', 'nhdflowline_network',
+     'hydroseq, comid, reachcode, streamleve, streamorde, divergence, startflag')
+]
+HR_HYDROSEQ_INDEXES = [
+    ('nhdplusflowlinevaa_nhdplusid_hydroseq_cover_idx', 'nhdplusflowlinevaa',
+     'nhdplusid, streamleve, streamorde, divergence, startflag, hydroseq, dnhydroseq, dnminorhyd'),
+    ('nhdplusflowlinevaa_hydroseq_cover_idx', 'nhdplusflowlinevaa',
+     'hydroseq, nhdplusid, streamleve, streamorde, divergence, startflag')
+]
+
+
+def connect_nhdplus(path: str, mmap_size: int = DEFAULT_MMAP_SIZE,
+                    cached_statements: int = DEFAULT_CACHED_STATEMENTS) -> sqlite3.Connection:
+    """
+    Open an NHDPlus database read-only and immutable, memory mapping up to mmap_size bytes of it. The database must
+    not be modified while it is open. The connection may be used by a thread other than the one that opened it (e.g.
+    a pipeline's prefetch thread), but only by one thread at a time.
+    """
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"NHDPlus database {path} not found.")
+    conn = sqlite3.connect(f"{Path(path).resolve().as_uri()}?mode=ro&immutable=1", uri=True,
+                           cached_statements=cached_statements, check_same_thread=False)
+    conn.execute(f"pragma mmap_size={int(mmap_size)}")
+    return conn
+
+
+def _tables(conn: sqlite3.Connection) -> set:
+    return {row[0].lower() for row in conn.execute("select name from sqlite_master where type='table'")}
+
+
+def _indexes(conn: sqlite3.Connection) -> set:
+    return {row[0].lower() for row in conn.execute("select name from sqlite_master where type='index'")}
+
+
+def prepare_database(path: str, indexes: List[Tuple[str, str, str]], analyze: bool = True) -> List[str]:
+    """
+    Create indexes missing from the database in path, and run ANALYZE.
+
+    :return: Names of the indexes created
+    :raises ValueError: If a table to be indexed does not exist
+    """
+    conn = sqlite3.connect(path)
+    try:
+        tables = _tables(conn)
+        existing = _indexes(conn)
+        created = []
+        for name, table, columns in indexes:
+            if table not in tables:
+                raise ValueError(f"Table {table} not found in {path}.")
+            if name in existing:
+                continue
+            conn.execute(f"create index {name} on {table} ({columns})")
+            created.append(name)
+        conn.commit()
+        if analyze:
+            conn.execute('analyze')
+            conn.commit()
+        return created
+    finally:
+        conn.close()
+
+
+def prepare_nhdplus(flowline_path: str, plusflow_path: str = None, nhd_hr: bool = False,
+                    analyze: bool = True, hydroseq: bool = False) -> Dict[str, List[str]]:
+    """
+    Prepare the NHDPlus V2 flowline and PlusFlow databases, or the NHDPlus HR database, for labeling.
+
+    :param hydroseq: Whether to also create the indexes used to load HUC8s from the VAA routing columns
+    :return: Names of the indexes created, keyed by database path
+    """
+    if nhd_hr:
+        return {flowline_path: prepare_database(flowline_path,
+                                                HR_INDEXES + (HR_HYDROSEQ_INDEXES if hydroseq else []), analyze)}
+    created = {flowline_path: prepare_database(flowline_path,
+                                               V2_FLOWLINE_INDEXES + (V2_HYDROSEQ_INDEXES if hydroseq else []),
+                                               analyze)}
+    created[plusflow_path] = created.get(plusflow_path, []) + \
+        prepare_database(plusflow_path, V2_PLUSFLOW_INDEXES, analyze)
+    return created
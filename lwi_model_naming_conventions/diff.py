@@ -0,0 +1,198 @@
+# Copyright (C) 2021-present State of Louisiana, Division of Administration, Office of Community Development.
+# All rights reserved. Licensed under the GPLv3 License. See LICENSE.txt in the project root for license information.
+
+"""
+Comparison of the stream labels of two labeling runs, e.g. before and after changing traversal rules or moving to a
+new NHDPlus release.
+
+The outputs of both runs are read back from their sinks (see sinks.OutputSink.read_huc8()) and joined on COMID one
+HUC8 at a time: the reaches of a HUC8 in the old output are loaded into a dict keyed by COMID, then the reaches of
+the HUC8 in the new output are streamed past it. Memory use is therefore bounded by the size of the largest HUC8,
+however many HUC8s are compared. A reach whose HUC8 differs between runs is reported as removed from one HUC8 and
+added to the other.
+
+Each relabeled reach is attributed to the hierarchy level at which its old and new labels first differ, counting
+the two-character segments of fully qualified labels: the watershed code (level 0), main stem (level 1), first
+order stream (level 2), and second through sixth order streams (levels 3 through 7). A stream renumbered at a level
+is a distinct pair of old and new label prefixes up to and including that level, e.g. main stem 03 of watershed AA
+renumbered to 04 is a single renumbering at level 1, however many reaches and tributaries it has. Base32 encodes
+level numbers below 32 as a single character, so levels of base32 labels are approximate beyond the first
+difference.
+"""
+
+import io
+import csv
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+
+from lwi_model_naming_conventions.sinks import OutputSink, OUTPUT_STREAM_LABEL, OUTPUT_COMID
+
+# Width, in characters, of each level of a fully qualified stream label
+LEVEL_WIDTH = 2
+LEVEL_NAMES = ['watershed', 'main stem', 'first order', 'second order', 'third order', 'fourth order',
+               'fifth order', 'sixth order']
+
+ADDED = 'added'
+REMOVED = 'removed'
+RELABELED = 'relabeled'
+CHANGE_FIELDS = ['huc8', 'comid', 'change', 'old_stream_label', 'new_stream_label', 'level']
+SUMMARY_FIELDS = ['huc8', 'old_ws_code', 'new_ws_code', 'old_reaches', 'new_reaches', 'unchanged', ADDED, REMOVED,
+                  RELABELED]
+
+
+def comid_key(comid: Union[str, int, float]) -> Union[int, float]:
+    """
+    :return: comid as a number, so that COMIDs (and NHDPlusIDs, which are floating point) read back as strings from
+        one sink join with those read back as numbers from another
+    """
+    if isinstance(comid, str):
+        try:
+            return int(comid)
+        except ValueError:
+            comid = float(comid)
+    if isinstance(comid, float) and comid.is_integer():
+        return int(comid)
+    return comid
+
+
+def change_level(old_label: str, new_label: str) -> int:
+    """
+    :return: Hierarchy level of the first difference between two different fully qualified stream labels
+    """
+    n = min(len(old_label), len(new_label))
+    i = 0
+    while i < n and old_label[i] == new_label[i]:
+        i += 1
+    return min(i // LEVEL_WIDTH, len(LEVEL_NAMES) - 1)
+
+
+def level_name(level: int) -> str:
+    return LEVEL_NAMES[level]
+
+
+def diff_huc8(huc8: str, old_ws_code: Optional[str], old_rows: Iterable[Tuple], new_ws_code: Optional[str],
+              new_rows: Iterable[Tuple], changes: csv.writer = None) -> dict:
+    """
+    Compare the labeled reaches of a HUC8 in two outputs, writing a row of CHANGE_FIELDS for each added, removed, or
+    relabeled reach to changes, if not None.
+
+    :return: Summary of differences, a dict of SUMMARY_FIELDS, plus 'relabeled_by_level' (number of reaches
+        relabeled at each level, keyed by level) and 'renumbered_by_level' (number of streams renumbered at each
+        level, keyed by level)
+    """
+    old_labels = {comid_key(row[OUTPUT_COMID]): row[OUTPUT_STREAM_LABEL] for row in old_rows}
+    num_old = len(old_labels)
+    num_new = 0
+    unchanged = 0
+    added = 0
+    relabeled_by_level: Dict[int, int] = {}
+    renumbered: Dict[int, set] = {}
+    for row in new_rows:
+        num_new += 1
+        comid = comid_key(row[OUTPUT_COMID])
+        new_label = row[OUTPUT_STREAM_LABEL]
+        old_label = old_labels.pop(comid, None)
+        if old_label is None:
+            added += 1
+            if changes is not None:
+                changes.writerow((huc8, comid, ADDED, None, new_label, None))
+        elif old_label == new_label:
+            unchanged += 1
+        else:
+            level = change_level(old_label, new_label)
+            relabeled_by_level[level] = relabeled_by_level.get(level, 0) + 1
+            end = (level + 1) * LEVEL_WIDTH
+            renumbered.setdefault(level, set()).add((old_label[:end], new_label[:end]))
+            if changes is not None:
+                changes.writerow((huc8, comid, RELABELED, old_label, new_label, level))
+    if changes is not None:
+        for comid, old_label in old_labels.items():
+            changes.writerow((huc8, comid, REMOVED, old_label, None, None))
+    return {
+        'huc8': huc8,
+        'old_ws_code': old_ws_code,
+        'new_ws_code': new_ws_code,
+        'old_reaches': num_old,
+        'new_reaches': num_new,
+        'unchanged': unchanged,
+        ADDED: added,
+        REMOVED: len(old_labels),
+        RELABELED: sum(relabeled_by_level.values()),
+        'relabeled_by_level': dict(sorted(relabeled_by_level.items())),
+        'renumbered_by_level': {level: len(pairs) for level, pairs in sorted(renumbered.items())}
+    }
+
+
+def _ws_codes_by_huc8(sink: OutputSink) -> Dict[str, List[str]]:
+    ws_codes = {}
+    for ws_code, huc8 in sink.huc8s():
+        ws_codes.setdefault(huc8, []).append(ws_code)
+    return ws_codes
+
+
+def _read_huc8(sink: OutputSink, huc8: str, ws_codes: List[str]) -> Iterable[Tuple]:
+    for ws_code in ws_codes:
+        yield from sink.read_huc8(ws_code, huc8)
+
+
+def diff_outputs(old: OutputSink, new: OutputSink, changes: csv.writer = None,
+                 huc8s: Iterable[str] = None) -> List[dict]:
+    """
+    Compare the labeled reaches of every HUC8 in either of two outputs (or only those in huc8s), writing a row of
+    CHANGE_FIELDS for each added, removed, or relabeled reach to changes, if not None.
+
+    :return: Summary of differences in each HUC8 (see diff_huc8()), sorted by HUC8
+    """
+    old_ws_codes = _ws_codes_by_huc8(old)
+    new_ws_codes = _ws_codes_by_huc8(new)
+    if huc8s is None:
+        huc8s = old_ws_codes.keys() | new_ws_codes.keys()
+    results = []
+    for huc8 in sorted(huc8s):
+        old_codes = old_ws_codes.get(huc8, [])
+        new_codes = new_ws_codes.get(huc8, [])
+        results.append(diff_huc8(huc8, ','.join(old_codes) or None, _read_huc8(old, huc8, old_codes),
+                                 ','.join(new_codes) or None, _read_huc8(new, huc8, new_codes), changes))
+    return results
+
+
+def has_differences(results: List[dict]) -> bool:
+    return any(r[ADDED] or r[REMOVED] or r[RELABELED] or r['old_ws_code'] != r['new_ws_code'] for r in results)
+
+
+def total_differences(results: List[dict]) -> dict:
+    """
+    :return: Sums of the counts of results, with relabeled_by_level and renumbered_by_level summed by level
+    """
+    totals = {name: sum(r[name] for r in results) for name in SUMMARY_FIELDS[3:]}
+    for name in ('relabeled_by_level', 'renumbered_by_level'):
+        by_level = {}
+        for r in results:
+            for level, count in r[name].items():
+                by_level[level] = by_level.get(level, 0) + count
+        totals[name] = dict(sorted(by_level.items()))
+    return totals
+
+
+def format_differences(results: List[dict], all_huc8s: bool = False) -> str:
+    """
+    :param all_huc8s: Whether to list HUC8s without differences
+    """
+    buff = io.StringIO()
+    buff.write(f"{'HUC8':<10}{'ws_code':>9}{'old':>10}{'new':>10}{'unchanged':>11}{ADDED:>9}{REMOVED:>9}"
+               f"{RELABELED:>11}\n")
+    for r in results:
+        if not all_huc8s and not has_differences([r]):
+            continue
+        ws_code = r['new_ws_code'] or r['old_ws_code']
+        if r['old_ws_code'] is not None and r['new_ws_code'] is not None and r['old_ws_code'] != r['new_ws_code']:
+            ws_code = f"{r['old_ws_code']}>{r['new_ws_code']}"
+        buff.write(f"{r['huc8']:<10}{ws_code:>9}{r['old_reaches']:>10}{r['new_reaches']:>10}{r['unchanged']:>11}"
+                   f"{r[ADDED]:>9}{r[REMOVED]:>9}{r[RELABELED]:>11}\n")
+    totals = total_differences(results)
+    buff.write(f"{'total':<10}{len(results):>9}{totals['old_reaches']:>10}{totals['new_reaches']:>10}"
+               f"{totals['unchanged']:>11}{totals[ADDED]:>9}{totals[REMOVED]:>9}{totals[RELABELED]:>11}\n")
+    if totals['relabeled_by_level']:
+        buff.write(f"\n{'level':<16}{'relabeled reaches':>19}{'renumbered streams':>20}\n")
+        for level, count in totals['relabeled_by_level'].items():
+            buff.write(f"{level_name(level):<16}{count:>19}{totals['renumbered_by_level'][level]:>20}\n")
+    return buff.getvalue()
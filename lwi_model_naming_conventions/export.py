@@ -0,0 +1,228 @@
+# Copyright (C) 2021-present State of Louisiana, Division of Administration, Office of Community Development.
+# All rights reserved. Licensed under the GPLv3 License. See LICENSE.txt in the project root for license information.
+
+"""
+Export of labeled streams as a flowline layer, with geometries, that can be opened directly in GIS (rather than
+joining output CSV files to the NHDFlowline layer by hand).
+
+The labeled reaches of a labeling run's output are written to a temp table of a new database, the NHDPlus flowline
+database with geometries (a SpatiaLite database, e.g. as written by ogr2ogr, or a GeoPackage) is attached, and the
+labeled flowline layer is built by a single INSERT ... SELECT joining the labels to the source flowlines by COMID
+(NHDPlusID for NHDPlus HR). Geometries are copied by SQLite as stored in the source, so they never pass through
+Python, and no spatial SQL functions (i.e. the SpatiaLite extension) are needed.
+
+The layer is written in the format of the source, and registered in its metadata tables. Each labeled flowline keeps
+the feature ID (rowid) of its source flowline, so the layer's spatial index (an R*Tree in both formats) is built by
+copying the bounding boxes of its flowlines from the source's spatial index, again by a single INSERT ... SELECT. If
+the source has no spatial index, the layer is written without one. The triggers that update spatial indexes when
+features are edited are not created, as they call spatial SQL functions, so the layer is to be exported again rather
+than edited.
+"""
+
+import re
+import sqlite3
+from typing import Dict, Iterable, List, NamedTuple, Optional
+
+from lwi_model_naming_conventions.extract import attach_database, write_database
+from lwi_model_naming_conventions.sinks import OUTPUT_FIELDS, OutputSink, typed_rows
+
+DEFAULT_LAYER = 'stream_labels'
+
+SPATIALITE = 'spatialite'
+GEOPACKAGE = 'gpkg'
+
+GPKG_EXTENSIONS_TABLE = ('create table if not exists gpkg_extensions (table_name text, column_name text, '
+                         'extension_name text not null, definition text not null, scope text not null, '
+                         'constraint ge_tce unique (table_name, column_name, extension_name))')
+GPKG_RTREE_EXTENSION = ('gpkg_rtree_index', 'http://www.geopackage.org/spec120/#extension_rtree', 'write-only')
+
+
+class GeometrySource(NamedTuple):
+    """
+    Flowline table with geometries in an attached database.
+    """
+    format: str
+    table: str
+    id_column: str
+    id_type: str
+    geometry_column: str
+    geometry_type: str
+    srid: int
+    # Name of the table's R*Tree spatial index, if it has one
+    spatial_index: Optional[str]
+
+
+def _tables(conn: sqlite3.Connection, schema: str) -> Dict[str, str]:
+    """
+    :return: Names of the tables in schema, keyed by lower case name
+    """
+    return {row[0].lower(): row[0] for row in
+            conn.execute(f"select name from {schema}.sqlite_master where type in ('table', 'view')")}
+
+
+def _columns(conn: sqlite3.Connection, schema: str, table: str) -> List[str]:
+    return [d[0] for d in conn.execute(f'select * from {schema}."{table}" limit 0').description]
+
+
+def find_geometry_source(conn: sqlite3.Connection, path: str, table: str, id_column: str) -> GeometrySource:
+    """
+    Find the geometry column and spatial index of table in the database at path, attached to conn as src.
+
+    :raises ValueError: If the database is not a SpatiaLite database or GeoPackage, or table has no geometry column
+    """
+    tables = _tables(conn, 'src')
+    if table not in tables:
+        raise ValueError(f"Table {table} not found in {path}.")
+    table = tables[table]
+    if 'gpkg_geometry_columns' in tables:
+        source_format = GEOPACKAGE
+        row = conn.execute('select column_name, srs_id from src.gpkg_geometry_columns where lower(table_name)=?',
+                           (table.lower(),)).fetchone()
+        index_prefix = 'rtree'
+    elif 'geometry_columns' in tables:
+        source_format = SPATIALITE
+        row = conn.execute('select f_geometry_column, srid from src.geometry_columns where lower(f_table_name)=?',
+                           (table.lower(),)).fetchone()
+        index_prefix = 'idx'
+    else:
+        raise ValueError(f"{path} is not a SpatiaLite database or GeoPackage.")
+    if row is None:
+        raise ValueError(f"Table {table} in {path} has no geometry column.")
+
+    geometry_column, srid = row
+    types = {r[1].lower(): (r[1], r[2]) for r in conn.execute(f'pragma src.table_info("{table}")')}
+    if geometry_column.lower() not in types or id_column not in types:
+        raise ValueError(f"Table {table} in {path} has no {geometry_column} or {id_column} column.")
+    geometry_column, geometry_type = types[geometry_column.lower()]
+    id_column, id_type = types[id_column]
+    return GeometrySource(source_format, table, id_column, id_type, geometry_column, geometry_type or 'blob', srid,
+                          tables.get(f"{index_prefix}_{table}_{geometry_column}".lower()))
+
+
+def _load_labels(conn: sqlite3.Connection, labeled: OutputSink, huc8s: Optional[Iterable[str]]) -> int:
+    """
+    Write the labeled reaches of huc8s (all HUC8s if None) to temp table labels.
+
+    :return: Number of labeled reaches
+    :raises ValueError: If a flowline is labeled in more than one HUC8
+    """
+    huc8s = None if huc8s is None else set(huc8s)
+    conn.execute(f"create temp table labels ({', '.join(OUTPUT_FIELDS)}, primary key (comid))")
+    insert = f"insert into temp.labels values ({', '.join('?' * len(OUTPUT_FIELDS))})"
+    count = 0
+    for ws_code, huc8 in labeled.huc8s():
+        if huc8s is not None and huc8 not in huc8s:
+            continue
+        try:
+            count += conn.executemany(insert, typed_rows(labeled.read_huc8(ws_code, huc8))).rowcount
+        except sqlite3.IntegrityError:
+            raise ValueError(f"Flowlines of watershed {ws_code}, HUC8 {huc8} are also labeled in another HUC8.")
+    return count
+
+
+def _copy_table(conn: sqlite3.Connection, table: str, where: str = '', params=()):
+    """
+    Create table in the output database as it is defined in the source, and copy the source's rows matching where.
+    """
+    sql = conn.execute("select sql from src.sqlite_master where type='table' and lower(name)=?",
+                       (table,)).fetchone()
+    if sql is None:
+        raise ValueError(f"Table {table} not found in source.")
+    conn.execute(sql[0])
+    conn.execute(f"insert into main.{table} select * from src.{table} {where}", params)
+
+
+def _register_spatialite(conn: sqlite3.Connection, source: GeometrySource, layer: str, indexed: bool):
+    _copy_table(conn, 'spatial_ref_sys', 'where srid=?', (source.srid,))
+    _copy_table(conn, 'geometry_columns', 'where 0')
+    # The layout of geometry_columns differs between SpatiaLite versions, so the source's row is copied
+    cur = conn.execute('select * from src.geometry_columns where lower(f_table_name)=?', (source.table.lower(),))
+    row = dict(zip([d[0].lower() for d in cur.description], cur.fetchone()))
+    row['f_table_name'] = layer
+    row['f_geometry_column'] = source.geometry_column.lower()
+    if 'spatial_index_enabled' in row:
+        row['spatial_index_enabled'] = int(indexed)
+    conn.execute(f"insert into main.geometry_columns ({', '.join(row)}) values ({', '.join('?' * len(row))})",
+                 list(row.values()))
+
+
+def _register_geopackage(conn: sqlite3.Connection, source: GeometrySource, layer: str, spatial_index: Optional[str]):
+    for pragma in ('application_id', 'user_version'):
+        conn.execute(f"pragma main.{pragma}={int(conn.execute(f'pragma src.{pragma}').fetchone()[0])}")
+    _copy_table(conn, 'gpkg_spatial_ref_sys')
+    _copy_table(conn, 'gpkg_contents', 'where 0')
+    _copy_table(conn, 'gpkg_geometry_columns', 'where 0')
+    bounds = (None,) * 4
+    if spatial_index is not None:
+        bounds = conn.execute(f'select min(minx), min(miny), max(maxx), max(maxy) from main."{spatial_index}"')\
+            .fetchone()
+    conn.execute("insert into main.gpkg_contents (table_name, data_type, identifier, last_change, min_x, min_y, "
+                 "max_x, max_y, srs_id) values (?, 'features', ?, strftime('%Y-%m-%dT%H:%M:%fZ', 'now'), ?, ?, ?, "
+                 '?, ?)', (layer, layer, *bounds, source.srid))
+    conn.execute('insert into main.gpkg_geometry_columns (table_name, column_name, geometry_type_name, srs_id, z, m) '
+                 'select ?, column_name, geometry_type_name, srs_id, z, m from src.gpkg_geometry_columns '
+                 'where lower(table_name)=?', (layer, source.table.lower()))
+    if spatial_index is not None:
+        conn.execute(GPKG_EXTENSIONS_TABLE)
+        conn.execute('insert into main.gpkg_extensions (table_name, column_name, extension_name, definition, scope) '
+                     'values (?, ?, ?, ?, ?)', (layer, source.geometry_column, *GPKG_RTREE_EXTENSION))
+
+
+def export_labeled_flowlines(labeled: OutputSink, flowline_path: str, output_path: str, nhd_hr: bool = False,
+                             layer: str = DEFAULT_LAYER, huc8s: Iterable[str] = None) -> Dict[str, int]:
+    """
+    Export the labeled reaches in labeled, with the geometries of their flowlines in the SpatiaLite database or
+    GeoPackage at flowline_path, as a layer of a new database of the same format at output_path.
+
+    :param huc8s: HUC8s to export. Default: all HUC8s in labeled
+    :return: Counts of 'labeled' reaches, 'flowlines' exported, 'missing' labeled reaches (not found in the flowline
+        database), and 'indexed' flowlines (0 if the flowline database has no spatial index)
+    :raises ValueError: If layer is not a valid layer name, the flowline database has no flowline geometries, or a
+        flowline is labeled in more than one HUC8
+    """
+    if not re.fullmatch('[a-z_][a-z0-9_]*', layer):
+        raise ValueError(f"Layer name {layer} must be lower case letters, digits, and underscores.")
+    table, id_column = ('nhdflowline', 'nhdplusid') if nhd_hr else ('nhdflowline_network', 'comid')
+
+    def write(conn: sqlite3.Connection) -> Dict[str, int]:
+        attach_database(conn, flowline_path, 'src')
+        source = find_geometry_source(conn, flowline_path, table, id_column)
+        labeled_count = _load_labels(conn, labeled, huc8s)
+
+        # Find the feature IDs of the labeled flowlines, so that their geometries are read in source order
+        conn.execute(f"create temp table features (fid integer primary key, {', '.join(OUTPUT_FIELDS)})")
+        conn.execute(f'insert into temp.features select f.rowid, l.* from temp.labels as l '
+                     f'join src."{source.table}" as f on f."{source.id_column}"=l.comid')
+        conn.execute(f'create table main."{layer}" (fid integer primary key, stream_label text not null, '
+                     f'ws_code text not null, huc8 text not null, comid {source.id_type} not null, '
+                     'reachcode text not null, divergence integer, raw_label text, '
+                     f'"{source.geometry_column}" {source.geometry_type})')
+        conn.execute(f'insert into main."{layer}" select t.*, f."{source.geometry_column}" from temp.features as t '
+                     f'join src."{source.table}" as f on f.rowid=t.fid order by t.fid')
+
+        spatial_index = None
+        indexed = 0
+        if source.spatial_index is not None:
+            prefix = 'rtree' if source.format == GEOPACKAGE else 'idx'
+            spatial_index = f"{prefix}_{layer}_{source.geometry_column}"
+            if source.format == SPATIALITE:
+                # SpatiaLite geometry column names are lower case
+                spatial_index = spatial_index.lower()
+            index_columns = _columns(conn, 'src', source.spatial_index)
+            conn.execute(f'create virtual table main."{spatial_index}" using rtree({", ".join(index_columns)})')
+            indexed = conn.execute(f'insert into main."{spatial_index}" select i.* from main."{layer}" as o '
+                                   f'join src."{source.spatial_index}" as i on i.{index_columns[0]}=o.fid '
+                                   'order by o.fid').rowcount
+        if source.format == GEOPACKAGE:
+            _register_geopackage(conn, source, layer, spatial_index)
+        else:
+            _register_spatialite(conn, source, layer, spatial_index is not None)
+        return {
+            'labeled': labeled_count,
+            'flowlines': conn.execute(f'select count(*) from main."{layer}"').fetchone()[0],
+            'missing': conn.execute('select count(*) from temp.labels '
+                                    'where comid not in (select comid from temp.features)').fetchone()[0],
+            'indexed': indexed
+        }
+
+    return write_database(output_path, write)
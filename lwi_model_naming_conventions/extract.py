@@ -0,0 +1,177 @@
+# Copyright (C) 2021-present State of Louisiana, Division of Administration, Office of Community Development.
+# All rights reserved. Licensed under the GPLv3 License. See LICENSE.txt in the project root for license information.
+
+"""
+Extraction of the NHDPlus flowlines and flow edges needed to label a set of HUC8s into a small, attribute-only
+SQLite database.
+
+The extract holds the flowlines of the HUC8s, every flow edge to or from them, and the flowlines one hop across the
+HUC8s' boundaries (the other ends of those edges), which is everything labeling the HUC8s reads. Only the columns
+used by labeling are copied (no geometry), in the order of the source tables so that flowlines and flow edges are
+returned in the same order as from the source, and the covering indexes created by the prepare command (see
+database.py) are created. Labels of HUC8s labeled from an extract are identical to those labeled from the source.
+
+An NHDPlus V2 extract holds both the nhdflowline_network and plusflow tables, so the same file is used as both the
+flowline and PlusFlow database. An NHDPlus HR extract holds the nhdflowline, nhdplusflowlinevaa, and nhdplusflow
+tables.
+
+The copy is done by SQLite (the source databases are attached to the extract), so rows never pass through Python.
+"""
+
+import os
+import sqlite3
+from pathlib import Path
+from typing import Callable, Dict, Iterable
+
+from lwi_model_naming_conventions.database import V2_FLOWLINE_INDEXES, V2_PLUSFLOW_INDEXES, HR_INDEXES, \
+    prepare_database
+
+
+def attach_database(conn: sqlite3.Connection, path: str, name: str):
+    """
+    Attach the NHDPlus database at path to conn read-only, as name.
+    """
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"NHDPlus database {path} not found.")
+    conn.execute(f"attach database ? as {name}", (f"{Path(path).resolve().as_uri()}?mode=ro",))
+
+
+def write_database(output_path: str, write: Callable[[sqlite3.Connection], Dict[str, int]]) -> Dict[str, int]:
+    """
+    Create a database at output_path and write to it with write (e.g. an extract), removing it if write fails.
+
+    :return: Counts returned by write
+    """
+    if os.path.exists(output_path):
+        raise FileExistsError(f"{output_path} already exists.")
+    # URIs are enabled for attaching source databases read-only
+    conn = sqlite3.connect(output_path, uri=True)
+    try:
+        # The database is written once, in a single transaction
+        conn.execute('pragma journal_mode=off')
+        conn.execute('pragma synchronous=off')
+        counts = write(conn)
+        conn.commit()
+    except BaseException:
+        conn.close()
+        os.remove(output_path)
+        raise
+    conn.close()
+    return counts
+
+
+def _select_huc8_ids(conn: sqlite3.Connection, huc8s: Iterable[str], id_column: str, table: str):
+    """
+    Select the IDs of the flowlines in huc8s into temp table huc8_ids.
+    """
+    conn.execute('create temp table huc8_ids (id primary key) without rowid')
+    for huc8 in sorted(set(huc8s)):
+        conn.execute(f"insert or ignore into huc8_ids select {id_column} from {table} where reachcode like ?",
+                     (f"{huc8}%",))
+
+
+def _select_buffer_ids(conn: sqlite3.Connection, from_column: str, to_column: str, table: str):
+    """
+    Select the IDs of the flowlines in huc8_ids, and those at the other end of their flow edges (in table, already
+    extracted), into temp table extract_ids.
+    """
+    conn.execute('create temp table extract_ids (id primary key) without rowid')
+    conn.execute('insert or ignore into extract_ids select id from huc8_ids')
+    conn.execute(f"insert or ignore into extract_ids select {from_column} from main.{table}")
+    conn.execute(f"insert or ignore into extract_ids select {to_column} from main.{table}")
+
+
+def _copy_edges(conn: sqlite3.Connection, source_table: str, table: str, from_column: str, to_column: str):
+    """
+    Copy flow edges to or from flowlines in huc8_ids, in the order of the source table.
+    """
+    conn.execute(f"insert into main.{table} ({from_column}, {to_column}) "
+                 f"select {from_column}, {to_column} from {source_table} where rowid in ("
+                 f"select rowid from {source_table} where {from_column} in (select id from huc8_ids) union "
+                 f"select rowid from {source_table} where {to_column} in (select id from huc8_ids)) "
+                 'order by rowid')
+
+
+def _copy_flowlines(conn: sqlite3.Connection, source_table: str, table: str, id_column: str, columns: str):
+    """
+    Copy the columns of flowlines in extract_ids, in the order of the source table.
+    """
+    conn.execute(f"insert into main.{table} ({columns}) select {columns} from {source_table} "
+                 f"where {id_column} in (select id from extract_ids) order by rowid")
+
+
+def _count(conn: sqlite3.Connection, table: str) -> int:
+    return conn.execute(f"select count(*) from {table}").fetchone()[0]
+
+
+def extract_nhdplus_v2(flowline_path: str, plusflow_path: str, huc8s: Iterable[str], output_path: str,
+                       analyze: bool = True) -> Dict[str, int]:
+    """
+    Extract the NHDPlus V2 flowlines and PlusFlow edges needed to label huc8s into a new database at output_path.
+
+    :return: Counts of 'huc8_flowlines' (flowlines within huc8s), 'flowlines' (including those one hop across the
+        boundary), and 'edges' extracted
+    """
+    def write(conn: sqlite3.Connection) -> Dict[str, int]:
+        attach_database(conn, flowline_path, 'src_flowline')
+        attach_database(conn, plusflow_path, 'src_plusflow')
+        conn.execute(('create table nhdflowline_network (comid integer, reachcode text, streamleve integer, '
+                      'streamorde integer, divergence integer, startflag integer)'))
+        conn.execute('create table plusflow (fromcomid integer, tocomid integer)')
+        _select_huc8_ids(conn, huc8s, 'comid', 'src_flowline.nhdflowline_network')
+        _copy_edges(conn, 'src_plusflow.plusflow', 'plusflow', 'fromcomid', 'tocomid')
+        _select_buffer_ids(conn, 'fromcomid', 'tocomid', 'plusflow')
+        _copy_flowlines(conn, 'src_flowline.nhdflowline_network', 'nhdflowline_network', 'comid',
+                        'comid, reachcode, streamleve, streamorde, divergence, startflag')
+        return {
+            'huc8_flowlines': _count(conn, 'huc8_ids'),
+            'flowlines': _count(conn, 'main.nhdflowline_network'),
+            'edges': _count(conn, 'main.plusflow')
+        }
+
+    counts = write_database(output_path, write)
+    prepare_database(output_path, V2_FLOWLINE_INDEXES + V2_PLUSFLOW_INDEXES, analyze)
+    return counts
+
+
+def extract_nhdplus_hr(nhdplushr_path: str, huc8s: Iterable[str], output_path: str,
+                       analyze: bool = True) -> Dict[str, int]:
+    """
+    Extract the NHDPlus HR flowlines, value added attributes, and flow edges needed to label huc8s into a new
+    database at output_path.
+
+    :return: Counts as for extract_nhdplus_v2()
+    """
+    def write(conn: sqlite3.Connection) -> Dict[str, int]:
+        attach_database(conn, nhdplushr_path, 'src')
+        conn.execute('create table nhdflowline (nhdplusid real, reachcode text)')
+        conn.execute(('create table nhdplusflowlinevaa (nhdplusid real, reachcode text, streamleve integer, '
+                      'streamorde integer, divergence integer, startflag integer)'))
+        conn.execute('create table nhdplusflow (fromnhdpid real, tonhdpid real)')
+        _select_huc8_ids(conn, huc8s, 'nhdplusid', 'src.nhdflowline')
+        _copy_edges(conn, 'src.nhdplusflow', 'nhdplusflow', 'fromnhdpid', 'tonhdpid')
+        _select_buffer_ids(conn, 'fromnhdpid', 'tonhdpid', 'nhdplusflow')
+        _copy_flowlines(conn, 'src.nhdflowline', 'nhdflowline', 'nhdplusid', 'nhdplusid, reachcode')
+        _copy_flowlines(conn, 'src.nhdplusflowlinevaa', 'nhdplusflowlinevaa', 'nhdplusid',
+                        'nhdplusid, reachcode, streamleve, streamorde, divergence, startflag')
+        return {
+            'huc8_flowlines': _count(conn, 'huc8_ids'),
+            'flowlines': _count(conn, 'main.nhdflowline'),
+            'edges': _count(conn, 'main.nhdplusflow')
+        }
+
+    counts = write_database(output_path, write)
+    prepare_database(output_path, HR_INDEXES, analyze)
+    return counts
+
+
+def extract_nhdplus(flowline_path: str, plusflow_path: str, nhd_hr: bool, huc8s: Iterable[str], output_path: str,
+                    analyze: bool = True) -> Dict[str, int]:
+    """
+    Extract the NHDPlus V2 or HR data needed to label huc8s into a new database at output_path.
+
+    :return: Counts as for extract_nhdplus_v2()
+    """
+    if nhd_hr:
+        return extract_nhdplus_hr(flowline_path, huc8s, output_path, analyze)
+    return extract_nhdplus_v2(flowline_path, plusflow_path, huc8s, output_path, analyze)
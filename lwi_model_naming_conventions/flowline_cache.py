@@ -0,0 +1,63 @@
+# Copyright (C) 2021-present State of Louisiana, Division of Administration, Office of Community Development.
+# All rights reserved. Licensed under the GPLv3 License. See LICENSE.txt in the project root for license information.
+
+"""
+Bounded LRU cache of NHDPlus flowline attributes, kept by each worker process across the watersheds it labels, so
+that flowlines shared by neighboring HUC8s (loaded with the flow edges across the HUC8 boundary, see
+network._load_edges()) are queried once.
+
+Only database rows (tuples of flowline attributes) are cached, never Flowline objects: label state (label,
+hack_order) is held in a flowline's FlowlineStore, so cached rows are added to each network's store anew and labels
+can't leak between watersheds.
+"""
+
+from collections import OrderedDict
+from typing import Hashable
+
+# Maximum number of flowline rows cached per worker process
+DEFAULT_FLOWLINE_CACHE_SIZE = 500000
+
+FLOWLINE = 'flowline'
+
+# Returned by FlowlineCache.get() for keys that aren't cached (None is cached for flowlines that don't exist)
+MISSING = object()
+
+
+class FlowlineCache:
+    """
+    LRU cache of at most maxsize entries, keyed by (kind, comid), where kind is FLOWLINE (value is the flowline's
+    attribute row, or None if it doesn't exist).
+    """
+    def __init__(self, maxsize: int = DEFAULT_FLOWLINE_CACHE_SIZE):
+        if maxsize <= 0:
+            raise ValueError(f"Flowline cache size must be positive, not {maxsize}.")
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, kind: str, comid: Hashable):
+        """
+        :return: The cached value, or MISSING if not cached
+        """
+        key = (kind, comid)
+        value = self._entries.get(key, MISSING)
+        if value is MISSING:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self._entries.move_to_end(key)
+        return value
+
+    def put(self, kind: str, comid: Hashable, value):
+        key = (kind, comid)
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._entries), 'maxsize': self.maxsize}
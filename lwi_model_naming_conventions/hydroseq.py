@@ -0,0 +1,203 @@
+# Copyright (C) 2021-present State of Louisiana, Division of Administration, Office of Community Development.
+# All rights reserved. Licensed under the GPLv3 License. See LICENSE.txt in the project root for license information.
+
+"""
+Loading of HUC8 networks from the routing attributes of the NHDPlus value added attributes (VAA) rather than the
+flow tables (PlusFlow, or NHDPlusFlow for NHDPlus HR).
+
+NHDPlus precomputes the hydrologic sequence number (hydroseq) of each flowline, which is lower than that of the
+flowlines upstream of it, and the hydroseqs of its major and minor downstream flowlines (dnhydroseq and dnminorhyd,
+0 if there are none). The flowlines of a HUC8 are loaded, with these columns, in ascending hydroseq order (i.e. from
+downstream to upstream) by a single query, and the flow edges of the HUC8 are those from each flowline to its
+downstream flowlines, so the flow tables are never queried. The flowlines one hop downstream across the HUC8's
+boundary are then loaded by hydroseq. Those one hop upstream are not, as labeling never continues upstream out of a
+HUC8.
+
+Root flowlines are found in a single sweep over the HUC8's flowlines in descending hydroseq order (i.e. from
+upstream to downstream): a flowline is swept only once every flowline upstream of it has been, so whether it is
+reachable from a headwater flowline is known without searching. Streams are then labeled by the same traversal as
+networks loaded from the flow tables.
+
+Upstream flowlines are ordered as PlusFlow returns them (descending COMID), so NHDPlus V2 labels are identical to
+those labeled from the flow tables. NHDPlusFlow returns upstream flowlines in table row order, which the VAA do not
+record, so NHDPlus HR upstream flowlines are ordered by descending NHDPlusID, and the streams joining a flowline may
+be numbered differently than when labeled from NHDPlusFlow. The VAA record at most two downstream flowlines of each
+flowline, so any others of the (rare) flowlines that split three or more ways are not part of the network.
+"""
+
+import sqlite3
+from array import array
+from typing import Dict, List, Set, Tuple
+
+from lwi_model_naming_conventions.network import FLOWLINE_COMID, FLOWLINE_STARTFLAG, QUERY_CHUNK_SIZE, Flowline, \
+    FlowlineNetwork, build_adjacency
+from lwi_model_naming_conventions.database import connect_nhdplus
+
+FLOWLINE_HYDROSEQ = 6
+FLOWLINE_DNHYDROSEQ = 7
+FLOWLINE_DNMINORHYD = 8
+
+HYDROSEQ_COLUMNS = ['hydroseq', 'dnhydroseq', 'dnminorhyd']
+
+V2_HUC8_QUERY = ('select comid, reachcode, streamleve, streamorde, divergence, startflag, hydroseq, dnhydroseq, '
+                 'dnminorhyd from nhdflowline_network where reachcode like ? order by hydroseq')
+V2_BOUNDARY_QUERY = ('select comid, reachcode, streamleve, streamorde, divergence, startflag, hydroseq '
+                     'from nhdflowline_network where hydroseq in ({params})')
+HR_HUC8_QUERY = ('select fl.nhdplusid, fl.reachcode, vaa.streamleve, vaa.streamorde, vaa.divergence, vaa.startflag, '
+                 'vaa.hydroseq, vaa.dnhydroseq, vaa.dnminorhyd '
+                 'from nhdflowline as fl, nhdplusflowlinevaa as vaa '
+                 'where fl.reachcode like ? and fl.nhdplusid=vaa.nhdplusid order by vaa.hydroseq')
+HR_BOUNDARY_QUERY = ('select fl.nhdplusid, fl.reachcode, vaa.streamleve, vaa.streamorde, vaa.divergence, '
+                     'vaa.startflag, vaa.hydroseq '
+                     'from nhdflowline as fl, nhdplusflowlinevaa as vaa '
+                     'where vaa.hydroseq in ({params}) and fl.nhdplusid=vaa.nhdplusid')
+
+
+class HydroseqNetwork(FlowlineNetwork):
+    """
+    FlowlineNetwork loaded from the VAA. The flowlines in the HUC8 are nodes 0 to num_huc8_flowlines - 1, in
+    ascending hydroseq order, followed by the flowlines one hop downstream across the HUC8's boundary. hydroseq holds
+    the hydroseq of each node.
+    """
+    def __init__(self, huc8: str, comid_typecode: str = 'q'):
+        super().__init__(huc8, comid_typecode)
+        self.hydroseq = array('q')
+        self.num_huc8_flowlines = 0
+
+
+def _add_flowline(network: HydroseqNetwork, row, nodes: Dict[int, int]) -> bool:
+    """
+    Add the flowline in row to network, unless it is already in it.
+
+    :param nodes: Node of each hydroseq in the network
+    :return: Whether the flowline was added
+    """
+    num_nodes = len(network.store)
+    node = network.add_flowline(row)
+    if node < num_nodes:
+        return False
+    hydroseq = int(row[FLOWLINE_HYDROSEQ])
+    if hydroseq in nodes:
+        raise ValueError(f"Flowlines {network.store.comid[nodes[hydroseq]]} and {row[FLOWLINE_COMID]} have the "
+                         f"same hydroseq {hydroseq}.")
+    nodes[hydroseq] = node
+    network.hydroseq.append(hydroseq)
+    return True
+
+
+def _load_hydroseq_network(cur, huc8: str, huc8_query: str, boundary_query: str,
+                           comid_typecode: str) -> HydroseqNetwork:
+    network = HydroseqNetwork(huc8, comid_typecode)
+    store = network.store
+    nodes = {}
+    # Hydroseqs of the major and minor downstream flowlines of each flowline in the HUC8
+    downstream: List[Tuple[int, int]] = []
+    cur.execute(huc8_query, (f"{huc8}%",))
+    for row in cur:
+        if _add_flowline(network, row, nodes):
+            downstream.append((int(row[FLOWLINE_DNHYDROSEQ] or 0), int(row[FLOWLINE_DNMINORHYD] or 0)))
+            if row[FLOWLINE_STARTFLAG] == 1:
+                network.headwaters.append(len(store) - 1)
+    network.num_huc8_flowlines = len(store)
+
+    # Fetch attributes of flowlines across the HUC8 boundary one hop downstream
+    boundary = sorted({h for hydroseqs in downstream for h in hydroseqs if h and h not in nodes})
+    for i in range(0, len(boundary), QUERY_CHUNK_SIZE):
+        chunk = boundary[i:i + QUERY_CHUNK_SIZE]
+        cur.execute(boundary_query.format(params=','.join('?' * len(chunk))), chunk)
+        for row in cur:
+            _add_flowline(network, row, nodes)
+
+    hydroseq = network.hydroseq
+    comid = store.comid
+    edges = []
+    for n, hydroseqs in enumerate(downstream):
+        for h in dict.fromkeys(hydroseqs):
+            # Downstream flowlines missing from the database are ignored, as COMID 0 is in PlusFlow
+            d = nodes.get(h) if h else None
+            if d is None:
+                continue
+            if hydroseq[d] >= hydroseq[n]:
+                raise ValueError(f"Hydroseq {hydroseq[n]} of flowline {comid[n]} is not greater than hydroseq "
+                                 f"{hydroseq[d]} of downstream flowline {comid[d]}.")
+            edges.append((n, d))
+    # Match the neighbor order of network.load_region_network() (downstream neighbors by ascending tocomid, upstream
+    # neighbors by descending fromcomid)
+    num_nodes = len(store)
+    downstream_edges = sorted(edges, key=lambda e: comid[e[1]])
+    upstream_edges = sorted(edges, key=lambda e: comid[e[0]], reverse=True)
+    network.downstream_offsets, network.downstream_nodes = build_adjacency(num_nodes,
+                                                                           [f for f, _ in downstream_edges],
+                                                                           [t for _, t in downstream_edges])
+    network.upstream_offsets, network.upstream_nodes = build_adjacency(num_nodes,
+                                                                       [t for _, t in upstream_edges],
+                                                                       [f for f, _ in upstream_edges])
+    return network
+
+
+def load_huc8_network_hydroseq(flowline, huc8: str) -> HydroseqNetwork:
+    """
+    Load the NHDPlus V2 subnetwork for a HUC8 from the nhdflowline_network table's VAA columns.
+
+    :raises ValueError: If hydroseqs are not unique, or do not decrease downstream
+    """
+    return _load_hydroseq_network(flowline, huc8, V2_HUC8_QUERY, V2_BOUNDARY_QUERY, 'q')
+
+
+def load_huc8_network_hydroseq_hr(nhdplushr, huc8: str) -> HydroseqNetwork:
+    """
+    Load the NHDPlus HR subnetwork for a HUC8 from the nhdplusflowlinevaa table.
+
+    :raises ValueError: If hydroseqs are not unique, or do not decrease downstream
+    """
+    return _load_hydroseq_network(nhdplushr, huc8, HR_HUC8_QUERY, HR_BOUNDARY_QUERY, 'd')
+
+
+def find_root_flowlines_hydroseq(network: HydroseqNetwork) -> Set[Flowline]:
+    """
+    Find root flowlines (i.e. watershed outlets) in a single sweep over the watershed's flowlines in descending
+    hydroseq order. The root flowlines are those found by find_root_flowlines(): flowlines reachable downstream from
+    a headwater flowline that either terminate on the coastline (stream level 1), or flow into a flowline outside of
+    the watershed.
+    """
+    store = network.store
+    stream_level = store.stream_level
+    num_huc8_flowlines = network.num_huc8_flowlines
+    down_offsets, down_nodes = network.downstream_offsets, network.downstream_nodes
+
+    reachable = bytearray(num_huc8_flowlines)
+    for n in network.headwaters:
+        reachable[n] = 1
+    root_nodes = set()
+    # Flowlines downstream of a flowline have lower hydroseqs, so are swept after it
+    for n in range(num_huc8_flowlines - 1, -1, -1):
+        if not reachable[n]:
+            continue
+        if stream_level[n] == 1:
+            # Flowline terminates on the coastline, it is a root flowline, don't search "downstream"
+            root_nodes.add(n)
+            continue
+        for d in down_nodes[down_offsets[n]:down_offsets[n + 1]]:
+            if d >= num_huc8_flowlines:
+                # Downstream flowline is not in the same watershed, so this flowline is a root flowline
+                root_nodes.add(n)
+            else:
+                reachable[d] = 1
+
+    return {Flowline(store, n) for n in root_nodes}
+
+
+def missing_hydroseq_columns(path: str, nhd_hr: bool = False) -> List[str]:
+    """
+    :return: VAA routing columns missing from the NHDPlus V2 nhdflowline_network table (or NHDPlus HR
+        nhdplusflowlinevaa table) in the database at path
+    """
+    table = 'nhdplusflowlinevaa' if nhd_hr else 'nhdflowline_network'
+    conn = connect_nhdplus(path)
+    try:
+        columns = {row[1].lower() for row in conn.execute(f"pragma table_info({table})")}
+    except sqlite3.Error:
+        columns = set()
+    finally:
+        conn.close()
+    return [c for c in HYDROSEQ_COLUMNS if c not in columns]
@@ -0,0 +1,91 @@
+# Copyright (C) 2021-present State of Louisiana, Division of Administration, Office of Community Development.
+# All rights reserved. Licensed under the GPLv3 License. See LICENSE.txt in the project root for license information.
+
+"""
+Lookup of labeled flowlines by stream label and by COMID (or NHDPlusID).
+
+Labeling runs with --label_index (or sqlite output) write all labeled flowlines to the stream_labels table of
+output/stream_labels.sqlite (see sinks.SQLiteOutputSink), which is indexed on stream_label and comid. As compact
+stream labels encode the label hierarchy from left to right, the tributaries of a stream are the flowlines whose
+stream labels start with a prefix of the stream's label, e.g. all tributaries of main stem '0a' in watershed AA have
+labels starting with 'AA0a'.
+"""
+
+import os
+import sqlite3
+from pathlib import Path
+from typing import List, Optional, Union
+
+from lwi_model_naming_conventions.sinks import LabeledReach, SQLITE_OUTPUT_FILE, SQLITE_OUTPUT_TABLE
+
+DEFAULT_LABEL_INDEX = os.path.join('output', SQLITE_OUTPUT_FILE)
+
+_SELECT = f"select stream_label, ws_code, huc8, comid, reachcode, divergence, raw_label from {SQLITE_OUTPUT_TABLE}"
+# Label indexes written before raw labels were output have no raw_label column
+_SELECT_WITHOUT_RAW_LABEL = ("select stream_label, ws_code, huc8, comid, reachcode, divergence, null "
+                             f"from {SQLITE_OUTPUT_TABLE}")
+
+
+def _prefix_upper_bound(prefix: str) -> str:
+    """
+    :return: The smallest string greater than all strings starting with prefix
+    """
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+class LabelIndex:
+    """
+    Read-only index of labeled flowlines. Stream labels are fully qualified (i.e. start with the watershed code) and
+    case sensitive.
+    """
+    def __init__(self, path: str = DEFAULT_LABEL_INDEX):
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"Label index {path} not found, it is created by labeling streams with "
+                                    '--label_index.')
+        self.path = path
+        self.conn = sqlite3.connect(f"{Path(path).resolve().as_uri()}?mode=ro", uri=True)
+        columns = {row[1] for row in self.conn.execute(f"pragma table_info({SQLITE_OUTPUT_TABLE})")}
+        self._select = _SELECT if 'raw_label' in columns else _SELECT_WITHOUT_RAW_LABEL
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        self.conn.close()
+
+    def _reaches(self, where: str, params) -> List[LabeledReach]:
+        return [LabeledReach(*row) for row in
+                self.conn.execute(f"{self._select} where {where} order by rowid", params)]
+
+    def flowlines(self, stream_label: str) -> List[LabeledReach]:
+        """
+        :return: Flowlines labeled stream_label
+        """
+        return self._reaches('stream_label=?', (stream_label,))
+
+    def flowlines_with_prefix(self, prefix: str) -> List[LabeledReach]:
+        """
+        :return: Flowlines whose labels start with prefix (e.g. a stream and its tributaries), sorted by label
+        """
+        if not prefix:
+            return [LabeledReach(*row) for row in self.conn.execute(f"{self._select} order by stream_label, rowid")]
+        return [LabeledReach(*row) for row in
+                self.conn.execute(f"{self._select} where stream_label >= ? and stream_label < ? "
+                                  'order by stream_label, rowid', (prefix, _prefix_upper_bound(prefix)))]
+
+    def flowline(self, comid: Union[int, float]) -> Optional[LabeledReach]:
+        """
+        :return: The labeled flowline with COMID (or NHDPlusID) comid, or None if it has not been labeled
+        """
+        reaches = self._reaches('comid=?', (comid,))
+        return reaches[0] if reaches else None
+
+    def label(self, comid: Union[int, float]) -> Optional[str]:
+        """
+        :return: The stream label of the flowline with COMID (or NHDPlusID) comid, or None if it has not been labeled
+        """
+        reach = self.flowline(comid)
+        return None if reach is None else reach.stream_label
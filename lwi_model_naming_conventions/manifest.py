@@ -0,0 +1,120 @@
+# Copyright (C) 2021-present State of Louisiana, Division of Administration, Office of Community Development.
+# All rights reserved. Licensed under the GPLv3 License. See LICENSE.txt in the project root for license information.
+
+"""
+Run manifests used to relabel only the watersheds whose inputs have changed since a previous run.
+
+For each watershed, a manifest records a content hash of its subnetwork (flowline attributes and flow edges), the
+watershed code, the label encoding, output format and version, and checksums of the output. A watershed whose entry
+in the previous manifest matches all of these (and whose output is unchanged) does not need to be labeled again.
+"""
+
+import os
+import json
+import hashlib
+from typing import Callable, Dict, Optional
+
+from lwi_model_naming_conventions.network import FlowlineNetwork
+
+MANIFEST_FILE = 'manifest.json'
+MANIFEST_VERSION = 1
+# Increment whenever a change to the labeling algorithm changes the labels it assigns, so that all watersheds are
+# relabeled.
+LABEL_ALGORITHM_VERSION = 1
+# Increment whenever a change to the output of labeling (e.g. a new column) requires all watersheds to be output again.
+OUTPUT_VERSION = 2
+
+
+def network_digest(network: FlowlineNetwork) -> str:
+    """
+    Compute a content hash of a watershed's subnetwork. The hash does not depend on how flowlines are numbered in
+    the network (so it is the same whether the network is loaded from SQLite or a network cache), but does depend on
+    the order of each flowline's neighbors, which determines the order in which flowlines are labeled.
+    """
+    store = network.store
+    comid = store.comid
+    headwaters = set(network.headwaters)
+    h = hashlib.sha256()
+    h.update(f"{LABEL_ALGORITHM_VERSION}:{network.huc8}".encode())
+    for n in sorted(range(len(store)), key=comid.__getitem__):
+        downstream = [comid[d] for d in
+                      network.downstream_nodes[network.downstream_offsets[n]:network.downstream_offsets[n + 1]]]
+        upstream = [comid[u] for u in
+                    network.upstream_nodes[network.upstream_offsets[n]:network.upstream_offsets[n + 1]]]
+        h.update(repr((comid[n], store.reachcode[n], store.stream_level[n], store.strahler_order[n],
+                       store.divergence[n], n in headwaters, downstream, upstream)).encode())
+    return h.hexdigest()
+
+
+def file_digest(path: str) -> Optional[str]:
+    if not os.path.exists(path):
+        return None
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def manifest_key(ws_code: str, huc8: str) -> str:
+    return f"{ws_code}_{huc8}"
+
+
+def make_manifest_entry(ws_code: str, huc8: str, base32: bool, output_format: str, digest: str,
+                        outputs: Dict[str, str]) -> dict:
+    """
+    :param outputs: Checksums of the watershed's output keyed by output name (see OutputSink.checksums())
+    """
+    return {
+        'ws_code': ws_code,
+        'huc8': huc8,
+        'base32': base32,
+        'output_format': output_format,
+        'output_version': OUTPUT_VERSION,
+        'network_digest': digest,
+        'outputs': outputs
+    }
+
+
+def is_up_to_date(entry: Optional[dict], ws_code: str, huc8: str, base32: bool, output_format: str, digest: str,
+                  checksums: Callable[[], Dict[str, str]]) -> bool:
+    """
+    :param checksums: Function returning the current checksums of the watershed's output, only called if all
+        inputs match
+    :return: True if entry (from a previous manifest) was produced from the same inputs and its output is still
+        present and unchanged.
+    """
+    if not entry:
+        return False
+    if entry.get('ws_code') != ws_code or entry.get('huc8') != huc8 or entry.get('base32') != base32 \
+            or entry.get('output_format') != output_format or entry.get('output_version') != OUTPUT_VERSION \
+            or entry.get('network_digest') != digest:
+        return False
+    outputs = entry.get('outputs') or {}
+    if not outputs or None in outputs.values():
+        return False
+    return checksums() == outputs
+
+
+def load_manifest(output_dir: str) -> Dict[str, dict]:
+    """
+    :return: Manifest entries from the previous run keyed by manifest_key(), or an empty dictionary if there is
+        no (readable) manifest.
+    """
+    path = os.path.join(output_dir, MANIFEST_FILE)
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if manifest.get('version') != MANIFEST_VERSION:
+        return {}
+    return manifest.get('watersheds', {})
+
+
+def save_manifest(output_dir: str, entries: Dict[str, dict]):
+    path = os.path.join(output_dir, MANIFEST_FILE)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({'version': MANIFEST_VERSION, 'watersheds': entries}, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
@@ -0,0 +1,111 @@
+# Copyright (C) 2021-present State of Louisiana, Division of Administration, Office of Community Development.
+# All rights reserved. Licensed under the GPLv3 License. See LICENSE.txt in the project root for license information.
+
+"""
+Per-watershed performance metrics, written as JSON lines (one JSON object per watershed) so that slow watersheds
+in a large run can be found with standard tools, e.g.:
+    jq -c '[.huc8, .wall_seconds, .reaches] | @json' output/metrics.jsonl | sort -t, -k2 -rn | head
+"""
+
+import os
+import sys
+import json
+import time
+import contextlib
+from typing import Dict, List
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+from lwi_model_naming_conventions.network import Flowline
+
+DEFAULT_METRICS_FILE = 'metrics.jsonl'
+
+
+def peak_rss() -> int:
+    """
+    :return: Peak resident set size of this process in bytes, or None if unknown
+    """
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in kilobytes on Linux, bytes on macOS
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+
+class HUC8Metrics:
+    """
+    Metrics of labeling a watershed. Stages are timed with stage(), other values are set as items, e.g.:
+        with metrics.stage('load'):
+            network = source.load_huc8_network(huc8)
+        metrics['reaches'] = len(network)
+    """
+    def __init__(self, ws_code: str, huc8: str):
+        self.ws_code = ws_code
+        self.huc8 = huc8
+        self.stages: Dict[str, Dict[str, float]] = {}
+        self.values = {}
+        self._wall_start = time.perf_counter()
+        self._cpu_start = time.process_time()
+
+    def __getitem__(self, name: str):
+        return self.values[name]
+
+    def __setitem__(self, name: str, value):
+        self.values[name] = value
+
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        # CPU time of the stage's thread, as stages of different watersheds may run at once in a pipeline
+        wall_start = time.perf_counter()
+        cpu_start = time.thread_time()
+        try:
+            yield
+        finally:
+            stage = self.stages.setdefault(name, {'wall_seconds': 0.0, 'cpu_seconds': 0.0})
+            stage['wall_seconds'] += time.perf_counter() - wall_start
+            stage['cpu_seconds'] += time.thread_time() - cpu_start
+
+    def to_dict(self) -> dict:
+        d = {
+            'ws_code': self.ws_code,
+            'huc8': self.huc8,
+            'pid': os.getpid(),
+            'wall_seconds': time.perf_counter() - self._wall_start,
+            'cpu_seconds': time.process_time() - self._cpu_start,
+            'stages': self.stages
+        }
+        d.update(self.values)
+        d['peak_rss_bytes'] = peak_rss()
+        return d
+
+
+def stage(metrics: HUC8Metrics, name: str):
+    """
+    :return: Context manager timing stage name in metrics, or doing nothing if metrics is None
+    """
+    if metrics is None:
+        return contextlib.nullcontext()
+    return metrics.stage(name)
+
+
+def record_labeling_metrics(metrics: HUC8Metrics, stream_orders: Dict[int, List[Flowline]],
+                            iteration_metadata: dict):
+    """
+    Record the number of flowlines visited, traversal depth, and counts of flowlines and labels of each order.
+    """
+    metrics['reaches_visited'] = sum(len(flowlines) for flowlines in stream_orders.values())
+    metrics['max_order'] = iteration_metadata.get('max_order')
+    metrics['max_traversal_depth'] = iteration_metadata.get('max_depth')
+    metrics['flowlines_per_order'] = {str(o): len(flowlines) for o, flowlines in sorted(stream_orders.items())}
+    metrics['labels_per_order'] = {str(o): len({f.label for f in flowlines})
+                                   for o, flowlines in sorted(stream_orders.items())}
+
+
+def write_metrics(f, metrics: dict):
+    f.write(json.dumps(metrics, sort_keys=True))
+    f.write('\n')
+    f.flush()
@@ -0,0 +1,517 @@
+# Copyright (C) 2021-present State of Louisiana, Division of Administration, Office of Community Development.
+# All rights reserved. Licensed under the GPLv3 License. See LICENSE.txt in the project root for license information.
+
+from typing import Dict, List, Iterable, Tuple, Optional, Sequence
+from array import array
+
+from lwi_model_naming_conventions.flowline_cache import FlowlineCache, MISSING, FLOWLINE
+
+FLOWLINE_COMID = 0
+FLOWLINE_REACHCODE = 1
+FLOWLINE_LEVEL = 2
+FLOWLINE_ORDER = 3
+FLOWLINE_DIVERGENCE = 4
+FLOWLINE_STARTFLAG = 5
+
+# Reachcodes are 14 digits (the first 8 of which are the HUC8), so they are stored as integers and zero-padded
+# back to this length when read.
+REACHCODE_LEN = 14
+NO_HACK_ORDER = -1
+NO_LABEL = -1
+
+# Keep the number of bound parameters per query below SQLite's historical SQLITE_MAX_VARIABLE_NUMBER of 999
+QUERY_CHUNK_SIZE = 500
+
+
+class FlowlineStore:
+    """
+    Struct-of-arrays storage of flowline attributes and label state, indexed by a dense integer node id.
+
+    Labels (tuples of integers, one per level of the label hierarchy) are interned: each node stores the index of its
+    label in labels. comid_typecode should be 'q' for
+    NHDPlus V2 COMIDs (integers) or 'd' for NHDPlus HR NHDPlusIDs (which are stored as floating point).
+    """
+    def __init__(self, comid_typecode: str = 'q'):
+        self.comid = array(comid_typecode)
+        self.reachcode = array('q')
+        self.stream_level = array('h')
+        self.strahler_order = array('b')
+        self.divergence = array('b')
+        self.hack_order = array('h')
+        self.label_index = array('q')
+        self.labels: List[Tuple[int, ...]] = []
+        self._label_ids: Dict[Tuple[int, ...], int] = {}
+        self._nodes: Dict = {}
+
+    def __len__(self):
+        return len(self.comid)
+
+    def add(self, comid, reachcode, stream_level: int, strahler_order: int, divergence: int) -> int:
+        node = self._nodes.get(comid)
+        if node is not None:
+            return node
+        node = len(self.comid)
+        self.comid.append(comid)
+        self.reachcode.append(int(reachcode))
+        self.stream_level.append(int(stream_level))
+        self.strahler_order.append(int(strahler_order))
+        self.divergence.append(int(divergence))
+        self.hack_order.append(NO_HACK_ORDER)
+        self.label_index.append(NO_LABEL)
+        self._nodes[comid] = node
+        return node
+
+    def add_columns(self, comid, reachcode, stream_level, strahler_order, divergence) -> range:
+        """
+        Append flowlines from buffers (e.g. arrays, or memoryviews of a network cache) holding attribute columns
+        with the same typecodes as this store. Flowlines must not already be in the store.
+
+        :return: Range of nodes of the appended flowlines
+        """
+        start = len(self.comid)
+        self.comid.frombytes(memoryview(comid).cast('B'))
+        self.reachcode.frombytes(memoryview(reachcode).cast('B'))
+        self.stream_level.frombytes(memoryview(stream_level).cast('B'))
+        self.strahler_order.frombytes(memoryview(strahler_order).cast('B'))
+        self.divergence.frombytes(memoryview(divergence).cast('B'))
+        nodes = range(start, len(self.comid))
+        self.hack_order.extend(array('h', [NO_HACK_ORDER]) * len(nodes))
+        self.label_index.extend(array('q', [NO_LABEL]) * len(nodes))
+        self._nodes.update(zip(self.comid[start:], nodes))
+        return nodes
+
+    def node(self, comid) -> Optional[int]:
+        return self._nodes.get(comid)
+
+    def flowline(self, node: int) -> 'Flowline':
+        return Flowline(self, node)
+
+    def get_label(self, node: int) -> Optional[Tuple[int, ...]]:
+        i = self.label_index[node]
+        return None if i == NO_LABEL else self.labels[i]
+
+    def clear_labels(self):
+        """
+        Clear the label state of all flowlines, so that their network can be labeled again.
+        """
+        num_nodes = len(self.comid)
+        self.hack_order = array('h', [NO_HACK_ORDER]) * num_nodes
+        self.label_index = array('q', [NO_LABEL]) * num_nodes
+        self.labels = []
+        self._label_ids = {}
+
+    def set_label(self, node: int, label: Tuple[int, ...]):
+        i = self._label_ids.get(label)
+        if i is None:
+            i = len(self.labels)
+            self.labels.append(label)
+            self._label_ids[label] = i
+        self.label_index[node] = i
+
+
+class Flowline:
+    """
+    Lightweight view of the flowline stored at node in a FlowlineStore. Two views are equal if they refer to
+    the same node in the same store.
+    """
+    __slots__ = ('store', 'node')
+
+    def __init__(self, store: FlowlineStore, node: int):
+        self.store = store
+        self.node = node
+
+    @classmethod
+    def from_row(cls, row, store: FlowlineStore = None) -> 'Flowline':
+        if store is None:
+            store = FlowlineStore('d' if isinstance(row[FLOWLINE_COMID], float) else 'q')
+        return cls(store, store.add(row[FLOWLINE_COMID], row[FLOWLINE_REACHCODE], row[FLOWLINE_LEVEL],
+                                    row[FLOWLINE_ORDER], row[FLOWLINE_DIVERGENCE]))
+
+    @property
+    def comid(self):
+        return self.store.comid[self.node]
+
+    @property
+    def reachcode(self) -> str:
+        return str(self.store.reachcode[self.node]).zfill(REACHCODE_LEN)
+
+    @property
+    def stream_level(self) -> int:
+        return self.store.stream_level[self.node]
+
+    @property
+    def strahler_order(self) -> int:
+        return self.store.strahler_order[self.node]
+
+    @property
+    def divergence(self) -> int:
+        return self.store.divergence[self.node]
+
+    @property
+    def hack_order(self) -> Optional[int]:
+        hack_order = self.store.hack_order[self.node]
+        return None if hack_order == NO_HACK_ORDER else hack_order
+
+    @hack_order.setter
+    def hack_order(self, hack_order: int):
+        self.store.hack_order[self.node] = NO_HACK_ORDER if hack_order is None else hack_order
+
+    @property
+    def label(self) -> Optional[Tuple[int, ...]]:
+        return self.store.get_label(self.node)
+
+    @label.setter
+    def label(self, label: Tuple[int, ...]):
+        self.store.set_label(self.node, label)
+
+    def __str__(self):
+        return f"Flowline(comid={self.comid}, reachcode={self.reachcode}, stream_level={self.stream_level}, " \
+               f"strahler_order={self.strahler_order}, divergence={self.divergence}, " \
+               f"hack_order={self.hack_order}, label={self.label})"
+
+    def __repr__(self):
+        return self.__str__()
+
+    def __eq__(self, o: object) -> bool:
+        if not isinstance(o, Flowline):
+            return NotImplemented
+        return self.node == o.node and self.store is o.store
+
+    def __hash__(self) -> int:
+        return self.node
+
+
+def build_adjacency(num_nodes: int, nodes: Sequence[int], neighbors: Sequence[int]) -> Tuple[array, array]:
+    """
+    Build compressed sparse row (CSR) adjacency from parallel sequences of nodes and their neighbors. The
+    neighbors of each node are kept in the order in which they appear.
+
+    :return: Tuple of (offsets, neighbors) where the neighbors of node n are neighbors[offsets[n]:offsets[n + 1]]
+    """
+    offsets = array('q', [0]) * (num_nodes + 1)
+    for n in nodes:
+        offsets[n + 1] += 1
+    for n in range(num_nodes):
+        offsets[n + 1] += offsets[n]
+    csr_neighbors = array('q', [0]) * len(nodes)
+    fill = offsets[:-1]
+    for n, m in zip(nodes, neighbors):
+        csr_neighbors[fill[n]] = m
+        fill[n] += 1
+    return offsets, csr_neighbors
+
+
+class FlowlineNetwork:
+    """
+    In-memory subnetwork for a HUC8: every flowline whose reachcode is in the HUC8, plus the flowlines one hop
+    upstream or downstream of them (i.e. across the HUC8 boundary), and the flow edges connecting them.
+
+    Flowline attributes are held in a FlowlineStore and upstream/downstream neighbors in CSR arrays, both indexed
+    by node. Neighbors of each flowline are stored in the order defined by the set-based load queries (see
+    load_region_network() and load_region_network_hr()), which every other way of loading a network (a network
+    cache, the VAA routing columns) matches, so that traversals visit flowlines in the same order however the network
+    was loaded.
+    """
+    def __init__(self, huc8: str, comid_typecode: str = 'q'):
+        self.huc8 = huc8
+        self.store = FlowlineStore(comid_typecode)
+        self.headwaters = array('q')
+        self.upstream_offsets, self.upstream_nodes = build_adjacency(0, [], [])
+        self.downstream_offsets, self.downstream_nodes = build_adjacency(0, [], [])
+
+    def __len__(self):
+        return len(self.store)
+
+    @property
+    def num_edges(self) -> int:
+        return len(self.downstream_nodes)
+
+    def in_huc(self, huc: str) -> bytearray:
+        """
+        :return: Flag for each node indicating whether the flowline's reachcode is within huc (e.g. a HUC8),
+            equivalent to flowline.reachcode.startswith(huc).
+        """
+        divisor = 10 ** (REACHCODE_LEN - len(huc))
+        huc_code = int(huc)
+        return bytearray(r // divisor == huc_code for r in self.store.reachcode)
+
+    def get_flowline(self, comid) -> Optional[Flowline]:
+        node = self.store.node(comid)
+        if node is None:
+            return None
+        return Flowline(self.store, node)
+
+    def get_headwater_flowlines(self) -> List[Flowline]:
+        return [Flowline(self.store, n) for n in self.headwaters]
+
+    def get_downstream_flowlines(self, node: int) -> List[Flowline]:
+        return [Flowline(self.store, n)
+                for n in self.downstream_nodes[self.downstream_offsets[node]:self.downstream_offsets[node + 1]]]
+
+    def get_upstream_flowlines(self, node: int) -> List[Flowline]:
+        return [Flowline(self.store, n)
+                for n in self.upstream_nodes[self.upstream_offsets[node]:self.upstream_offsets[node + 1]]]
+
+    def add_flowline(self, row) -> int:
+        return self.store.add(row[FLOWLINE_COMID], row[FLOWLINE_REACHCODE], row[FLOWLINE_LEVEL],
+                              row[FLOWLINE_ORDER], row[FLOWLINE_DIVERGENCE])
+
+    def set_edges(self, downstream_edges: Iterable[Tuple], upstream_edges: Iterable[Tuple] = None):
+        """
+        Build adjacency from (from_comid, to_comid) edges. Neighbors are ordered as they appear in
+        downstream_edges (for downstream neighbors) and upstream_edges (for upstream neighbors, defaults to
+        downstream_edges). Edges to/from flowlines missing from the network (e.g. comid 0 in PlusFlow) are
+        ignored.
+        """
+        downstream_edges = self._edge_nodes(downstream_edges)
+        if upstream_edges is None:
+            upstream_edges = downstream_edges
+        else:
+            upstream_edges = self._edge_nodes(upstream_edges)
+        num_nodes = len(self.store)
+        self.downstream_offsets, self.downstream_nodes = build_adjacency(num_nodes,
+                                                                         [f for f, _ in downstream_edges],
+                                                                         [t for _, t in downstream_edges])
+        self.upstream_offsets, self.upstream_nodes = build_adjacency(num_nodes,
+                                                                     [t for _, t in upstream_edges],
+                                                                     [f for f, _ in upstream_edges])
+
+    def _edge_nodes(self, edges: Iterable[Tuple]) -> List[Tuple[int, int]]:
+        node = self.store.node
+        edge_nodes = []
+        for from_comid, to_comid in edges:
+            from_node = node(from_comid)
+            to_node = node(to_comid)
+            if from_node is not None and to_node is not None:
+                edge_nodes.append((from_node, to_node))
+        return edge_nodes
+
+
+class RegionNetwork:
+    """
+    Network of a whole region (e.g. a HUC4, or all HUC8s to be labeled), loaded once, from which the subnetwork of
+    each of its HUC8s is copied in memory rather than loaded from the database. Each subnetwork is equivalent to
+    that returned by load_huc8_network() (or load_huc8_network_hr()), as the region network also holds the flowlines
+    one hop upstream or downstream of it.
+
+    root_comids holds the COMIDs of the root flowlines of each HUC8, if found for the whole region at once.
+    """
+    def __init__(self, network: FlowlineNetwork, huc8s: Iterable[str]):
+        self.network = network
+        huc8_divisor = 10 ** (REACHCODE_LEN - 8)
+        # Group the nodes of each HUC8 in a single pass over the region
+        nodes_by_code: Dict[int, array] = {}
+        for n, reachcode in enumerate(network.store.reachcode):
+            nodes = nodes_by_code.get(reachcode // huc8_divisor)
+            if nodes is None:
+                nodes = nodes_by_code[reachcode // huc8_divisor] = array('q')
+            nodes.append(n)
+        self.huc8_nodes: Dict[str, array] = {huc8: nodes_by_code.get(int(huc8), array('q')) for huc8 in huc8s}
+        self.root_comids: Dict[str, List] = {}
+
+    def __len__(self):
+        return len(self.network)
+
+    def num_flowlines(self, huc8: str) -> int:
+        return len(self.huc8_nodes.get(huc8, ()))
+
+    def subnetwork(self, huc8: str) -> FlowlineNetwork:
+        """
+        Copy the subnetwork for huc8 out of the region network: its flowlines, the flowlines one hop upstream or
+        downstream of them, and the edges connecting them.
+        """
+        region = self.network
+        src = region.store
+        network = FlowlineNetwork(huc8, comid_typecode=src.comid.typecode)
+        store = network.store
+        huc8_nodes = self.huc8_nodes.get(huc8, array('q'))
+        local = {}
+
+        def local_node(n):
+            node = local.get(n)
+            if node is None:
+                node = store.add(src.comid[n], src.reachcode[n], src.stream_level[n], src.strahler_order[n],
+                                 src.divergence[n])
+                local[n] = node
+            return node
+
+        for n in huc8_nodes:
+            local_node(n)
+        in_huc8 = set(huc8_nodes)
+        network.headwaters.extend(local[n] for n in region.headwaters if n in in_huc8)
+
+        down_offsets, down_nodes = region.downstream_offsets, region.downstream_nodes
+        up_offsets, up_nodes = region.upstream_offsets, region.upstream_nodes
+        downstream_from, downstream_to = array('q'), array('q')
+        upstream_to, upstream_from = array('q'), array('q')
+        boundary = []
+        # Copy the edges of flowlines in the HUC8, adding flowlines across the boundary as they are encountered
+        for n in huc8_nodes:
+            node = local[n]
+            for d in down_nodes[down_offsets[n]:down_offsets[n + 1]]:
+                if d not in local:
+                    boundary.append(d)
+                downstream_from.append(node)
+                downstream_to.append(local_node(d))
+            for u in up_nodes[up_offsets[n]:up_offsets[n + 1]]:
+                if u not in local:
+                    boundary.append(u)
+                upstream_to.append(node)
+                upstream_from.append(local_node(u))
+        # Boundary flowlines are only connected to flowlines in the HUC8
+        for b in boundary:
+            node = local[b]
+            for d in down_nodes[down_offsets[b]:down_offsets[b + 1]]:
+                if d in in_huc8:
+                    downstream_from.append(node)
+                    downstream_to.append(local[d])
+            for u in up_nodes[up_offsets[b]:up_offsets[b + 1]]:
+                if u in in_huc8:
+                    upstream_to.append(node)
+                    upstream_from.append(local[u])
+
+        num_nodes = len(store)
+        network.downstream_offsets, network.downstream_nodes = build_adjacency(num_nodes, downstream_from,
+                                                                               downstream_to)
+        network.upstream_offsets, network.upstream_nodes = build_adjacency(num_nodes, upstream_to, upstream_from)
+        return network
+
+
+def _chunks(items: List, size: int = QUERY_CHUNK_SIZE) -> Iterable[List]:
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def _in_clause(chunk: List) -> str:
+    return ','.join('?' * len(chunk))
+
+
+def _add_flowline(network: FlowlineNetwork, row, flowline_cache: FlowlineCache = None) -> int:
+    if flowline_cache is not None:
+        # Cached for other HUC8s, which this flowline may be one hop across the boundary of
+        flowline_cache.put(FLOWLINE, row[FLOWLINE_COMID], row)
+    return network.add_flowline(row)
+
+
+def _load_edges(network: FlowlineNetwork, flow_cur, edges_query: str, flowline_cur, attributes_query: str,
+                flowline_cache: FlowlineCache = None):
+    huc8_comids = list(network.store.comid)
+    edges = []
+    for column in ('from', 'to'):
+        for chunk in _chunks(huc8_comids):
+            flow_cur.execute(edges_query.format(column=column, params=_in_clause(chunk)), chunk)
+            edges.extend(flow_cur.fetchall())
+    # The same edge is returned twice when both of its ends are in the HUC8
+    edges = sorted(set(edges))
+    # Fetch attributes of flowlines across the HUC8 boundary one hop away
+    boundary_comids = list({e[i] for e in edges for i in (1, 2) if network.store.node(e[i]) is None})
+    if flowline_cache is not None:
+        uncached_comids = []
+        for comid in boundary_comids:
+            row = flowline_cache.get(FLOWLINE, comid)
+            if row is MISSING:
+                uncached_comids.append(comid)
+            elif row is not None:
+                network.add_flowline(row)
+        boundary_comids = uncached_comids
+    for chunk in _chunks(boundary_comids):
+        flowline_cur.execute(attributes_query.format(params=_in_clause(chunk)), chunk)
+        for row in flowline_cur:
+            _add_flowline(network, row, flowline_cache)
+    if flowline_cache is not None:
+        # Also cache flowlines that don't exist (e.g. COMID 0 in PlusFlow)
+        for comid in boundary_comids:
+            if network.store.node(comid) is None:
+                flowline_cache.put(FLOWLINE, comid, None)
+    return edges
+
+
+def _region_hucs(hucs: Iterable[str]) -> List[str]:
+    """
+    :return: Sorted HUCs, without those within another of the HUCs (e.g. HUC8s within a HUC4 in hucs)
+    """
+    hucs = sorted(set(hucs), key=lambda h: (len(h), h))
+    region = []
+    for huc in hucs:
+        if not any(huc.startswith(r) for r in region):
+            region.append(huc)
+    return sorted(region)
+
+
+def load_huc8_network(flowline, plusflow, huc8: str, flowline_cache: FlowlineCache = None) -> FlowlineNetwork:
+    """
+    Load the NHDPlus V2 subnetwork for a HUC8 into memory using a handful of set-based queries (rather than
+    one query per flowline and neighbor).
+
+    :param flowline_cache: If not None, cache that flowlines are added to, and flowlines across the HUC8 boundary
+        looked up in before querying the database
+    """
+    return load_region_network(flowline, plusflow, [huc8], flowline_cache)
+
+
+def load_region_network(flowline, plusflow, hucs: Iterable[str],
+                        flowline_cache: FlowlineCache = None) -> FlowlineNetwork:
+    """
+    Load the NHDPlus V2 network for a region (one or more HUCs of any level, e.g. a HUC4, or a list of HUC8s),
+    and the flowlines one hop upstream or downstream of it, as for load_huc8_network().
+    """
+    hucs = _region_hucs(hucs)
+    network = FlowlineNetwork(','.join(hucs))
+    for huc in hucs:
+        flowline.execute(('select comid, reachcode, streamleve, streamorde, divergence, startflag '
+                          'from nhdflowline_network where reachcode like ? order by comid desc'),
+                         (f"{huc}%",))
+        for row in flowline:
+            node = _add_flowline(network, row, flowline_cache)
+            if row[FLOWLINE_STARTFLAG] == 1:
+                network.headwaters.append(node)
+    edges = _load_edges(network, plusflow,
+                        'select rowid, fromcomid, tocomid from plusflow where {column}comid in ({params})',
+                        flowline,
+                        ('select comid, reachcode, streamleve, streamorde, divergence '
+                         'from nhdflowline_network where comid in ({params})'),
+                        flowline_cache)
+    # Neighbor order of NHDPlus V2 networks, which all other ways of loading them match: downstream neighbors by
+    # ascending tocomid, upstream neighbors by descending fromcomid
+    network.set_edges([(e[1], e[2]) for e in sorted(edges, key=lambda e: e[2])],
+                      [(e[1], e[2]) for e in sorted(edges, key=lambda e: e[1], reverse=True)])
+    return network
+
+
+def load_huc8_network_hr(nhdplushr, huc8: str, flowline_cache: FlowlineCache = None) -> FlowlineNetwork:
+    """
+    Load the NHDPlus HR subnetwork for a HUC8 into memory using a handful of set-based queries (rather than
+    one query per flowline and neighbor).
+
+    :param flowline_cache: See load_huc8_network()
+    """
+    return load_region_network_hr(nhdplushr, [huc8], flowline_cache)
+
+
+def load_region_network_hr(nhdplushr, hucs: Iterable[str], flowline_cache: FlowlineCache = None) -> FlowlineNetwork:
+    """
+    Load the NHDPlus HR network for a region, as for load_region_network().
+    """
+    hucs = _region_hucs(hucs)
+    network = FlowlineNetwork(','.join(hucs), comid_typecode='d')
+    for huc in hucs:
+        nhdplushr.execute(('select fl.nhdplusid, fl.reachcode, vaa.streamleve, vaa.streamorde, vaa.divergence, '
+                           'vaa.startflag '
+                           'from nhdflowline as fl, nhdplusflowlinevaa as vaa '
+                           'where fl.reachcode like ? and fl.nhdplusid=vaa.nhdplusid'),
+                          (f"{huc}%",))
+        for row in nhdplushr:
+            node = _add_flowline(network, row, flowline_cache)
+            if row[FLOWLINE_STARTFLAG] == 1:
+                network.headwaters.append(node)
+    # Neighbor order of NHDPlus HR networks, which all other ways of loading them match: NHDPlusFlow rowid order
+    # (edges are sorted by rowid by _load_edges())
+    edges = _load_edges(network, nhdplushr,
+                        'select rowid, fromnhdpid, tonhdpid from nhdplusflow where {column}nhdpid in ({params})',
+                        nhdplushr,
+                        ('select fl.nhdplusid, fl.reachcode, vaa.streamleve, vaa.streamorde, vaa.divergence '
+                         'from nhdflowline as fl, nhdplusflowlinevaa as vaa '
+                         'where fl.nhdplusid in ({params}) and fl.nhdplusid=vaa.nhdplusid'),
+                        flowline_cache)
+    network.set_edges([(e[1], e[2]) for e in edges])
+    return network
@@ -0,0 +1,355 @@
+# Copyright (C) 2021-present State of Louisiana, Division of Administration, Office of Community Development.
+# All rights reserved. Licensed under the GPLv3 License. See LICENSE.txt in the project root for license information.
+
+"""
+Precompiled, memory-mapped NHDPlus network cache.
+
+NHDPlus is static between releases, so rather than querying the SQLite databases prepared by download-data.sh on
+every run, the flowline and flow tables can be compiled once into a binary file holding flowline attribute columns,
+upstream/downstream adjacency in compressed sparse row (CSR) form, and an index of the range of flowlines in each
+HUC8. Flowlines are sorted by reachcode so that the flowlines of each HUC8 are contiguous.
+
+File layout (all values little-endian, each section padded to a multiple of 8 bytes):
+    header: magic, version, flags, number of flowlines (N), number of edges (E), number of HUC8s (H)
+    comid (N x int64, or N x float64 for NHDPlus HR)
+    reachcode (N x int64)
+    stream_level (N x int16)
+    strahler_order (N x int8)
+    divergence (N x int8)
+    startflag (N x int8)
+    downstream_offsets (N + 1 x int64), downstream_nodes (E x int64)
+    upstream_offsets (N + 1 x int64), upstream_nodes (E x int64)
+    huc8 (H x int64), huc8_offsets (H + 1 x int64)
+
+The same layout is used for networks shared between processes in memory (see shared_network.py).
+"""
+
+import os
+import sys
+import mmap
+import struct
+from array import array
+from bisect import bisect_left
+from typing import Callable, List, Tuple
+
+from lwi_model_naming_conventions.network import FLOWLINE_COMID, FLOWLINE_REACHCODE, FLOWLINE_LEVEL, \
+    FLOWLINE_ORDER, FLOWLINE_DIVERGENCE, FLOWLINE_STARTFLAG, REACHCODE_LEN, FlowlineNetwork, build_adjacency
+
+MAGIC = b'LWINHDNC'
+VERSION = 1
+FLAG_NHD_HR = 0x1
+HEADER = struct.Struct('<8sBB6xqqq')
+
+HUC8_DIVISOR = 10 ** (REACHCODE_LEN - 8)
+
+
+def _sections(nhd_hr: bool, num_flowlines: int, num_edges: int, num_huc8s: int) -> List[Tuple[str, str, int]]:
+    return [
+        ('comid', 'd' if nhd_hr else 'q', num_flowlines),
+        ('reachcode', 'q', num_flowlines),
+        ('stream_level', 'h', num_flowlines),
+        ('strahler_order', 'b', num_flowlines),
+        ('divergence', 'b', num_flowlines),
+        ('startflag', 'b', num_flowlines),
+        ('downstream_offsets', 'q', num_flowlines + 1),
+        ('downstream_nodes', 'q', num_edges),
+        ('upstream_offsets', 'q', num_flowlines + 1),
+        ('upstream_nodes', 'q', num_edges),
+        ('huc8', 'q', num_huc8s),
+        ('huc8_offsets', 'q', num_huc8s + 1)
+    ]
+
+
+def _padding(size: int) -> int:
+    return -size % 8
+
+
+def _column_counts(columns: dict) -> Tuple[int, int, int]:
+    return len(columns['comid']), len(columns['downstream_nodes']), len(columns['huc8'])
+
+
+def network_cache_size(nhd_hr: bool, columns: dict) -> int:
+    """
+    :return: Size in bytes of the network cache of a dictionary of arrays keyed by section name (see _sections())
+    """
+    size = HEADER.size
+    for _, typecode, length in _sections(nhd_hr, *_column_counts(columns)):
+        size += length * array(typecode).itemsize
+        size += _padding(size)
+    return size
+
+
+def pack_network_cache(write: Callable[[bytes], None], nhd_hr: bool, columns: dict):
+    """
+    Pack a dictionary of arrays keyed by section name (see _sections()) into the network cache layout, passing each
+    part to write in turn.
+    """
+    num_flowlines, num_edges, num_huc8s = _column_counts(columns)
+    write(HEADER.pack(MAGIC, VERSION, FLAG_NHD_HR if nhd_hr else 0, num_flowlines, num_edges, num_huc8s))
+    for name, typecode, length in _sections(nhd_hr, num_flowlines, num_edges, num_huc8s):
+        a = columns[name]
+        assert a.typecode == typecode and len(a) == length, f"Invalid network cache section {name}."
+        if sys.byteorder != 'little':
+            a = array(typecode, a)
+            a.byteswap()
+        data = a.tobytes()
+        write(data)
+        write(b'\0' * _padding(len(data)))
+
+
+def write_network_cache(path: str, nhd_hr: bool, columns: dict):
+    """
+    Write a network cache file from a dictionary of arrays keyed by section name (see _sections()). The file is
+    written to a temporary file first and then moved into place so that readers never see a partial cache.
+    """
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        pack_network_cache(f.write, nhd_hr, columns)
+    os.replace(tmp_path, path)
+
+
+def network_cache_columns(network: FlowlineNetwork) -> dict:
+    """
+    Convert a network loaded into memory (e.g. a region network) into a dictionary of arrays keyed by section name
+    (see _sections()), sorting flowlines by reachcode and COMID as compile_network_cache() does. Neighbors of each
+    flowline are kept in the same order.
+    """
+    store = network.store
+    nhd_hr = store.comid.typecode == 'd'
+    num_flowlines = len(store)
+    order = sorted(range(num_flowlines), key=lambda n: (store.reachcode[n], store.comid[n]))
+    new_node = array('q', [0]) * num_flowlines
+    for i, n in enumerate(order):
+        new_node[n] = i
+    columns = {name: array(typecode) for name, typecode, _ in _sections(nhd_hr, 0, 0, 0)}
+    headwaters = set(network.headwaters)
+    for n in order:
+        reachcode = store.reachcode[n]
+        huc8 = reachcode // HUC8_DIVISOR
+        if not columns['huc8'] or columns['huc8'][-1] != huc8:
+            columns['huc8'].append(huc8)
+            columns['huc8_offsets'].append(len(columns['comid']))
+        columns['comid'].append(store.comid[n])
+        columns['reachcode'].append(reachcode)
+        columns['stream_level'].append(store.stream_level[n])
+        columns['strahler_order'].append(store.strahler_order[n])
+        columns['divergence'].append(store.divergence[n])
+        columns['startflag'].append(int(n in headwaters))
+    columns['huc8_offsets'].append(num_flowlines)
+    for direction in ('downstream', 'upstream'):
+        offsets = getattr(network, f"{direction}_offsets")
+        nodes = getattr(network, f"{direction}_nodes")
+        new_offsets = columns[f"{direction}_offsets"]
+        new_nodes = columns[f"{direction}_nodes"]
+        new_offsets.append(0)
+        for n in order:
+            new_nodes.extend(new_node[m] for m in nodes[offsets[n]:offsets[n + 1]])
+            new_offsets.append(len(new_nodes))
+    return columns
+
+
+def _compile_edges(node_by_comid: dict, cur, query: str) -> Tuple[array, array]:
+    from_nodes = array('q')
+    to_nodes = array('q')
+    cur.execute(query)
+    for from_comid, to_comid in cur:
+        from_node = node_by_comid.get(from_comid)
+        to_node = node_by_comid.get(to_comid)
+        # Skip edges to/from flowlines that are not in the flowline table (e.g. comid 0 in PlusFlow)
+        if from_node is not None and to_node is not None:
+            from_nodes.append(from_node)
+            to_nodes.append(to_node)
+    return from_nodes, to_nodes
+
+
+def compile_network_cache(path: str, flowline, plusflow=None, nhd_hr: bool = False):
+    """
+    Compile the NHDPlus V2 (nhdflowline_network and plusflow) or NHDPlus HR (nhdflowline, nhdplusflowlinevaa
+    and nhdplusflow) flowline and flow tables into a network cache file at path.
+
+    Neighbors of each flowline are stored in the same order as by network.load_region_network() (or
+    network.load_region_network_hr() for NHDPlus HR).
+    """
+    if nhd_hr:
+        flowline.execute(('select fl.nhdplusid, fl.reachcode, vaa.streamleve, vaa.streamorde, vaa.divergence, '
+                          'vaa.startflag '
+                          'from nhdflowline as fl, nhdplusflowlinevaa as vaa '
+                          'where fl.nhdplusid=vaa.nhdplusid and fl.reachcode is not null '
+                          'order by fl.reachcode, fl.nhdplusid'))
+    else:
+        flowline.execute(('select comid, reachcode, streamleve, streamorde, divergence, startflag '
+                          'from nhdflowline_network where reachcode is not null order by reachcode, comid'))
+    columns = {name: array(typecode) for name, typecode, _ in _sections(nhd_hr, 0, 0, 0)}
+    node_by_comid = {}
+    huc8_offsets = columns['huc8_offsets']
+    for row in flowline:
+        comid = row[FLOWLINE_COMID]
+        if comid in node_by_comid:
+            continue
+        reachcode = int(row[FLOWLINE_REACHCODE])
+        huc8 = reachcode // HUC8_DIVISOR
+        if not columns['huc8'] or columns['huc8'][-1] != huc8:
+            columns['huc8'].append(huc8)
+            huc8_offsets.append(len(columns['comid']))
+        node_by_comid[comid] = len(columns['comid'])
+        columns['comid'].append(comid)
+        columns['reachcode'].append(reachcode)
+        columns['stream_level'].append(int(row[FLOWLINE_LEVEL]))
+        columns['strahler_order'].append(int(row[FLOWLINE_ORDER]))
+        columns['divergence'].append(int(row[FLOWLINE_DIVERGENCE]))
+        columns['startflag'].append(int(row[FLOWLINE_STARTFLAG] == 1))
+    num_flowlines = len(columns['comid'])
+    huc8_offsets.append(num_flowlines)
+
+    if nhd_hr:
+        # Neighbors in NHDPlusFlow rowid order, as in network.load_region_network_hr()
+        from_nodes, to_nodes = _compile_edges(node_by_comid, flowline,
+                                              'select fromnhdpid, tonhdpid from nhdplusflow order by rowid')
+        downstream = build_adjacency(num_flowlines, from_nodes, to_nodes)
+        upstream = build_adjacency(num_flowlines, to_nodes, from_nodes)
+    else:
+        # Downstream neighbors ordered by ascending tocomid, upstream neighbors by descending fromcomid
+        from_nodes, to_nodes = _compile_edges(node_by_comid, plusflow,
+                                              'select fromcomid, tocomid from plusflow order by tocomid asc')
+        downstream = build_adjacency(num_flowlines, from_nodes, to_nodes)
+        from_nodes, to_nodes = _compile_edges(node_by_comid, plusflow,
+                                              'select fromcomid, tocomid from plusflow order by fromcomid desc')
+        upstream = build_adjacency(num_flowlines, to_nodes, from_nodes)
+    columns['downstream_offsets'], columns['downstream_nodes'] = downstream
+    columns['upstream_offsets'], columns['upstream_nodes'] = upstream
+
+    write_network_cache(path, nhd_hr, columns)
+
+
+class NetworkCache:
+    """
+    Read-only, memory-mapped network cache. Sections of the file are exposed as memoryviews so that opening a
+    cache, even for the whole country, takes next to no time; only the subnetwork for a HUC8 being labeled is
+    copied into memory by load_huc8_network().
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self._file = open(path, 'rb')
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._open(self._mmap)
+
+    def _open(self, buffer):
+        """
+        Expose the sections of the network cache in buffer.
+        """
+        magic, version, flags, num_flowlines, num_edges, num_huc8s = HEADER.unpack_from(buffer)
+        if magic != MAGIC or version != VERSION:
+            self.close()
+            raise ValueError(f"{self.path} is not a version {VERSION} network cache.")
+        if sys.byteorder != 'little':
+            self.close()
+            raise ValueError("Network caches can only be read on little-endian platforms.")
+        self.nhd_hr = bool(flags & FLAG_NHD_HR)
+        self.num_flowlines = num_flowlines
+        self.num_edges = num_edges
+        self.num_huc8s = num_huc8s
+
+        self._buffer = memoryview(buffer)
+        self._sections = {}
+        offset = HEADER.size
+        for name, typecode, length in _sections(self.nhd_hr, num_flowlines, num_edges, num_huc8s):
+            size = length * array(typecode).itemsize
+            self._sections[name] = self._buffer[offset:offset + size].cast(typecode)
+            offset += size + _padding(size)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __getitem__(self, name: str) -> memoryview:
+        return self._sections[name]
+
+    def close(self):
+        for section in getattr(self, '_sections', {}).values():
+            section.release()
+        self._sections = {}
+        if getattr(self, '_buffer', None) is not None:
+            self._buffer.release()
+            self._buffer = None
+        self._close_source()
+
+    def _close_source(self):
+        self._mmap.close()
+        self._file.close()
+
+    def huc8s(self) -> List[str]:
+        return [str(h).zfill(8) for h in self['huc8']]
+
+    def huc8_range(self, huc8: str) -> range:
+        """
+        :return: Range of the nodes of flowlines in huc8 (an empty range if there are none).
+        """
+        huc8_codes = self['huc8']
+        i = bisect_left(huc8_codes, int(huc8))
+        if i == len(huc8_codes) or huc8_codes[i] != int(huc8):
+            return range(0)
+        offsets = self['huc8_offsets']
+        return range(offsets[i], offsets[i + 1])
+
+    def load_huc8_network(self, huc8: str) -> FlowlineNetwork:
+        """
+        Copy the subnetwork for huc8 out of the cache: its flowlines, the flowlines one hop upstream or downstream
+        of them, and the edges connecting them. The result is equivalent to load_huc8_network() (or
+        load_huc8_network_hr()).
+        """
+        network = FlowlineNetwork(huc8, comid_typecode='d' if self.nhd_hr else 'q')
+        store = network.store
+        huc8_nodes = self.huc8_range(huc8)
+        start, stop = huc8_nodes.start, huc8_nodes.stop
+        # Flowlines in the HUC8 are contiguous, so their attributes are copied directly
+        store.add_columns(*(self[name][start:stop] for name in ('comid', 'reachcode', 'stream_level',
+                                                                  'strahler_order', 'divergence')))
+        startflag = self['startflag']
+        network.headwaters.extend(n - start for n in huc8_nodes if startflag[n])
+
+        down_offsets, down_nodes = self['downstream_offsets'], self['downstream_nodes']
+        up_offsets, up_nodes = self['upstream_offsets'], self['upstream_nodes']
+        # Map cache nodes to network nodes, adding boundary flowlines as they are encountered
+        local = {}
+        boundary = []
+
+        def local_node(n):
+            if start <= n < stop:
+                return n - start
+            node = local.get(n)
+            if node is None:
+                node = store.add(self['comid'][n], self['reachcode'][n], self['stream_level'][n],
+                                 self['strahler_order'][n], self['divergence'][n])
+                local[n] = node
+                boundary.append(n)
+            return node
+
+        downstream_from, downstream_to = array('q'), array('q')
+        upstream_to, upstream_from = array('q'), array('q')
+        for n in huc8_nodes:
+            node = n - start
+            for d in down_nodes[down_offsets[n]:down_offsets[n + 1]]:
+                downstream_from.append(node)
+                downstream_to.append(local_node(d))
+            for u in up_nodes[up_offsets[n]:up_offsets[n + 1]]:
+                upstream_to.append(node)
+                upstream_from.append(local_node(u))
+        # Boundary flowlines are only connected to flowlines in the HUC8
+        for b in boundary:
+            node = local[b]
+            for d in down_nodes[down_offsets[b]:down_offsets[b + 1]]:
+                if start <= d < stop:
+                    downstream_from.append(node)
+                    downstream_to.append(d - start)
+            for u in up_nodes[up_offsets[b]:up_offsets[b + 1]]:
+                if start <= u < stop:
+                    upstream_to.append(node)
+                    upstream_from.append(u - start)
+
+        num_nodes = len(store)
+        network.downstream_offsets, network.downstream_nodes = build_adjacency(num_nodes, downstream_from,
+                                                                               downstream_to)
+        network.upstream_offsets, network.upstream_nodes = build_adjacency(num_nodes, upstream_to, upstream_from)
+        return network
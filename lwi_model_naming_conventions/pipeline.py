@@ -0,0 +1,147 @@
+# Copyright (C) 2021-present State of Louisiana, Division of Administration, Office of Community Development.
+# All rights reserved. Licensed under the GPLv3 License. See LICENSE.txt in the project root for license information.
+
+"""
+Pipelined processing of a sequence of items (e.g. watersheds) in three stages, so that the I/O of loading and
+writing items overlaps with processing them:
+    load: Run by a prefetch thread, e.g. loading the next watershed's subnetwork from the NHDPlus databases
+    process: Run by the calling thread, e.g. labeling a watershed
+    write: Run by a writer thread, e.g. writing a watershed's labeled reaches and log to output sinks
+
+Stages are connected by bounded queues: a stage that gets ahead of the next blocks until there is room in its
+queue, so at most prefetch loaded items, and write_queue_size processed items, wait between stages. If any stage
+raises an exception, the pipeline stops: the other stages finish the item they are working on, and run_pipeline()
+raises a PipelineError, naming the stage and item, from the exception.
+"""
+
+import queue
+import threading
+from typing import Callable, Iterable, List
+
+# Seconds a stage waits on a queue before checking whether the pipeline has been stopped
+POLL_SECONDS = 0.1
+
+# Sentinel put on a queue after the last item
+_DONE = object()
+
+
+class PipelineError(Exception):
+    pass
+
+
+class _Stop(Exception):
+    pass
+
+
+class _Pipeline:
+    def __init__(self):
+        self.stopped = threading.Event()
+        self.error = None
+
+    def fail(self, stage: str, item, e: BaseException):
+        if self.error is None:
+            self.error = (stage, item, e)
+        self.stopped.set()
+
+    def put(self, q: queue.Queue, value):
+        """
+        Put value on q, waiting for room unless the pipeline is stopped.
+
+        :raises _Stop: If the pipeline is stopped
+        """
+        while not self.stopped.is_set():
+            try:
+                q.put(value, timeout=POLL_SECONDS)
+                return
+            except queue.Full:
+                pass
+        raise _Stop()
+
+    def get(self, q: queue.Queue):
+        """
+        :raises _Stop: If the pipeline is stopped
+        """
+        while not self.stopped.is_set():
+            try:
+                return q.get(timeout=POLL_SECONDS)
+            except queue.Empty:
+                pass
+        raise _Stop()
+
+
+def run_pipeline(items: Iterable, load: Callable, process: Callable, write: Callable, prefetch: int = 1,
+                 write_queue_size: int = 1) -> List:
+    """
+    Compute write(item, process(item, load(item))) for each of items, loading up to prefetch items ahead of the item
+    being processed, and writing items in the background.
+
+    :return: Results of write for each item, in the order of items
+    :raises PipelineError: If load, process, or write raises an exception
+    """
+    pipeline = _Pipeline()
+    loaded = queue.Queue(maxsize=max(1, prefetch))
+    processed = queue.Queue(maxsize=max(1, write_queue_size))
+    results = []
+
+    def load_items():
+        try:
+            for item in items:
+                if pipeline.stopped.is_set():
+                    return
+                try:
+                    value = load(item)
+                except BaseException as e:
+                    pipeline.fail('load', item, e)
+                    return
+                pipeline.put(loaded, (item, value))
+            pipeline.put(loaded, _DONE)
+        except _Stop:
+            pass
+
+    def write_items():
+        try:
+            while True:
+                entry = pipeline.get(processed)
+                if entry is _DONE:
+                    return
+                item, value = entry
+                try:
+                    results.append(write(item, value))
+                except BaseException as e:
+                    pipeline.fail('write', item, e)
+                    return
+        except _Stop:
+            pass
+
+    loader = threading.Thread(target=load_items, name='pipeline-load', daemon=True)
+    writer = threading.Thread(target=write_items, name='pipeline-write', daemon=True)
+    loader.start()
+    writer.start()
+    try:
+        while True:
+            entry = pipeline.get(loaded)
+            if entry is _DONE:
+                break
+            item, value = entry
+            try:
+                value = process(item, value)
+            except BaseException as e:
+                pipeline.fail('process', item, e)
+                break
+            pipeline.put(processed, (item, value))
+        pipeline.put(processed, _DONE)
+    except _Stop:
+        pass
+    except BaseException:
+        # e.g. KeyboardInterrupt while waiting on a queue
+        pipeline.stopped.set()
+        raise
+    finally:
+        if pipeline.error is not None:
+            pipeline.stopped.set()
+        loader.join()
+        writer.join()
+    if pipeline.error is not None:
+        stage, item, e = pipeline.error
+        raise PipelineError(f"Pipeline {stage} stage failed for {item}: {e!r}") from e
+    return results
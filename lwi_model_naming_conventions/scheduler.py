@@ -0,0 +1,95 @@
+# Copyright (C) 2021-present State of Louisiana, Division of Administration, Office of Community Development.
+# All rights reserved. Licensed under the GPLv3 License. See LICENSE.txt in the project root for license information.
+
+"""
+Size-aware scheduling of watersheds onto a multiprocessing pool.
+
+Labeling time and memory are roughly proportional to the number of flowlines in a HUC8, so watersheds are dispatched
+largest-first: the largest HUC8s (e.g. the Atchafalaya) start right away instead of possibly being left to last,
+so that the total runtime approaches that of the largest single watershed.
+"""
+
+import queue
+from typing import Callable, Iterable, Iterator, List, Sequence, Tuple
+
+# Rough upper bound of the memory used to label a HUC8 per flowline in it (network, traversal state and labels)
+BYTES_PER_FLOWLINE_ESTIMATE = 1024
+
+
+def estimate_memory(num_flowlines: int) -> int:
+    return num_flowlines * BYTES_PER_FLOWLINE_ESTIMATE
+
+
+def largest_first(tasks: Sequence, sizes: Sequence[int]) -> List[Tuple[object, int]]:
+    """
+    :return: List of (task, size) sorted by descending size. Tasks of equal size keep their original order.
+    """
+    return sorted(zip(tasks, sizes), key=lambda t: t[1], reverse=True)
+
+
+def imap_scheduled(pool, func: Callable, tasks: Sequence, sizes: Sequence[int], num_workers: int,
+                   memory_budget: int = None) -> Iterator:
+    """
+    Apply func to each task on pool, dispatching tasks largest-first, and yield results as they complete.
+
+    :param sizes: Size (number of flowlines) of each task
+    :param num_workers: Number of worker processes in pool
+    :param memory_budget: If not None, the maximum estimated memory (in bytes, see estimate_memory()) of the tasks
+        running at once. When the next largest task does not fit within the budget, the largest one that does is
+        run instead; a task larger than the whole budget is only run on its own.
+    """
+    scheduled = largest_first(tasks, sizes)
+    if memory_budget is None:
+        yield from pool.imap_unordered(func, [task for task, _ in scheduled])
+        return
+
+    pending = [(task, estimate_memory(size)) for task, size in scheduled]
+    completed = queue.Queue()
+    in_flight = 0
+    memory_in_use = 0
+    while pending or in_flight:
+        while pending and in_flight < num_workers:
+            if in_flight == 0:
+                i = 0
+            else:
+                i = next((i for i, (_, memory) in enumerate(pending) if memory_in_use + memory <= memory_budget),
+                         None)
+                if i is None:
+                    break
+            task, memory = pending.pop(i)
+            pool.apply_async(func, (task,),
+                             callback=lambda result, memory=memory: completed.put((memory, result, None)),
+                             error_callback=lambda e, memory=memory: completed.put((memory, None, e)))
+            in_flight += 1
+            memory_in_use += memory
+        memory, result, error = completed.get()
+        in_flight -= 1
+        memory_in_use -= memory
+        if error is not None:
+            raise error
+        yield result
+
+
+def deal_batches(tasks: Sequence, sizes: Sequence[int], num_batches: int,
+                 max_in_flight: int) -> Tuple[List[List], List[int]]:
+    """
+    Deal tasks, largest first, into num_batches batches in turn, so that batches are of similar total size and the
+    tasks of each batch are in largest-first order.
+
+    :param max_in_flight: Maximum number of tasks of a batch in memory at once (e.g. in a pipeline), the size of
+        a batch being the total size of its max_in_flight largest tasks
+    :return: Tuple of (batches, size of each batch)
+    """
+    num_batches = max(1, min(num_batches, len(tasks)))
+    batches = [[] for _ in range(num_batches)]
+    batch_sizes = [0] * num_batches
+    for i, (task, size) in enumerate(largest_first(tasks, sizes)):
+        batch = i % num_batches
+        batches[batch].append(task)
+        if len(batches[batch]) <= max_in_flight:
+            batch_sizes[batch] += size
+    return batches, batch_sizes
+
+
+def estimate_sizes(count_flowlines: Callable[[str], int], huc8s: Iterable[str]) -> List[int]:
+    return [count_flowlines(huc8) for huc8 in huc8s]
@@ -0,0 +1,209 @@
+# Copyright (C) 2021-present State of Louisiana, Division of Administration, Office of Community Development.
+# All rights reserved. Licensed under the GPLv3 License. See LICENSE.txt in the project root for license information.
+
+"""
+Long-running labeling service.
+
+Keeps the NHDPlus network (SQLite databases or network cache) open, and the HUC8 subnetworks and labeled reaches of
+recently requested watersheds in memory, behind a local HTTP endpoint, either on a TCP port or on a Unix socket.
+A request for labels that are not cached (e.g. of a HUC8 in the other encoding, or under another watershed code)
+relabels the HUC8's cached subnetwork, so only HUC8s that have not been requested recently are loaded from the
+source. Endpoints:
+    GET /labels/{ws_code}/{huc8}[?encoding=base32|hexadecimal]: Labeled reaches of a watershed as JSON:
+        {"fields": [...], "reaches": [[...], ...]}, where fields are the names of the values of each reach
+    GET /health: {"status": "ok", "cached": number of watersheds whose labels are cached}
+
+For example:
+    lwi-label-nhd-streams serve -c data/NHDPlusV2.lwinet --port 8765
+    curl http://127.0.0.1:8765/labels/AA/08080101
+"""
+
+import os
+import json
+import stat
+import socketserver
+from collections import OrderedDict
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from typing import List
+from urllib.parse import urlsplit, parse_qs
+
+from lwi_model_naming_conventions.api import LabeledReach, label_network
+from lwi_model_naming_conventions.network import FlowlineNetwork
+from lwi_model_naming_conventions.sources import NetworkSource
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8765
+DEFAULT_CACHE_SIZE = 64
+DEFAULT_NETWORK_CACHE_SIZE = 16
+ENCODINGS = {'base32': True, 'hexadecimal': False}
+
+
+def _cache_get(cache: OrderedDict, key):
+    value = cache.get(key)
+    if value is not None:
+        cache.move_to_end(key)
+    return value
+
+
+def _cache_put(cache: OrderedDict, key, value, size: int):
+    cache[key] = value
+    if len(cache) > size:
+        cache.popitem(last=False)
+
+
+class LabelService:
+    """
+    Labels watersheds using a network source kept open for the life of the service, caching the labeled reaches of
+    the cache_size most recently requested watersheds, and the subnetworks of the network_cache_size most recently
+    labeled HUC8s.
+    """
+    def __init__(self, source: NetworkSource, base32: bool = True, cache_size: int = DEFAULT_CACHE_SIZE,
+                 network_cache_size: int = DEFAULT_NETWORK_CACHE_SIZE):
+        self.source = source
+        self.base32 = base32
+        self.cache_size = cache_size
+        self.network_cache_size = network_cache_size
+        self._cache: OrderedDict = OrderedDict()
+        self._networks: OrderedDict = OrderedDict()
+
+    def __len__(self):
+        return len(self._cache)
+
+    def labels(self, ws_code: str, huc8: str, base32: bool = None) -> List[LabeledReach]:
+        if base32 is None:
+            base32 = self.base32
+        key = (ws_code, huc8, base32)
+        reaches = _cache_get(self._cache, key)
+        if reaches is not None:
+            return reaches
+        network = self.network(huc8)
+        reaches = label_network(network, huc8, ws_code, base32) if len(network) else []
+        _cache_put(self._cache, key, reaches, self.cache_size)
+        return reaches
+
+    def network(self, huc8: str) -> FlowlineNetwork:
+        """
+        :return: Subnetwork of huc8, with no labels, loaded from the source unless it is cached
+        """
+        network = _cache_get(self._networks, huc8)
+        if network is None:
+            network = self.source.load_huc8_network(huc8)
+            if self.network_cache_size:
+                _cache_put(self._networks, huc8, network, self.network_cache_size)
+        else:
+            # Labels of the previous request are cleared (networks are labeled in place)
+            network.store.clear_labels()
+        return network
+
+
+class LabelRequestHandler(BaseHTTPRequestHandler):
+    server_version = 'lwi-label-nhd-streams'
+
+    def _send_json(self, status: int, body: dict):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_error(self, status: int, message: str):
+        self._send_json(status, {'error': message})
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        parts = [p for p in url.path.split('/') if p]
+        service: LabelService = self.server.label_service
+        if parts == ['health']:
+            self._send_json(200, {'status': 'ok', 'cached': len(service)})
+            return
+        if len(parts) != 3 or parts[0] != 'labels':
+            self._send_error(404, f"Unknown path {url.path}, expected /labels/{{ws_code}}/{{huc8}} or /health.")
+            return
+        ws_code, huc8 = parts[1], parts[2]
+        if len(huc8) != 8 or not huc8.isdigit():
+            self._send_error(400, f"Invalid HUC8 {huc8}.")
+            return
+        base32 = None
+        encoding = parse_qs(url.query).get('encoding')
+        if encoding:
+            if encoding[-1] not in ENCODINGS:
+                self._send_error(400, f"Invalid encoding {encoding[-1]}, expected one of: {', '.join(ENCODINGS)}.")
+                return
+            base32 = ENCODINGS[encoding[-1]]
+        try:
+            reaches = service.labels(ws_code, huc8, base32)
+        except (Exception, SystemExit) as e:
+            # The labeling algorithm exits on some errors, which must not stop the service
+            self._send_error(500, f"Unable to label watershed {ws_code}, HUC8 {huc8}: {e}")
+            return
+        if not reaches:
+            self._send_error(404, f"No flowlines found in HUC8 {huc8}.")
+            return
+        self._send_json(200, {'fields': list(LabeledReach._fields), 'reaches': reaches})
+
+    def address_string(self):
+        # Clients of a Unix socket have no address
+        if isinstance(self.client_address, tuple) and self.client_address:
+            return super().address_string()
+        return 'unix'
+
+
+class UnixHTTPServer(socketserver.UnixStreamServer):
+    def server_bind(self):
+        socketserver.UnixStreamServer.server_bind(self)
+        # Attributes set by HTTPServer.server_bind() for TCP sockets
+        self.server_name = self.server_address
+        self.server_port = 0
+
+
+def _remove_socket(path: str):
+    """
+    Remove the Unix socket at path, if there is one.
+
+    :raises FileExistsError: If path is not a socket
+    """
+    try:
+        mode = os.stat(path).st_mode
+    except FileNotFoundError:
+        return
+    if not stat.S_ISSOCK(mode):
+        raise FileExistsError(f"{path} exists and is not a socket.")
+    os.remove(path)
+
+
+def make_server(service: LabelService, host: str = DEFAULT_HOST, port: int = DEFAULT_PORT,
+                socket_path: str = None) -> socketserver.BaseServer:
+    """
+    Create a server for service listening on socket_path if specified, otherwise on host and port. Requests are
+    handled one at a time, as labeling is CPU bound and the network source is not thread safe.
+
+    :raises FileExistsError: If socket_path exists and is not a socket
+    """
+    if socket_path:
+        _remove_socket(socket_path)
+        server = UnixHTTPServer(socket_path, LabelRequestHandler)
+    else:
+        server = HTTPServer((host, port), LabelRequestHandler)
+    server.label_service = service
+    return server
+
+
+def server_address(server: socketserver.BaseServer) -> str:
+    address = server.server_address
+    if isinstance(address, tuple):
+        return f"http://{address[0]}:{address[1]}"
+    return f"unix:{address}"
+
+
+def serve(service: LabelService, host: str = DEFAULT_HOST, port: int = DEFAULT_PORT, socket_path: str = None):
+    server = make_server(service, host, port, socket_path)
+    print(f"Serving stream labels at {server_address(server)}...")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if socket_path:
+            _remove_socket(socket_path)
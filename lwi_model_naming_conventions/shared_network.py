@@ -0,0 +1,82 @@
+# Copyright (C) 2021-present State of Louisiana, Division of Administration, Office of Community Development.
+# All rights reserved. Licensed under the GPLv3 License. See LICENSE.txt in the project root for license information.
+
+"""
+Networks shared by worker processes in memory.
+
+A network loaded once by a parent process (e.g. the region network of all watersheds to be labeled) is packed into a
+block of shared memory (see multiprocessing.shared_memory), in the layout of a network cache file (see
+network_cache.py): flowline attribute columns and CSR adjacency as flat arrays, with flowlines sorted by reachcode so
+that those of each HUC8 are contiguous. Worker processes attach to the block by name and read its sections in place,
+as they would a memory-mapped network cache, copying only the subnetwork of the HUC8 they are labeling. The network
+is held in memory once, however many workers there are, and workers do no database I/O.
+"""
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    # Python 3.7
+    shared_memory = None
+
+from lwi_model_naming_conventions.network import FlowlineNetwork
+from lwi_model_naming_conventions.network_cache import NetworkCache, network_cache_columns, network_cache_size, \
+    pack_network_cache
+
+
+def _require_shared_memory():
+    if shared_memory is None:
+        raise ImportError('Shared memory networks require Python 3.8 or later.')
+
+
+class SharedNetworkCache(NetworkCache):
+    """
+    Read-only network cache held in a block of shared memory. The process that creates the block (see create()) owns
+    it, and unlinks it when closed; other processes attach to it by name (see attach()).
+    """
+    def __init__(self, shm, owner: bool = False):
+        self.path = shm.name
+        self._shm = shm
+        self._owner = owner
+        self._open(shm.buf)
+
+    @property
+    def name(self) -> str:
+        return self._shm.name
+
+    @classmethod
+    def create(cls, network: FlowlineNetwork) -> 'SharedNetworkCache':
+        """
+        Pack network into a new block of shared memory.
+        """
+        _require_shared_memory()
+        nhd_hr = network.store.comid.typecode == 'd'
+        columns = network_cache_columns(network)
+        shm = shared_memory.SharedMemory(create=True, size=network_cache_size(nhd_hr, columns))
+        try:
+            offset = 0
+
+            def write(data: bytes):
+                nonlocal offset
+                shm.buf[offset:offset + len(data)] = data
+                offset += len(data)
+
+            pack_network_cache(write, nhd_hr, columns)
+            return cls(shm, owner=True)
+        except BaseException:
+            shm.close()
+            shm.unlink()
+            raise
+
+    @classmethod
+    def attach(cls, name: str) -> 'SharedNetworkCache':
+        _require_shared_memory()
+        return cls(shared_memory.SharedMemory(name=name))
+
+    def _close_source(self):
+        shm = self._shm
+        if shm is None:
+            return
+        self._shm = None
+        shm.close()
+        if self._owner:
+            shm.unlink()
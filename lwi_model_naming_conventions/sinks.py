@@ -0,0 +1,300 @@
+# Copyright (C) 2021-present State of Louisiana, Division of Administration, Office of Community Development.
+# All rights reserved. Licensed under the GPLv3 License. See LICENSE.txt in the project root for license information.
+
+"""
+Output sinks for labeled stream reaches.
+
+Labeled reaches are streamed to a sink as tuples of OUTPUT_FIELDS, one HUC8 at a time:
+    csv: One CSV file per HUC8 (the default)
+    sqlite: A single SQLite database with one indexed table for all HUC8s, written with one transaction per HUC8
+    parquet: One Parquet file per HUC8 (requires pyarrow)
+
+Sinks also read back the output of previous runs, one HUC8 at a time (see OutputSink.huc8s() and
+OutputSink.read_huc8()), e.g. to compare the labels of two runs. Output written before raw labels were output has no
+raw_label column.
+"""
+
+import os
+import re
+import csv
+import sqlite3
+import hashlib
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple, Union
+
+from lwi_model_naming_conventions.manifest import file_digest
+
+
+class LabeledReach(NamedTuple):
+    """
+    A labeled flowline, as output for each flowline by labeling. raw_label is the delimited form of the stream label
+    (e.g. '0a05-3-12'), from which it can be encoded again (see the reencode command).
+    """
+    stream_label: str
+    ws_code: str
+    huc8: str
+    comid: Union[int, float]
+    reachcode: str
+    divergence: int
+    raw_label: Optional[str] = None
+
+
+OUTPUT_FIELDS = list(LabeledReach._fields)
+OUTPUT_STREAM_LABEL = 0
+OUTPUT_WS_CODE = 1
+OUTPUT_HUC8 = 2
+OUTPUT_COMID = 3
+OUTPUT_REACHCODE = 4
+OUTPUT_DIVERGENCE = 5
+OUTPUT_RAW_LABEL = 6
+
+SQLITE_OUTPUT_FILE = 'stream_labels.sqlite'
+SQLITE_OUTPUT_TABLE = 'stream_labels'
+SQLITE_BATCH_SIZE = 10000
+# Workers writing to the same SQLite database wait for each other's transactions to finish
+SQLITE_TIMEOUT = 600
+
+# Names of per-HUC8 output files, as {ws_code}_{huc8}.{extension}
+_HUC8_FILE_NAME = re.compile(r'^(?P<ws_code>[^_]+)_(?P<huc8>\d{8})\.(?P<extension>\w+)$')
+
+
+def typed_rows(rows: Iterable[Tuple]) -> Iterator[Tuple]:
+    """
+    Convert labeled reaches read back as strings (e.g. from CSV) to the types they were labeled with, so that they can
+    be written to any sink. Reaches without a raw label (see LabeledReach) are given a raw label of None.
+    """
+    for row in rows:
+        comid, divergence = row[OUTPUT_COMID], row[OUTPUT_DIVERGENCE]
+        if isinstance(comid, str):
+            # NHDPlus HR NHDPlusIDs are floating point
+            comid = int(comid) if comid.isdigit() else float(comid)
+        if isinstance(divergence, str):
+            divergence = int(divergence) if divergence else None
+        raw_label = row[OUTPUT_RAW_LABEL] if len(row) > OUTPUT_RAW_LABEL else None
+        yield (row[OUTPUT_STREAM_LABEL], row[OUTPUT_WS_CODE], row[OUTPUT_HUC8], comid, row[OUTPUT_REACHCODE],
+               divergence, raw_label or None)
+
+
+def _huc8_files(output_dir: str, extension: str) -> List[Tuple[str, str]]:
+    """
+    :return: (ws_code, huc8) of each per-HUC8 output file with extension in output_dir, sorted by HUC8
+    """
+    found = []
+    for name in os.listdir(output_dir):
+        m = _HUC8_FILE_NAME.match(name)
+        if m and m.group('extension') == extension:
+            found.append((m.group('ws_code'), m.group('huc8')))
+    return sorted(found, key=lambda ws: (ws[1], ws[0]))
+
+
+class OutputSink:
+    format = None
+
+    def __init__(self, output_dir: str):
+        self.output_dir = output_dir
+
+    def prepare(self):
+        """
+        Prepare the sink for output. Called once per run, before any HUC8 is written.
+        """
+        pass
+
+    def write_huc8(self, ws_code: str, huc8: str, rows: Iterable[Tuple]):
+        """
+        Write labeled reaches of a HUC8, replacing any previously written for the HUC8.
+        """
+        raise NotImplementedError()
+
+    def checksums(self, ws_code: str, huc8: str) -> Dict[str, str]:
+        """
+        :return: Checksums of the output of a HUC8, keyed by output name, used to verify that output is intact
+            when deciding whether a HUC8 needs to be relabeled. A checksum is None if there is no output.
+        """
+        raise NotImplementedError()
+
+    def huc8s(self) -> List[Tuple[str, str]]:
+        """
+        :return: (ws_code, huc8) of each HUC8 previously written to the sink, sorted by HUC8
+        """
+        raise NotImplementedError()
+
+    def read_huc8(self, ws_code: str, huc8: str) -> Iterable[Tuple]:
+        """
+        :return: Labeled reaches previously written for a HUC8, as tuples of OUTPUT_FIELDS. Values may be read
+            back as strings, depending on the sink.
+        """
+        raise NotImplementedError()
+
+    def close(self):
+        pass
+
+
+class CSVOutputSink(OutputSink):
+    format = 'csv'
+
+    def path(self, ws_code: str, huc8: str) -> str:
+        return os.path.join(self.output_dir, f"{ws_code}_{huc8}.csv")
+
+    def write_huc8(self, ws_code: str, huc8: str, rows: Iterable[Tuple]):
+        with open(self.path(ws_code, huc8), 'w') as csvfile:
+            w = csv.writer(csvfile, delimiter=',', quotechar='"')
+            w.writerow(OUTPUT_FIELDS)
+            w.writerows(rows)
+
+    def checksums(self, ws_code: str, huc8: str) -> Dict[str, str]:
+        path = self.path(ws_code, huc8)
+        return {os.path.basename(path): file_digest(path)}
+
+    def huc8s(self) -> List[Tuple[str, str]]:
+        return _huc8_files(self.output_dir, self.format)
+
+    def read_huc8(self, ws_code: str, huc8: str) -> Iterable[Tuple]:
+        with open(self.path(ws_code, huc8), 'r', newline='') as csvfile:
+            reader = csv.reader(csvfile)
+            next(reader, None)
+            yield from reader
+
+
+class SQLiteOutputSink(OutputSink):
+    format = 'sqlite'
+
+    def __init__(self, output_dir: str):
+        super().__init__(output_dir)
+        self.path = os.path.join(output_dir, SQLITE_OUTPUT_FILE)
+        self._conn = None
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        # Connect lazily so that each worker process opens its own connection. The connection may be used by a
+        # thread other than the one that opened it (e.g. a pipeline's writer thread), but only by one at a time.
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, timeout=SQLITE_TIMEOUT, isolation_level=None,
+                                         check_same_thread=False)
+        return self._conn
+
+    def prepare(self):
+        conn = self.conn
+        conn.execute('pragma journal_mode=wal')
+        conn.execute((f"create table if not exists {SQLITE_OUTPUT_TABLE} (stream_label text not null, "
+                      'ws_code text not null, huc8 text not null, comid not null, reachcode text not null, '
+                      'divergence integer, raw_label text)'))
+        if 'raw_label' not in {row[1] for row in conn.execute(f"pragma table_info({SQLITE_OUTPUT_TABLE})")}:
+            # Written before raw labels were output
+            conn.execute(f"alter table {SQLITE_OUTPUT_TABLE} add column raw_label text")
+        conn.execute(f"create index if not exists {SQLITE_OUTPUT_TABLE}_stream_label_idx "
+                     f"on {SQLITE_OUTPUT_TABLE} (stream_label)")
+        conn.execute(f"create index if not exists {SQLITE_OUTPUT_TABLE}_comid_idx on {SQLITE_OUTPUT_TABLE} (comid)")
+        conn.execute(f"create index if not exists {SQLITE_OUTPUT_TABLE}_huc8_idx "
+                     f"on {SQLITE_OUTPUT_TABLE} (huc8, ws_code)")
+
+    def write_huc8(self, ws_code: str, huc8: str, rows: Iterable[Tuple]):
+        conn = self.conn
+        insert = (f"insert into {SQLITE_OUTPUT_TABLE} ({', '.join(OUTPUT_FIELDS)}) "
+                  f"values ({', '.join('?' * len(OUTPUT_FIELDS))})")
+        conn.execute('begin immediate')
+        try:
+            conn.execute(f"delete from {SQLITE_OUTPUT_TABLE} where huc8=?", (huc8,))
+            batch = []
+            for row in rows:
+                batch.append(row)
+                if len(batch) == SQLITE_BATCH_SIZE:
+                    conn.executemany(insert, batch)
+                    batch = []
+            conn.executemany(insert, batch)
+        except BaseException:
+            conn.execute('rollback')
+            raise
+        conn.execute('commit')
+
+    def checksums(self, ws_code: str, huc8: str) -> Dict[str, str]:
+        h = hashlib.sha256()
+        num_rows = 0
+        if os.path.exists(self.path):
+            cur = self.conn.execute(f"select * from {SQLITE_OUTPUT_TABLE} where huc8=? and ws_code=? order by rowid",
+                                    (huc8, ws_code))
+            for row in cur:
+                h.update(repr(row).encode())
+                num_rows += 1
+        return {f"{SQLITE_OUTPUT_FILE}:{ws_code}_{huc8}": h.hexdigest() if num_rows else None}
+
+    def huc8s(self) -> List[Tuple[str, str]]:
+        if not os.path.exists(self.path):
+            return []
+        return [(ws_code, huc8) for ws_code, huc8 in
+                self.conn.execute(f"select distinct ws_code, huc8 from {SQLITE_OUTPUT_TABLE} order by huc8, ws_code")]
+
+    def read_huc8(self, ws_code: str, huc8: str) -> Iterable[Tuple]:
+        # A cursor of its own, so that HUC8s of two sinks on the same database can be read at once
+        return self.conn.cursor().execute(f"select * from {SQLITE_OUTPUT_TABLE} where huc8=? and ws_code=? "
+                                          'order by rowid', (huc8, ws_code))
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+class ParquetOutputSink(OutputSink):
+    format = 'parquet'
+
+    def __init__(self, output_dir: str):
+        super().__init__(output_dir)
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ImportError("Parquet output requires pyarrow, which can be installed with "
+                              "'pip install lwi-model-naming-conventions[parquet]'.")
+        self.pa = pyarrow
+        self.pq = pyarrow.parquet
+
+    def path(self, ws_code: str, huc8: str) -> str:
+        return os.path.join(self.output_dir, f"{ws_code}_{huc8}.parquet")
+
+    def write_huc8(self, ws_code: str, huc8: str, rows: Iterable[Tuple]):
+        columns = [[] for _ in OUTPUT_FIELDS]
+        for row in rows:
+            for column, value in zip(columns, row):
+                column.append(value)
+        table = self.pa.table(dict(zip(OUTPUT_FIELDS, columns)))
+        self.pq.write_table(table, self.path(ws_code, huc8))
+
+    def checksums(self, ws_code: str, huc8: str) -> Dict[str, str]:
+        path = self.path(ws_code, huc8)
+        return {os.path.basename(path): file_digest(path)}
+
+    def huc8s(self) -> List[Tuple[str, str]]:
+        return _huc8_files(self.output_dir, self.format)
+
+    def read_huc8(self, ws_code: str, huc8: str) -> Iterable[Tuple]:
+        path = self.path(ws_code, huc8)
+        names = self.pq.read_schema(path).names
+        table = self.pq.read_table(path, columns=[name for name in OUTPUT_FIELDS if name in names])
+        for batch in table.to_batches():
+            yield from zip(*(column.to_pylist() for column in batch.columns))
+
+
+OUTPUT_SINKS = {s.format: s for s in (CSVOutputSink, SQLiteOutputSink, ParquetOutputSink)}
+
+# Output sinks opened by this process, keyed by format and output directory
+_output_sinks: Dict[Tuple[str, str], OutputSink] = {}
+
+
+def get_output_sink(output_format: str, output_dir: str) -> OutputSink:
+    key = (output_format, output_dir)
+    sink = _output_sinks.get(key)
+    if sink is None:
+        sink = OUTPUT_SINKS[output_format](output_dir)
+        _output_sinks[key] = sink
+    return sink
+
+
+def get_output_sinks(output_format: str, output_dir: str, label_index: bool = False) -> List[OutputSink]:
+    """
+    :param label_index: Whether to also output to the SQLite database used as the label index (see label_index.py),
+        if output_format is not already sqlite
+    :return: Output sinks to write labeled reaches to
+    """
+    sinks = [get_output_sink(output_format, output_dir)]
+    if label_index and output_format != SQLiteOutputSink.format:
+        sinks.append(get_output_sink(SQLiteOutputSink.format, output_dir))
+    return sinks
@@ -0,0 +1,172 @@
+# Copyright (C) 2021-present State of Louisiana, Division of Administration, Office of Community Development.
+# All rights reserved. Licensed under the GPLv3 License. See LICENSE.txt in the project root for license information.
+
+import time
+import sqlite3
+from typing import Dict, Iterable, Tuple
+
+from lwi_model_naming_conventions.network import FlowlineNetwork, RegionNetwork, load_huc8_network, \
+    load_huc8_network_hr, load_region_network, load_region_network_hr
+from lwi_model_naming_conventions.network_cache import NetworkCache
+from lwi_model_naming_conventions.hydroseq import load_huc8_network_hydroseq, load_huc8_network_hydroseq_hr
+from lwi_model_naming_conventions.database import connect_nhdplus
+from lwi_model_naming_conventions.flowline_cache import FlowlineCache, DEFAULT_FLOWLINE_CACHE_SIZE
+
+
+class TimedCursor:
+    """
+    Wraps a cursor, adding the time spent executing queries and fetching their results to source.query_seconds.
+    """
+    def __init__(self, cursor: sqlite3.Cursor, source: 'NetworkSource'):
+        self.cursor = cursor
+        self.source = source
+
+    def _timed(self, func, *args):
+        start = time.perf_counter()
+        try:
+            return func(*args)
+        finally:
+            self.source.query_seconds += time.perf_counter() - start
+
+    def execute(self, sql: str, parameters=()) -> 'TimedCursor':
+        self._timed(self.cursor.execute, sql, parameters)
+        return self
+
+    def fetchone(self):
+        return self._timed(self.cursor.fetchone)
+
+    def fetchall(self) -> list:
+        return self._timed(self.cursor.fetchall)
+
+    def __iter__(self):
+        return iter(self.fetchall())
+
+
+class NetworkSource:
+    """
+    Loads HUC8 subnetworks from either the NHDPlus SQLite databases or a network cache, keeping the databases
+    (or the cache) open between HUC8s. Databases are opened read-only (see database.connect_nhdplus()).
+    num_queries counts the SQL statements executed on the databases, and
+    query_seconds the time spent executing them and fetching their results.
+
+    Flowlines loaded from the databases are kept in a FlowlineCache of flowline_cache_size entries (disabled if 0),
+    so that flowlines across the boundary of a HUC8 that were loaded with a neighboring HUC8 aren't queried again.
+
+    If hydroseq is True, HUC8 subnetworks are instead loaded from the VAA routing columns of the flowline database
+    (see hydroseq.py), and the flow tables (and flowline cache) are not used.
+    """
+    def __init__(self, flowline_path: str = None, plusflow_path: str = None, nhd_hr: bool = False,
+                 network_cache_path: str = None, flowline_cache_size: int = DEFAULT_FLOWLINE_CACHE_SIZE,
+                 hydroseq: bool = False):
+        self.flowline_path = flowline_path
+        self.plusflow_path = plusflow_path
+        self.nhd_hr = nhd_hr
+        self.network_cache_path = network_cache_path
+        self.hydroseq = hydroseq
+        self.cache = None
+        self.flowline_cache = None
+        self.flowline_conn = None
+        self.plusflow_conn = None
+        self.num_queries = 0
+        self.query_seconds = 0.0
+        if network_cache_path:
+            self.cache = NetworkCache(network_cache_path)
+        else:
+            if flowline_cache_size and not self.hydroseq:
+                self.flowline_cache = FlowlineCache(flowline_cache_size)
+            self.flowline_conn = connect_nhdplus(flowline_path)
+            self.flowline_conn.set_trace_callback(self._count_query)
+            if not nhd_hr and not self.hydroseq:
+                self.plusflow_conn = connect_nhdplus(plusflow_path)
+                self.plusflow_conn.set_trace_callback(self._count_query)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _count_query(self, statement: str):
+        self.num_queries += 1
+
+    def close(self):
+        if self.cache is not None:
+            self.cache.close()
+            self.cache = None
+        if self.flowline_conn is not None:
+            self.flowline_conn.close()
+            self.flowline_conn = None
+        if self.plusflow_conn is not None:
+            self.plusflow_conn.close()
+            self.plusflow_conn = None
+
+    def load_huc8_network(self, huc8: str) -> FlowlineNetwork:
+        if self.cache is not None:
+            return self.cache.load_huc8_network(huc8)
+        if self.hydroseq:
+            if self.nhd_hr:
+                return load_huc8_network_hydroseq_hr(TimedCursor(self.flowline_conn.cursor(), self), huc8)
+            return load_huc8_network_hydroseq(TimedCursor(self.flowline_conn.cursor(), self), huc8)
+        if self.nhd_hr:
+            return load_huc8_network_hr(TimedCursor(self.flowline_conn.cursor(), self), huc8, self.flowline_cache)
+        return load_huc8_network(TimedCursor(self.flowline_conn.cursor(), self),
+                                 TimedCursor(self.plusflow_conn.cursor(), self), huc8, self.flowline_cache)
+
+    def load_region_network(self, huc8s: Iterable[str], hucs: Iterable[str] = None) -> RegionNetwork:
+        """
+        Load the network of a region once, for labeling each of huc8s.
+
+        :param hucs: HUCs (e.g. HUC4s) making up the region. Defaults to huc8s.
+        """
+        if self.cache is not None:
+            raise ValueError('Regions are loaded from the NHDPlus databases, not a network cache.')
+        if self.hydroseq:
+            raise ValueError('Regions are loaded from the NHDPlus flow tables, not the VAA routing columns.')
+        huc8s = list(huc8s)
+        if hucs is None:
+            hucs = huc8s
+        if self.nhd_hr:
+            network = load_region_network_hr(TimedCursor(self.flowline_conn.cursor(), self), hucs)
+        else:
+            network = load_region_network(TimedCursor(self.flowline_conn.cursor(), self),
+                                          TimedCursor(self.plusflow_conn.cursor(), self), hucs)
+        return RegionNetwork(network, huc8s)
+
+    def count_flowlines(self, huc8: str) -> int:
+        """
+        :return: Number of flowlines in huc8, used to estimate the cost of labeling it
+        """
+        if self.cache is not None:
+            return len(self.cache.huc8_range(huc8))
+        cur = TimedCursor(self.flowline_conn.cursor(), self)
+        if self.nhd_hr:
+            cur.execute('select count(*) from nhdflowline where reachcode like ?', (f"{huc8}%",))
+        else:
+            cur.execute('select count(*) from nhdflowline_network where reachcode like ?', (f"{huc8}%",))
+        return cur.fetchone()[0]
+
+
+# Network sources opened by this process, keyed by their paths, so that each worker process opens the
+# databases (or cache) only once.
+_network_sources: Dict[Tuple, NetworkSource] = {}
+
+
+def get_network_source(flowline_path: str = None, plusflow_path: str = None, nhd_hr: bool = False,
+                       network_cache_path: str = None, flowline_cache_size: int = DEFAULT_FLOWLINE_CACHE_SIZE,
+                       hydroseq: bool = False) -> NetworkSource:
+    key = (flowline_path, plusflow_path, nhd_hr, network_cache_path, flowline_cache_size, hydroseq)
+    source = _network_sources.get(key)
+    if source is None:
+        source = NetworkSource(flowline_path, plusflow_path, nhd_hr, network_cache_path, flowline_cache_size,
+                               hydroseq)
+        _network_sources[key] = source
+    return source
+
+
+def init_worker_network_source(flowline_path: str = None, plusflow_path: str = None, nhd_hr: bool = False,
+                               network_cache_path: str = None,
+                               flowline_cache_size: int = DEFAULT_FLOWLINE_CACHE_SIZE, hydroseq: bool = False):
+    """
+    multiprocessing.Pool initializer that opens a worker's network source once, when the worker starts.
+    """
+    get_network_source(flowline_path, plusflow_path, nhd_hr, network_cache_path, flowline_cache_size, hydroseq)
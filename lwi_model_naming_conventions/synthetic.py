@@ -0,0 +1,251 @@
+# Copyright (C) 2021-present State of Louisiana, Division of Administration, Office of Community Development.
+# All rights reserved. Licensed under the GPLv3 License. See LICENSE.txt in the project root for license information.
+
+"""
+Synthetic NHDPlus networks, for benchmarking and checking labeling without downloading NHDPlus.
+
+Each HUC8 is made up of drainage basins, each draining either to the coast (coastal outlets, stream level 1) or into
+a flowline of the previous HUC8. A stream of Strahler order n is a chain of reaches that starts at the confluence of
+two streams of order n - 1, and may be joined along the way by tributaries of lower order (see branching) and split
+into major and minor flowpaths that rejoin downstream (see divergence). Streams of order 1 start at headwater reaches
+(startflag=1).
+
+Networks are written as SQLite databases with the same tables as those prepared by download-data.sh (NHDPlus V2),
+or the NHDPlus HR tables described in README.md, including the VAA routing columns (see compute_vaa_routing()).
+"""
+
+import os
+import random
+import sqlite3
+from collections import deque
+from typing import Dict, List, Tuple
+
+DEFAULT_HUC6 = '080801'
+# NHDPlus HR NHDPlusIDs are large numbers stored as floating point
+NHDPLUSID_BASE = 55000100000000
+HYDROSEQ_BASE = 350000000
+
+
+class SyntheticNetwork:
+    def __init__(self):
+        # comid -> [reachcode, stream level, Strahler order, divergence, startflag]
+        self.flowlines: Dict[int, List] = {}
+        # (from comid, to comid)
+        self.edges: List[Tuple[int, int]] = []
+        self.huc8s: List[str] = []
+
+    def __len__(self):
+        return len(self.flowlines)
+
+
+class _Generator:
+    def __init__(self, network: SyntheticNetwork, rng: random.Random, branching: float, divergence: float):
+        self.network = network
+        self.rng = rng
+        self.branching = branching
+        self.divergence = divergence
+        self.next_comid = 1000
+        self.num_reaches_in_huc8: Dict[str, int] = {}
+
+    def add_reach(self, huc8: str, stream_level: int, strahler_order: int, divergence: int = 0) -> int:
+        self.next_comid += self.rng.randint(1, 9)
+        num_reaches = self.num_reaches_in_huc8.get(huc8, 0) + 1
+        self.num_reaches_in_huc8[huc8] = num_reaches
+        self.network.flowlines[self.next_comid] = [f"{huc8}{num_reaches:06d}", stream_level, strahler_order,
+                                                   divergence, 0]
+        return self.next_comid
+
+    def add_stream(self, huc8: str, downstream: int, strahler_order: int, stream_level: int):
+        """
+        Add a stream flowing into downstream (or the coast if None), and all of the streams upstream of it.
+        """
+        # Streams are added iteratively as deep networks would exceed the recursion limit
+        streams = [(downstream, strahler_order, stream_level)]
+        while streams:
+            downstream, strahler_order, stream_level = streams.pop()
+            reach = None
+            for _ in range(self.rng.randint(1, 4)):
+                reach = self.add_reach(huc8, stream_level, strahler_order)
+                if downstream is not None and self.rng.random() < self.divergence:
+                    # Split into a major and a minor flowpath, which rejoin at the downstream reach
+                    major = self.add_reach(huc8, stream_level, strahler_order, 1)
+                    minor = self.add_reach(huc8, stream_level + 1, strahler_order, 2)
+                    self.network.edges.extend([(reach, major), (reach, minor), (major, downstream),
+                                               (minor, downstream)])
+                elif downstream is not None:
+                    self.network.edges.append((reach, downstream))
+                if strahler_order > 1 and self.rng.random() < self.branching:
+                    streams.append((reach, self.rng.randint(1, strahler_order - 1), stream_level + 1))
+                downstream = reach
+            if strahler_order > 1:
+                # Confluence of two streams of the next lower order
+                streams.append((reach, strahler_order - 1, stream_level))
+                streams.append((reach, strahler_order - 1, stream_level + 1))
+            else:
+                self.network.flowlines[reach][4] = 1
+
+
+def generate_network(num_reaches: int = 10000, num_huc8s: int = 4, branching: float = 0.4, max_order: int = 5,
+                     divergence: float = 0.1, coastal_outlets: int = 2, seed: int = 0,
+                     huc6: str = DEFAULT_HUC6) -> SyntheticNetwork:
+    """
+    Generate a synthetic network of about num_reaches flowlines (more if a basin of order max_order is larger than
+    num_reaches / num_huc8s) in num_huc8s HUC8s.
+
+    :param branching: Probability that a tributary of lower order joins a stream at each reach
+    :param max_order: Maximum Strahler order of a drainage basin
+    :param divergence: Probability that a stream splits into a major and minor flowpath at each reach
+    :param coastal_outlets: Number of drainage basins in each HUC8 draining to the coast. Other basins drain into
+        the previous HUC8 (and those of the first HUC8 to the coast).
+    """
+    network = SyntheticNetwork()
+    generator = _Generator(network, random.Random(seed), branching, divergence)
+    rng = generator.rng
+    network.huc8s = [f"{huc6}{i + 1:02d}" for i in range(num_huc8s)]
+    reaches_per_huc8 = num_reaches // num_huc8s
+    prev_huc8_reaches = None
+    for huc8 in network.huc8s:
+        num_basins = 0
+        first_reach = len(network.flowlines)
+        while len(network.flowlines) - first_reach < reaches_per_huc8:
+            strahler_order = rng.randint(1, max_order)
+            if num_basins < coastal_outlets or prev_huc8_reaches is None:
+                generator.add_stream(huc8, None, strahler_order, 1)
+            else:
+                downstream = rng.choice(prev_huc8_reaches)
+                generator.add_stream(huc8, downstream, strahler_order, network.flowlines[downstream][1] + 1)
+            num_basins += 1
+        prev_huc8_reaches = list(network.flowlines)[first_reach:]
+    return network
+
+
+def compute_vaa_routing(network: SyntheticNetwork) -> Dict[int, Tuple[int, int, int, int, int]]:
+    """
+    Compute the VAA routing columns of each flowline, as NHDPlus does: its hydroseq (numbered upstream from the
+    outlets, so that it is greater than those of its downstream flowlines), uphydroseq (the hydroseq of its major
+    upstream flowline, that of the lowest stream level, or 0 if none), dnhydroseq and dnminorhyd (the hydroseqs of its
+    major and minor downstream flowlines, or 0 if none), and levelpathi (the hydroseq of the most downstream flowline
+    of the path of major upstream flowlines that it is on).
+
+    :return: Tuple of (hydroseq, uphydroseq, dnhydroseq, dnminorhyd, levelpathi) of each flowline, keyed by COMID
+    """
+    flowlines = network.flowlines
+    downstream = {comid: [] for comid in flowlines}
+    upstream = {comid: [] for comid in flowlines}
+    for from_comid, to_comid in network.edges:
+        downstream[from_comid].append(to_comid)
+        upstream[to_comid].append(from_comid)
+    # Number each flowline once all of its downstream flowlines have been numbered
+    remaining = {comid: len(d) for comid, d in downstream.items()}
+    queue = deque(sorted(comid for comid, n in remaining.items() if n == 0))
+    hydroseq = {}
+    while queue:
+        comid = queue.popleft()
+        hydroseq[comid] = HYDROSEQ_BASE + len(hydroseq) + 1
+        for u in sorted(upstream[comid]):
+            remaining[u] -= 1
+            if remaining[u] == 0:
+                queue.append(u)
+    # The major downstream flowline is the one that isn't a minor flowpath of a divergence
+    major_downstream = {comid: sorted(d, key=lambda c: (flowlines[c][3] == 2, c)) for comid, d in downstream.items()}
+    routing = {}
+    for comid in sorted(hydroseq, key=hydroseq.get):
+        dn = major_downstream[comid]
+        major_upstream = [u for u in upstream[comid] if major_downstream[u][0] == comid]
+        up = min(major_upstream, key=lambda c: (flowlines[c][1], hydroseq[c]), default=None)
+        levelpathi = hydroseq[comid]
+        if dn and routing[dn[0]][1] == hydroseq[comid]:
+            levelpathi = routing[dn[0]][4]
+        routing[comid] = (hydroseq[comid], hydroseq[up] if up is not None else 0, hydroseq[dn[0]] if dn else 0,
+                          hydroseq[dn[1]] if len(dn) > 1 else 0, levelpathi)
+    return routing
+
+
+def write_nhdplus_v2(network: SyntheticNetwork, flowline_path: str, plusflow_path: str):
+    routing = compute_vaa_routing(network)
+    conn = sqlite3.connect(flowline_path)
+    conn.execute(('create table nhdflowline_network (comid integer, reachcode text, streamleve integer, '
+                  'streamorde integer, divergence integer, startflag integer, hydroseq integer, uphydroseq integer, '
+                  'dnhydroseq integer, dnminorhyd integer, levelpathi integer)'))
+    conn.executemany('insert into nhdflowline_network values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                     [(comid, *attributes, *routing[comid]) for comid, attributes in network.flowlines.items()])
+    conn.execute('create index nhd_flow_reachcode_idx on nhdflowline_network (reachcode COLLATE NOCASE)')
+    conn.execute('create index nhd_flow_comid_idx on nhdflowline_network (comid)')
+    conn.commit()
+    conn.close()
+
+    # As in NHDPlus, headwaters flow from COMID 0, and coastal outlets to COMID 0
+    edges = list(network.edges)
+    has_downstream = {f for f, _ in edges}
+    for comid, attributes in network.flowlines.items():
+        if attributes[4] == 1:
+            edges.append((0, comid))
+        if comid not in has_downstream:
+            edges.append((comid, 0))
+    # Unlike the order of flowlines, which matters in some cases, the order of flow table rows should not
+    random.Random(len(edges)).shuffle(edges)
+    conn = sqlite3.connect(plusflow_path)
+    conn.execute('create table plusflow (fromcomid integer, tocomid integer)')
+    conn.executemany('insert into plusflow values (?, ?)', edges)
+    conn.execute('create index nhd_plusflow_tocomid_idx on plusflow (tocomid)')
+    conn.execute('create index nhd_plusflow_fromcomid_idx on plusflow (fromcomid)')
+    conn.commit()
+    conn.close()
+
+
+def write_nhdplus_hr(network: SyntheticNetwork, path: str):
+    def nhdplusid(comid: int) -> float:
+        return float(NHDPLUSID_BASE + comid)
+
+    routing = compute_vaa_routing(network)
+    conn = sqlite3.connect(path)
+    conn.execute('create table nhdflowline (nhdplusid real, reachcode text)')
+    conn.execute(('create table nhdplusflowlinevaa (nhdplusid real, reachcode text, streamleve integer, '
+                  'streamorde integer, divergence integer, startflag integer, hydroseq real, uphydroseq real, '
+                  'dnhydroseq real, dnminorhyd real, levelpathi real)'))
+    conn.execute('create table nhdplusflow (fromnhdpid real, tonhdpid real)')
+    conn.executemany('insert into nhdflowline values (?, ?)',
+                     [(nhdplusid(comid), attributes[0]) for comid, attributes in network.flowlines.items()])
+    conn.executemany('insert into nhdplusflowlinevaa values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                     [(nhdplusid(comid), *attributes, *routing[comid])
+                      for comid, attributes in network.flowlines.items()])
+    edges = [(nhdplusid(f), nhdplusid(t)) for f, t in network.edges]
+    random.Random(len(edges)).shuffle(edges)
+    conn.executemany('insert into nhdplusflow values (?, ?)', edges)
+    conn.execute('create index nhdflowline_nhdplusid_idx on nhdflowline (nhdplusid)')
+    conn.execute('create index nhdplusflowlinevaa_nhdplusid_idx on nhdplusflowlinevaa (nhdplusid)')
+    conn.execute('create index nhdplusflow_fromnhdpid_idx on nhdplusflow (fromnhdpid)')
+    conn.execute('create index nhdplusflow_tonhdpid_idx on nhdplusflow (tonhdpid)')
+    conn.commit()
+    conn.close()
+
+
+def write_watersheds(network: SyntheticNetwork, path: str):
+    with open(path, 'w') as f:
+        f.write('WS_code,HUC8,Name\n')
+        for i, huc8 in enumerate(network.huc8s):
+            ws_code = chr(ord('A') + i // 26) + chr(ord('A') + i % 26)
+            f.write(f'"{ws_code}","{huc8}","Synthetic {huc8}"\n')
+
+
+def write_synthetic_data(network: SyntheticNetwork, output_dir: str) -> Dict[str, str]:
+    """
+    Write NHDPlus V2 and HR databases and a watershed definition file for network to output_dir, which must not
+    already contain them.
+
+    :return: Paths written, keyed by 'flowline', 'plusflow', 'nhdplushr', and 'watersheds'
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    paths = {
+        'flowline': os.path.join(output_dir, 'NHDFlowline_Network.sqlite'),
+        'plusflow': os.path.join(output_dir, 'NHD_PlusFlow.sqlite'),
+        'nhdplushr': os.path.join(output_dir, 'NHDPlusHR.sqlite'),
+        'watersheds': os.path.join(output_dir, 'watersheds.csv')
+    }
+    for key in ('flowline', 'plusflow', 'nhdplushr'):
+        if os.path.exists(paths[key]):
+            raise FileExistsError(f"{paths[key]} already exists.")
+    write_nhdplus_v2(network, paths['flowline'], paths['plusflow'])
+    write_nhdplus_hr(network, paths['nhdplushr'])
+    write_watersheds(network, paths['watersheds'])
+    return paths
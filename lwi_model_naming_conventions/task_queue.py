@@ -0,0 +1,432 @@
+# Copyright (C) 2021-present State of Louisiana, Division of Administration, Office of Community Development.
+# All rights reserved. Licensed under the GPLv3 License. See LICENSE.txt in the project root for license information.
+
+"""
+File-based queue of watersheds to label, shared by worker processes on any number of nodes, so that a run can use
+more cores than one node has.
+
+A queue is a directory, on a filesystem shared by the nodes (or a local one, for workers on a single node),
+created by a coordinator (see TaskQueue.create()):
+    queue.json: Labeling options of the run (label encoding, output format, NHDPlus HR), lease duration, and
+        maximum number of attempts of each task
+    tasks/{ws_code}_{huc8}.json: One task per watershed, with its estimated size (number of flowlines)
+    leases/{ws_code}_{huc8}.{attempt}: Lease of an attempt at a task by a worker. The worker heartbeats by
+        touching the file, so its modification time is when the worker was last known to be alive.
+    staging/: Output of tasks being labeled, one directory per attempt
+    results/{ws_code}_{huc8}/: Output of a completed task: labeled reaches, log, and manifest entry (RESULT_FILE)
+    failed/{ws_code}_{huc8}.json: Error of a failed task
+
+Workers claim tasks largest first. A task is claimed by exclusively creating (O_EXCL) the lease file of its next
+attempt: attempt 1 if it has never been leased, or the attempt after its latest one if that lease is stale (has not
+been heartbeat for the lease duration, e.g. because its worker's node went down). Only one worker can create each
+lease file, so each attempt is made by a single worker. A task whose last allowed attempt goes stale, or whose
+labeling raises an exception, is failed rather than retried.
+
+A worker labels a task into a staging directory of its own, then renames the directory into results/. Renames are
+atomic, so a task's result is either absent or complete, and as a directory can't be renamed over a non-empty one,
+only the first attempt to finish is kept (e.g. if a slow worker finishes after its task was retried). These are the
+only guarantees relied on, and they hold on NFS. Lease staleness is judged by comparing file modification times
+with the clock of the node checking them, so the clocks of the nodes must agree to well within the lease duration.
+
+Once all tasks are done, the merge stage (see merge_results()) combines the outputs and logs of all tasks into an
+output directory.
+"""
+
+import os
+import json
+import time
+import errno
+import shutil
+import socket
+import threading
+import traceback
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+from lwi_model_naming_conventions.sinks import OUTPUT_SINKS, CSVOutputSink, OutputSink, SQLiteOutputSink, typed_rows
+
+QUEUE_FILE = 'queue.json'
+QUEUE_VERSION = 1
+RESULT_FILE = 'result.json'
+DEFAULT_LEASE_SECONDS = 300
+DEFAULT_MAX_ATTEMPTS = 3
+# Maximum number of seconds an idle worker waits before checking the queue for tasks again
+MAX_POLL_SECONDS = 10
+
+PENDING = 'pending'
+LEASED = 'leased'
+DONE = 'done'
+FAILED = 'failed'
+TASK_STATES = [PENDING, LEASED, DONE, FAILED]
+
+
+def task_key(ws_code: str, huc8: str) -> str:
+    return f"{ws_code}_{huc8}"
+
+
+def staging_format(output_format: str) -> str:
+    """
+    :return: Format that workers write the output of tasks in: the run's output format, unless that is sqlite, which
+        is written to a single database (by the merge stage) rather than one file per HUC8
+    """
+    return CSVOutputSink.format if output_format == SQLiteOutputSink.format else output_format
+
+
+def _write_json(path: str, value):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(value, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def _read_json(path: str):
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def _create_exclusive(path: str, value) -> bool:
+    """
+    Create the file at path with value as JSON, unless it already exists.
+
+    :return: Whether the file was created
+    """
+    try:
+        fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+    except FileExistsError:
+        return False
+    with os.fdopen(fd, 'w', encoding='utf-8') as f:
+        json.dump(value, f, sort_keys=True)
+    return True
+
+
+def default_worker_id() -> str:
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+class Lease:
+    """
+    A worker's lease of an attempt at a task.
+    """
+    def __init__(self, queue: 'TaskQueue', task: dict, attempt: int, worker_id: str):
+        self.queue = queue
+        self.task = task
+        self.attempt = attempt
+        self.worker_id = worker_id
+        self.path = queue.lease_path(task['key'], attempt)
+
+    def heartbeat(self):
+        """
+        Mark the lease as live, unless it has been removed (i.e. the task was completed by another attempt).
+        """
+        try:
+            os.utime(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class Heartbeat:
+    """
+    Context manager that heartbeats a lease in a background thread, every third of the lease duration, while the
+    task is labeled.
+    """
+    def __init__(self, lease: Lease):
+        self.lease = lease
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        interval = self.lease.queue.lease_seconds / 3
+        while not self._stopped.wait(interval):
+            self.lease.heartbeat()
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._stopped.set()
+        self._thread.join()
+
+
+class TaskQueue:
+    """
+    Queue of watersheds to label, in the directory at path.
+    """
+    def __init__(self, path: str):
+        queue_file = os.path.join(path, QUEUE_FILE)
+        if not os.path.exists(queue_file):
+            raise FileNotFoundError(f"Task queue {path} not found, it is created by the enqueue command.")
+        config = _read_json(queue_file)
+        if config.get('version') != QUEUE_VERSION:
+            raise ValueError(f"{path} is not a version {QUEUE_VERSION} task queue.")
+        self.path = path
+        self.options: dict = config['options']
+        self.lease_seconds: float = config['lease_seconds']
+        self.max_attempts: int = config['max_attempts']
+        self._tasks = None
+
+    @classmethod
+    def create(cls, path: str, watersheds: List[Tuple[str, str, str]], sizes: List[int], options: dict,
+               lease_seconds: float = DEFAULT_LEASE_SECONDS,
+               max_attempts: int = DEFAULT_MAX_ATTEMPTS) -> 'TaskQueue':
+        """
+        Create a queue with a task for each of watersheds.
+
+        :param sizes: Estimated size (number of flowlines) of each watershed, so that the largest are labeled first
+        :param options: Labeling options of the run: 'base32', 'output_format', and 'nhd_hr'
+        """
+        if os.path.exists(path) and os.listdir(path):
+            raise FileExistsError(f"{path} already exists and is not empty.")
+        for name in ('tasks', 'leases', 'staging', 'results', 'failed'):
+            os.makedirs(os.path.join(path, name), exist_ok=True)
+        for ws, size in zip(watersheds, sizes):
+            key = task_key(ws[0], ws[1])
+            _write_json(os.path.join(path, 'tasks', f"{key}.json"), {'key': key, 'ws': list(ws), 'size': size})
+        # The queue file is written last, so that workers don't start on a partially created queue
+        _write_json(os.path.join(path, QUEUE_FILE), {
+            'version': QUEUE_VERSION,
+            'options': options,
+            'lease_seconds': lease_seconds,
+            'max_attempts': max_attempts
+        })
+        return cls(path)
+
+    def tasks(self) -> List[dict]:
+        """
+        :return: Tasks, largest first, as dicts of 'key', 'ws' (watershed code, HUC8, and name), and 'size'
+        """
+        if self._tasks is None:
+            tasks_dir = os.path.join(self.path, 'tasks')
+            tasks = [_read_json(os.path.join(tasks_dir, name)) for name in sorted(os.listdir(tasks_dir))
+                     if name.endswith('.json')]
+            self._tasks = sorted(tasks, key=lambda t: t['size'], reverse=True)
+        return self._tasks
+
+    def lease_path(self, key: str, attempt: int) -> str:
+        return os.path.join(self.path, 'leases', f"{key}.{attempt}")
+
+    def result_dir(self, key: str) -> str:
+        return os.path.join(self.path, 'results', key)
+
+    def failed_path(self, key: str) -> str:
+        return os.path.join(self.path, 'failed', f"{key}.json")
+
+    def _latest_attempts(self) -> Dict[str, int]:
+        """
+        :return: Latest attempt at each task that has a lease
+        """
+        latest = {}
+        for name in os.listdir(os.path.join(self.path, 'leases')):
+            key, _, attempt = name.rpartition('.')
+            if attempt.isdigit():
+                latest[key] = max(latest.get(key, 0), int(attempt))
+        return latest
+
+    def _is_stale(self, key: str, attempt: int) -> bool:
+        try:
+            return time.time() - os.stat(self.lease_path(key, attempt)).st_mtime > self.lease_seconds
+        except FileNotFoundError:
+            # Removed since the leases were listed, i.e. the task has just been completed or failed
+            return False
+
+    def states(self) -> Dict[str, str]:
+        """
+        :return: State (see TASK_STATES) of each task, keyed by task key. A task whose latest lease is stale is
+            pending (if it has attempts left), as it will be claimed again.
+        """
+        done = set(os.listdir(os.path.join(self.path, 'results')))
+        failed = {name[:-len('.json')] for name in os.listdir(os.path.join(self.path, 'failed'))
+                  if name.endswith('.json')}
+        latest = self._latest_attempts()
+        states = {}
+        for task in self.tasks():
+            key = task['key']
+            if key in done:
+                states[key] = DONE
+            elif key in failed:
+                states[key] = FAILED
+            elif key in latest and not self._is_stale(key, latest[key]):
+                states[key] = LEASED
+            elif latest.get(key, 0) >= self.max_attempts:
+                states[key] = FAILED
+            else:
+                states[key] = PENDING
+        return states
+
+    def claim(self, worker_id: str) -> Optional[Lease]:
+        """
+        Claim the largest task that is neither done, failed, nor leased by a live worker.
+
+        :return: Lease of the claimed task, or None if there is none to claim
+        """
+        done = set(os.listdir(os.path.join(self.path, 'results')))
+        failed = set(os.listdir(os.path.join(self.path, 'failed')))
+        latest = self._latest_attempts()
+        for task in self.tasks():
+            key = task['key']
+            if key in done or f"{key}.json" in failed:
+                continue
+            attempt = latest.get(key, 0)
+            if attempt:
+                if not self._is_stale(key, attempt):
+                    continue
+                if attempt >= self.max_attempts:
+                    _create_exclusive(self.failed_path(key), {
+                        'key': key,
+                        'attempts': attempt,
+                        'error': f"Lease of attempt {attempt} expired, no attempts left."
+                    })
+                    continue
+            lease = Lease(self, task, attempt + 1, worker_id)
+            if _create_exclusive(lease.path, {'worker_id': worker_id, 'claimed': time.time()}):
+                return lease
+        return None
+
+    def staging_dir(self, lease: Lease) -> str:
+        return self._staging_dir(lease.task['key'], lease.attempt)
+
+    def _staging_dir(self, key: str, attempt: int) -> str:
+        return os.path.join(self.path, 'staging', f"{key}.{attempt}")
+
+    def _remove_leases(self, key: str):
+        """
+        Remove the leases of all attempts at a task, and the staging directories of attempts whose workers are gone
+        (or superseded, in which case they give up once they find the task is done).
+        """
+        for attempt in range(1, self._latest_attempts().get(key, 0) + 1):
+            try:
+                os.remove(self.lease_path(key, attempt))
+            except FileNotFoundError:
+                pass
+            shutil.rmtree(self._staging_dir(key, attempt), ignore_errors=True)
+
+    def is_done(self, key: str) -> bool:
+        return os.path.exists(self.result_dir(key))
+
+    def complete(self, lease: Lease, staging_dir: str) -> bool:
+        """
+        Complete lease's task with the output in staging_dir, unless another attempt has already completed it.
+
+        :return: Whether the output was kept
+        """
+        try:
+            os.rename(staging_dir, self.result_dir(lease.task['key']))
+            kept = True
+        except OSError as e:
+            if e.errno not in (errno.EEXIST, errno.ENOTEMPTY):
+                raise
+            shutil.rmtree(staging_dir, ignore_errors=True)
+            kept = False
+        self._remove_leases(lease.task['key'])
+        return kept
+
+    def fail(self, lease: Lease, error: str):
+        _create_exclusive(self.failed_path(lease.task['key']), {
+            'key': lease.task['key'],
+            'attempts': lease.attempt,
+            'worker_id': lease.worker_id,
+            'error': error
+        })
+        shutil.rmtree(self.staging_dir(lease), ignore_errors=True)
+        self._remove_leases(lease.task['key'])
+
+    def release(self, lease: Lease):
+        """
+        Give up lease (e.g. when a worker is interrupted), so that its task can be claimed right away.
+        """
+        shutil.rmtree(self.staging_dir(lease), ignore_errors=True)
+        try:
+            os.remove(lease.path)
+        except FileNotFoundError:
+            pass
+
+    def read_result(self, key: str) -> dict:
+        return _read_json(os.path.join(self.result_dir(key), RESULT_FILE))
+
+    def read_failure(self, key: str) -> dict:
+        return _read_json(self.failed_path(key))
+
+
+def run_worker(queue: TaskQueue, label: Callable[[Tuple[str, str, str], str], Tuple[dict, Optional[dict]]],
+               worker_id: str = None) -> Dict[str, int]:
+    """
+    Claim and label tasks of queue until every task is done or failed. Idle workers wait for leased tasks to be
+    completed, as a stale one will be claimed again.
+
+    :param label: Function labeling a watershed into an output directory, returning a tuple of (manifest entry,
+        metrics or None)
+    :return: Number of tasks completed (DONE) and failed (FAILED) by this worker
+    """
+    worker_id = worker_id or default_worker_id()
+    counts = {DONE: 0, FAILED: 0}
+    poll_seconds = min(queue.lease_seconds / 2, MAX_POLL_SECONDS)
+    while True:
+        lease = queue.claim(worker_id)
+        if lease is None:
+            if all(state in (DONE, FAILED) for state in queue.states().values()):
+                return counts
+            time.sleep(poll_seconds)
+            continue
+        staging_dir = queue.staging_dir(lease)
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        os.makedirs(staging_dir)
+        try:
+            with Heartbeat(lease):
+                entry, metrics = label(tuple(lease.task['ws']), staging_dir)
+            _write_json(os.path.join(staging_dir, RESULT_FILE), {
+                'entry': entry,
+                'metrics': metrics,
+                'worker_id': worker_id,
+                'attempt': lease.attempt
+            })
+        except Exception:
+            if queue.is_done(lease.task['key']):
+                # Superseded by another attempt, which completed the task (and removed this attempt's staging
+                # directory)
+                queue.release(lease)
+            else:
+                queue.fail(lease, traceback.format_exc())
+                counts[FAILED] += 1
+            continue
+        except BaseException:
+            queue.release(lease)
+            raise
+        if queue.complete(lease, staging_dir):
+            counts[DONE] += 1
+
+
+def _copy_file(source: str, destination: str):
+    tmp_path = f"{destination}.tmp"
+    shutil.copyfile(source, tmp_path)
+    os.replace(tmp_path, destination)
+
+
+def merge_results(queue: TaskQueue, sinks: List[OutputSink], output_dir: str,
+                  keys: List[str] = None) -> Iterator[Tuple[dict, dict]]:
+    """
+    Merge the output and logs of completed tasks into sinks, writing to output_dir. Per-HUC8 output files in the
+    format the tasks were labeled in are copied; other sinks (e.g. the label index) are written the labeled reaches
+    read back from them. Each HUC8 replaces any output previously written for it, so merging is idempotent.
+
+    :param keys: Keys of the tasks to merge. Default: all completed tasks
+    :return: Iterator of (task, result) of each merged task, after its output has been written
+    """
+    if keys is None:
+        states = queue.states()
+        keys = [key for key in sorted(states) if states[key] == DONE]
+    tasks = {task['key']: task for task in queue.tasks()}
+    staged_format = staging_format(queue.options['output_format'])
+    for key in keys:
+        task = tasks[key]
+        ws_code, huc8 = task['ws'][0], task['ws'][1]
+        result_dir = queue.result_dir(key)
+        staged = OUTPUT_SINKS[staged_format](result_dir)
+        try:
+            for sink in sinks:
+                if sink.format == staged_format:
+                    _copy_file(staged.path(ws_code, huc8), sink.path(ws_code, huc8))
+                else:
+                    sink.write_huc8(ws_code, huc8, typed_rows(staged.read_huc8(ws_code, huc8)))
+        finally:
+            staged.close()
+        _copy_file(os.path.join(result_dir, f"{key}.txt"), os.path.join(output_dir, f"{key}.txt"))
+        yield task, queue.read_result(key)
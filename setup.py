@@ -21,7 +21,11 @@ setuptools.setup(
     install_requires=[
         'base32-crockford'
     ],
+    extras_require={
+        'parquet': ['pyarrow']
+    },
     tests_require=[
+        'pytest'
     ],
     entry_points={
         'console_scripts': [
@@ -0,0 +1,194 @@
+# Copyright (C) 2021-present State of Louisiana, Division of Administration, Office of Community Development.
+# All rights reserved. Licensed under the GPLv3 License. See LICENSE.txt in the project root for license information.
+
+"""
+Tests that each way of loading and labeling watersheds labels a small synthetic network (see synthetic.py) exactly as
+labeling it serially does, for NHDPlus V2 and HR, and that labels survive the diff, extract, and task queue
+commands.
+"""
+
+import csv
+import io
+import json
+import os
+import shutil
+import subprocess
+import sys
+from typing import Dict, List
+
+import pytest
+
+from lwi_model_naming_conventions.cmd.lwi_label_nhd_streams import assign_stream_labels, \
+    assign_stream_labels_parallel, find_root_flowlines, sort_root_flowlines
+from lwi_model_naming_conventions.sources import NetworkSource
+from lwi_model_naming_conventions.synthetic import generate_network, write_synthetic_data
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Large enough that each HUC8 has dozens of independent groups of root flowlines, none more than a tenth of the
+# HUC8, so that assign_stream_labels_parallel() labels them in parallel rather than falling back to serial labeling
+NUM_REACHES = 1000
+NUM_HUC8S = 2
+MAX_ORDER = 3
+
+
+@pytest.fixture(scope='module')
+def synthetic(tmp_path_factory):
+    network = generate_network(num_reaches=NUM_REACHES, num_huc8s=NUM_HUC8S, max_order=MAX_ORDER, seed=1)
+    return network, write_synthetic_data(network, str(tmp_path_factory.mktemp('synthetic')))
+
+
+@pytest.fixture(scope='module')
+def paths(synthetic) -> Dict[str, str]:
+    return synthetic[1]
+
+
+def run_command(cwd: str, *args: str) -> subprocess.CompletedProcess:
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [REPO_DIR, os.environ.get('PYTHONPATH')])))
+    return subprocess.run([sys.executable, '-m', 'lwi_model_naming_conventions.cmd.lwi_label_nhd_streams', *args],
+                          cwd=cwd, env=env, capture_output=True, text=True)
+
+
+def source_args(paths: Dict[str, str], nhd_hr: bool) -> List[str]:
+    if nhd_hr:
+        return ['--nhdhr', '-f', paths['nhdplushr']]
+    return ['-f', paths['flowline'], '-p', paths['plusflow']]
+
+
+def read_labels(output_dir: str) -> Dict[str, List[List[str]]]:
+    """
+    :return: Rows of each CSV output file in output_dir, keyed by file name
+    """
+    labels = {}
+    for name in sorted(os.listdir(output_dir)):
+        if name.endswith('.csv'):
+            with open(os.path.join(output_dir, name), newline='') as f:
+                labels[name] = list(csv.reader(f))
+    return labels
+
+
+def label(run_dir: str, *args: str) -> Dict[str, List[List[str]]]:
+    """
+    Label streams in run_dir, with base32 labels in CSV output.
+
+    :return: Labels written (see read_labels())
+    """
+    os.makedirs(os.path.join(run_dir, 'output'))
+    result = run_command(run_dir, '--base32', *args)
+    assert result.returncode == 0, result.stderr
+    return read_labels(os.path.join(run_dir, 'output'))
+
+
+@pytest.fixture(scope='module')
+def serial_labels(paths, tmp_path_factory) -> Dict[bool, Dict[str, List[List[str]]]]:
+    """
+    Labels of watersheds labeled one at a time by a single process, keyed by whether NHDPlus HR was labeled
+    """
+    labels = {}
+    for nhd_hr in (False, True):
+        labels[nhd_hr] = label(str(tmp_path_factory.mktemp('serial')), *source_args(paths, nhd_hr),
+                               '-w', paths['watersheds'], '-n', '1')
+        assert len(labels[nhd_hr]) == NUM_HUC8S
+        assert all(len(rows) > 1 for rows in labels[nhd_hr].values())
+    return labels
+
+
+@pytest.mark.parametrize('nhd_hr', [False, True], ids=['v2', 'hr'])
+@pytest.mark.parametrize('options', [
+    ['-n', '2'],
+    ['--pipeline'],
+    ['--pipeline', '-n', '2'],
+    ['--region'],
+    ['--shared_memory'],
+    ['--flowline_cache_size', '0'],
+], ids=lambda options: ' '.join(options))
+def test_labeling_options(paths, serial_labels, tmp_path, nhd_hr, options):
+    assert label(str(tmp_path), *source_args(paths, nhd_hr), '-w', paths['watersheds'], *options) == \
+        serial_labels[nhd_hr]
+
+
+# NHDPlus HR labels loaded from the VAA may differ from those loaded from NHDPlusFlow (see hydroseq.py)
+def test_hydroseq(paths, serial_labels, tmp_path):
+    assert label(str(tmp_path), '-f', paths['flowline'], '--hydroseq', '-w', paths['watersheds'], '-n', '1') == \
+        serial_labels[False]
+
+
+@pytest.mark.parametrize('nhd_hr', [False, True], ids=['v2', 'hr'])
+def test_network_cache(paths, serial_labels, tmp_path, nhd_hr):
+    cache = str(tmp_path / 'network.cache')
+    result = run_command(str(tmp_path), 'compile', *source_args(paths, nhd_hr), '-o', cache)
+    assert result.returncode == 0, result.stderr
+    args = ['--nhdhr'] if nhd_hr else []
+    assert label(str(tmp_path / 'run'), *args, '-c', cache, '-w', paths['watersheds'], '-n', '1') == \
+        serial_labels[nhd_hr]
+
+
+@pytest.mark.parametrize('nhd_hr', [False, True], ids=['v2', 'hr'])
+@pytest.mark.parametrize('base32', [False, True], ids=['hexadecimal', 'base32'])
+def test_assign_stream_labels_parallel(synthetic, nhd_hr, base32):
+    network, paths = synthetic
+    flowline_path, plusflow_path = (paths['nhdplushr'], None) if nhd_hr else (paths['flowline'], paths['plusflow'])
+    with NetworkSource(flowline_path, plusflow_path, nhd_hr) as source:
+        for huc8 in network.huc8s:
+            labeled = []
+            for parallel in (False, True):
+                # Labels are set on the flowlines of the network, so each run labels a network of its own
+                huc8_network = source.load_huc8_network(huc8)
+                root_flowlines = sort_root_flowlines(find_root_flowlines(huc8_network, huc8))
+                if parallel:
+                    log = io.StringIO()
+                    stream_orders, order_label_count, _ = \
+                        assign_stream_labels_parallel(huc8_network, huc8, root_flowlines, base32, 2, log)
+                    assert 'labeling serially' not in log.getvalue()
+                else:
+                    stream_orders, order_label_count, _ = assign_stream_labels(huc8_network, huc8, root_flowlines,
+                                                                               base32)
+                labeled.append(({order: [(f.comid, f.label) for f in flowlines]
+                                 for order, flowlines in stream_orders.items()}, list(stream_orders),
+                                dict(order_label_count)))
+            assert labeled[0] == labeled[1]
+
+
+def test_diff(paths, tmp_path):
+    old = os.path.join(str(tmp_path / 'old'), 'output')
+    new = os.path.join(str(tmp_path / 'new'), 'output')
+    labels = label(os.path.dirname(old), *source_args(paths, False), '-w', paths['watersheds'], '-n', '1')
+    shutil.copytree(old, new)
+    result = run_command(str(tmp_path), 'diff', old, new)
+    assert result.returncode == 0, result.stdout + result.stderr
+
+    # Relabel a reach of the new run
+    name, rows = next(iter(labels.items()))
+    stream_label = rows[1][0]
+    rows[1][0] = stream_label[:-1] + ('1' if stream_label[-1] == '0' else '0')
+    with open(os.path.join(new, name), 'w', newline='') as f:
+        csv.writer(f).writerows(rows)
+    differences = str(tmp_path / 'differences.json')
+    result = run_command(str(tmp_path), 'diff', old, new, '--json', differences)
+    assert result.returncode == 1, result.stdout + result.stderr
+    with open(differences, encoding='utf-8') as f:
+        assert [(r['huc8'], r['relabeled']) for r in json.load(f) if r['relabeled']] == [(rows[1][2], 1)]
+
+
+@pytest.mark.parametrize('nhd_hr', [False, True], ids=['v2', 'hr'])
+def test_extract(paths, serial_labels, tmp_path, nhd_hr):
+    extract = str(tmp_path / 'extract.sqlite')
+    result = run_command(str(tmp_path), 'extract', *source_args(paths, nhd_hr), '-w', paths['watersheds'],
+                         '-o', extract)
+    assert result.returncode == 0, result.stderr
+    args = ['--nhdhr', '-f', extract] if nhd_hr else ['-f', extract, '-p', extract]
+    assert label(str(tmp_path / 'run'), *args, '-w', paths['watersheds'], '-n', '1') == serial_labels[nhd_hr]
+
+
+@pytest.mark.parametrize('nhd_hr', [False, True], ids=['v2', 'hr'])
+def test_task_queue(paths, serial_labels, tmp_path, nhd_hr):
+    queue = str(tmp_path / 'queue')
+    output = str(tmp_path / 'output')
+    # Workers label NHDPlus HR if the queue does
+    work_source_args = ['-f', paths['nhdplushr']] if nhd_hr else source_args(paths, nhd_hr)
+    for args in (['enqueue', '-q', queue, '-w', paths['watersheds'], *source_args(paths, nhd_hr)],
+                 ['work', '-q', queue, *work_source_args, '-n', '2'],
+                 ['merge', '-q', queue, '-o', output]):
+        result = run_command(str(tmp_path), *args)
+        assert result.returncode == 0, result.stderr
+    assert read_labels(output) == serial_labels[nhd_hr]